@@ -1,12 +1,25 @@
+import startup_profile
+# Only a server start is profiled, not importing app from the benchmarks
+if __name__ == "__main__":
+    startup_profile.start()
 import gradio as gr
-from utils import process_paper
+from utils import stream_paper, queue_status, MODELS
 import os
 import logging
 import html
-from logging_config import setup_logging
-from aws_utils import update_leaderboard, get_leaderboard, write_request
+import threading
+import time
+import providers
+import token_utils
+from logging_config import setup_logging, log_payload
+from storage import get_storage, build_request_item
+from leaderboard_utils import MaterializedLeaderboard
+from vote_queue import VoteQueue
+from upload_store import upload_store
+from job_queue import get_job_queue
+from pair_sampling import pair_sampler
+from metrics_utils import span, increment, start_metrics_server
 from flask import request
-import hashlib
 import uuid
 import json
 from dotenv import load_dotenv
@@ -17,6 +30,7 @@ except:
     pass
 
 setup_logging()
+startup_profile.phase('imports')
 paper_dir = 'path_to_temp_storage'
 prompt_dir = 'iclr2024'
 api_keys = {
@@ -28,10 +42,17 @@ api_keys = {
 
 ##
 use_real_api = True
-
-# Function to generate a paper_id using SHA-512 hash
-def generate_paper_id(paper_content):
-    return hashlib.sha512(paper_content.encode('utf-8')).hexdigest()
+# Warm up storage, the tokenizer and provider clients once the server is listening
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+# 'queue' hands reviews to review_worker.py processes through the job queue;
+# 'inline' runs them in this process
+REVIEW_JOBS = os.environ.get('REVIEW_JOBS', 'inline')
+# Provider calls, and so the model health pairs are weighed by, are then in the workers
+pair_sampler.worker_health = REVIEW_JOBS == 'queue'
+# Seconds between polls of a queued job
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_SECONDS', 0.5))
+# Seconds between sweeps of Gradio's upload cache, and the age at which files go
+GRADIO_CACHE_SECONDS = int(os.environ.get('GRADIO_CACHE_SECONDS', 3600))
 
 # Function to get user IP address
 def get_user_ip():
@@ -40,23 +61,105 @@ def get_user_ip():
     except:
         return "Unknown"
 
-def review_papers(pdf_file):
+# Function to turn a list of "Header: text" sections into a section dict
+def process_review(review):
+    processed_review = {}
+    for section in review:
+        if ':' in section:
+            key, value = section.split(':', 1)
+            processed_value = value.strip().replace('\n', '<br>')
+            processed_review[key.strip()] = html.escape(
+                processed_value)
+    return processed_review
+
+# Function to render a processed review as HTML
+def format_review(review, pending=False, status=None, job_id=None, error=None):
+    formatted_review = "<div class='review-container'>"
+    for section, content in review.items():
+        formatted_review += f"<div class='review-section'><strong>{section}:</strong> <span>{html.unescape(content)}</span></div>"
+    if error is not None:
+        formatted_review += f"<div class='review-section'><em>{html.escape(error)}</em></div>"
+    if pending and status is not None:
+        ahead, eta = status
+        formatted_review += f"<div class='review-section'><em>Queued behind {ahead} requests, about {max(1, round(eta))}s until generation starts...</em></div>"
+    elif pending:
+        formatted_review += "<div class='review-section'><em>Generating review...</em></div>"
+    if pending and job_id is not None:
+        formatted_review += f"<div class='review-section'><em>Reloading? Follow this review at <a href='?job={job_id}'>?job={job_id}</a></em></div>"
+    formatted_review += "</div>"
+    return formatted_review
+
+# Generator: yields (reviews, models, done) for a queued job as the workers
+# write its progress, like stream_paper does for an inline review. A job that
+# failed or is unknown ends with a fourth item, the message to show instead.
+def poll_job(job_id):
+    jobs = get_job_queue()
+    while True:
+        job = jobs.get(job_id)
+        if job is None:
+            logging.error(f"Job {job_id} not found")
+            yield [], [], True, "This review was not found; it may have expired. Please upload the paper again."
+            return
+        if job['Status'] == 'failed':
+            logging.error(f"Job {job_id} failed: {job['Error']}")
+            yield job['Reviews'], job['Models'], True, "This review could not be finished. Please upload the paper again."
+            return
+        if job['Status'] == 'done':
+            yield job['Reviews'], job['Models'], True
+            return
+        yield job['Reviews'], job['Models'], False
+        time.sleep(JOB_POLL_INTERVAL)
+
+# Function to check whether a finished review is missing or has no answered
+# section, so there is nothing to vote on
+def review_failed(review, model):
+    return model is None or not review or all(value == 'N/A' for value in review.values())
+
+# Generator: yields the review outputs for each update. The vote controls are
+# only made visible on the final yield, and not at all if it carries an error
+# or either review failed.
+def render_updates(updates, paper_digest, user_id=None, job_id=None):
+    for reviews, selected_models, done, *failure in updates:
+        error = failure[0] if failure else None
+        if use_real_api:
+            reviews = [process_review(review) for review in reviews]
+        reviews = (list(reviews) + [{}, {}])[:2]
+        model_a, model_b = (selected_models + [None, None])[:2]
+        if done and error is None and (review_failed(reviews[0], model_a) or review_failed(reviews[1], model_b)):
+            logging.error(f"Review by {model_a} or {model_b} failed; not offering a vote")
+            error = "A review could not be generated, so this pair cannot be voted on. Please upload the paper again."
+        if done or not use_real_api:
+            status = None
+        elif job_id is not None:
+            status = get_job_queue().queue_status(job_id)
+        else:
+            status = queue_status(user_id)
+        review_texts = [format_review(review, pending=not done, status=status, job_id=job_id, error=error) for review in reviews]
+
+        if done:
+            log_payload("Final formatted reviews", review_texts)
+        votable = done and error is None
+        yield review_texts[0], review_texts[1], gr.update(visible=votable), gr.update(visible=votable), model_a, model_b, paper_digest
+
+# Generator: yields both reviews as their sections stream in; the vote
+# controls only become visible on the final yield
+def review_papers(pdf_file, request: gr.Request = None):
     logging.info(f"Received file type: {type(pdf_file)}")
-    paper_content = pdf_file.read() if hasattr(pdf_file, 'read') else pdf_file  # Read the content of the uploaded PDF file
-    if use_real_api:
-        reviews, selected_models = process_paper(
-            pdf_file, paper_dir, prompt_dir, api_keys)
-        processed_reviews = []
-        for review in reviews:
-            processed_review = {}
-            for section in review:
-                if ':' in section:
-                    key, value = section.split(':', 1)
-                    processed_value = value.strip().replace('\n', '<br>')
-                    processed_review[key.strip()] = html.escape(
-                        processed_value)
-            processed_reviews.append(processed_review)
-        reviews = processed_reviews
+    if pdf_file is None:
+        logging.error("Submit clicked without an uploaded file.")
+        return
+    # The upload is hashed and stored once; the session only keeps its digest
+    paper_digest = upload_store.put_file(pdf_file)
+    # Provider calls are queued fairly per browser session
+    user_id = request.session_hash if request is not None and request.session_hash else uuid.uuid4().hex
+    job_id = None
+    if use_real_api and REVIEW_JOBS == 'queue':
+        # The pair is picked here, where votes are recorded, and the job runs on a worker
+        job_id = get_job_queue().enqueue(paper_digest, pair_sampler.sample(MODELS), user_id)
+        logging.info(f"Queued review job {job_id}")
+        updates = poll_job(job_id)
+    elif use_real_api:
+        updates = stream_paper(upload_store.path(paper_digest), paper_dir, prompt_dir, api_keys, user_id, paper_digest)
     else:
         reviews = [
             {
@@ -87,38 +190,120 @@ def review_papers(pdf_file):
             }
         ]
         selected_models = ['model1-placeholder', 'model2-placeholder']
+        updates = [(reviews, selected_models, True)]
+
+    yield from render_updates(updates, paper_digest, user_id, job_id)
 
-    review_texts = []
-    for review in reviews:
-        formatted_review = "<div class='review-container'>"
-        for section, content in review.items():
-            formatted_review += f"<div class='review-section'><strong>{section}:</strong> <span>{html.unescape(content)}</span></div>"
-        formatted_review += "</div>"
-        review_texts.append(formatted_review)
+# Generator: follows the job named in the page URL (?job=...), so a reload
+# does not lose a queued review
+def resume_review(request: gr.Request = None):
+    job_id = request.query_params.get('job') if request is not None else None
+    if not job_id or REVIEW_JOBS != 'queue':
+        return
+    job = get_job_queue().get(job_id)
+    yield from render_updates(poll_job(job_id), job['PaperDigest'] if job else None, job_id=job_id)
 
-    model_a = selected_models[0]
-    model_b = selected_models[1]
+# Function to store votes from the log and apply each to the leaderboard,
+# patching the cached copy with the new rows. Both happen in one storage
+# transaction keyed by RequestID, so a batch replayed after a crash neither
+# loses nor double counts a leaderboard update. Storage is connected on first
+# use rather than at import, so a slow or unreachable database cannot hold up startup.
+def record_votes(items):
+    # rating_utils loads numpy, which startup does not need
+    from rating_utils import LATE_VOTE_SECONDS
+    storage = get_storage()
+    for item in items:
+        with span('leaderboard_update'):
+            updated_items = storage.record_vote(item)
+        if updated_items is None:
+            continue
+        leaderboard.apply(updated_items)
+        # The incremental rating job only rereads LATE_VOTE_SECONDS back, so a
+        # vote stored later than that is missed until its next full recompute
+        delay = time.time() - float(item['Timestamp'])
+        if delay > LATE_VOTE_SECONDS:
+            logging.warning(f"Vote {item['RequestID']} stored {delay:.0f}s late; ratings miss it until the next full recompute")
+            increment('arena_late_votes_total')
 
-    logging.debug(f"Final formatted reviews: {review_texts}")
-    return review_texts[0], review_texts[1], gr.update(visible=True), gr.update(visible=True), model_a, model_b, paper_content
+vote_queue = VoteQueue(record_votes, is_transient=lambda error: get_storage().is_transient(error))
 
-def handle_vote(vote, model_a, model_b, paper_content):
+def handle_vote(vote, model_a, model_b, paper_digest):
     user_id = get_user_ip()  # Get the user IP address as user_id
-    paper_id = generate_paper_id(paper_content)  # Generate paper_id from paper content
-    
-    # Write the request
-    write_request(user_id, paper_id, model_a, model_b, vote)
+    paper_id = paper_digest  # SHA-512 of the uploaded PDF
+
+    # The vote endpoint can be called from a session that never got a pair
+    if not model_a or not model_b or not vote:
+        logging.warning(f"Rejected vote {vote!r} for {model_a!r} vs {model_b!r}")
+        message = "<p>This vote could not be recorded: pick an option after both reviews have finished.</p>"
+        return gr.update(value=message, visible=True), gr.update(), gr.update(), gr.update()
     
-    # Update the leaderboard
-    update_leaderboard(model_a, model_b, vote)
+    # Record the vote in the local log; the flusher writes it to the Requests
+    # table and applies it to the leaderboard off the request path
+    with span('vote_submit'):
+        vote_queue.submit(build_request_item(user_id, paper_id, model_a, model_b, vote))
     
-    # Fetch the updated leaderboard (optional, if you want to display it immediately)
-    leaderboard = get_leaderboard()
+    pair_sampler.record_vote(model_a, model_b)
     
     message = f"<p>Thank you for your vote!</p><p>Model A: {model_a}</p><p>Model B: {model_b}</p>"
     return gr.update(value=message, visible=True), gr.update(visible=False), gr.update(visible=False), gr.update(visible=True)
 
 
+# Function to render leaderboard rows as an HTML table
+def render_leaderboard(leaderboard_data):
+    leaderboard_html = """
+        <table style="width:100%; border: 1px solid #444; border-collapse: collapse; font-family: Arial, sans-serif; background-color: #2b2b2b;">
+            <thead>
+                <tr style="border: 1px solid #444; padding: 12px; background-color: #1a1a1a;">
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Rank</th>
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Model</th>
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Arena Elo</th>
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">95% CI</th>
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Votes</th>
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Organization</th>
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">License</th>
+                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Knowledge Cutoff</th>
+                </tr>
+            </thead>
+            <tbody>
+    """
+
+    for rank, model in enumerate(leaderboard_data, start=1):
+        leaderboard_html += f"""
+            <tr style="border: 1px solid #444; padding: 12px;">
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{rank}</td>
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['ModelID']}</td>
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['EloScore']}</td>
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model.get('CI_Lower', '')} - {model.get('CI_Upper', '')}</td>
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['Votes']}</td>
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model.get('Organization', '')}</td>
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model.get('License', '')}</td>
+                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model.get('KnowledgeCutoff', '')}</td>
+            </tr>
+        """
+    leaderboard_html += """
+            </tbody>
+        </table>
+    """
+    return leaderboard_html
+
+leaderboard = MaterializedLeaderboard(lambda: get_storage().get_leaderboard(), render_leaderboard)
+LEADERBOARD_LOADING_HTML = "<p>Loading leaderboard...</p>"
+
+# Function to do the slow first-use work (imports, tokenizer files, clients)
+# in the background, so the first upload does not pay for it
+def warm_up():
+    steps = [('storage', get_storage), ('tokenizer', token_utils.get_encoding)]
+    steps += [(model, lambda model=model: providers.get_provider(model).client) for model in MODELS]
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logging.warning(f"Warmup of {name} failed: {e!r}")
+            continue
+        logging.info(f"Warmed up {name} in {time.perf_counter() - started:.2f}s")
+
+
 def setup_interface():
     logging.debug("Setting up Gradio interface.")
     css = """
@@ -165,8 +350,9 @@ def setup_interface():
         font-size: 16px;
     }
     """
-    with gr.Blocks(css=css) as demo:
-        paper_content_state = gr.State()
+    # Gradio's own copies of uploads are dropped once they are in the upload store
+    with gr.Blocks(css=css, delete_cache=(GRADIO_CACHE_SECONDS, GRADIO_CACHE_SECONDS)) as demo:
+        paper_digest_state = gr.State()
         model_a_state = gr.State()
         model_b_state = gr.State()
         with gr.Tabs():
@@ -192,99 +378,47 @@ def setup_interface():
 
                 model_identity_message = gr.HTML("", visible=False)
 
-                def handle_vote_interface(vote, model_a, model_b, paper_content):
-                    return handle_vote(vote, model_a, model_b, paper_content)
+                def handle_vote_interface(vote, model_a, model_b, paper_digest):
+                    return handle_vote(vote, model_a, model_b, paper_digest)
 
                 submit_button.click(fn=review_papers, inputs=[file_input],
-                                    outputs=[review1, review2, vote, vote_button, model_a_state, model_b_state, paper_content_state])
+                                    outputs=[review1, review2, vote, vote_button, model_a_state, model_b_state, paper_digest_state])
 
-                vote_button.click(fn=handle_vote_interface, inputs=[vote, model_a_state, model_b_state, paper_content_state],
+                vote_button.click(fn=handle_vote_interface, inputs=[vote, model_a_state, model_b_state, paper_digest_state],
                                   outputs=[vote_message, vote, vote_button, another_paper_button])
 
                 another_paper_button.click(fn=lambda: None, inputs=None, outputs=None, js="() => { location.reload(); }")
 
+                demo.load(fn=resume_review, inputs=None,
+                          outputs=[review1, review2, vote, vote_button, model_a_state, model_b_state, paper_digest_state])
+
             with gr.TabItem("Leaderboard"):
                 gr.Markdown("## Leaderboard")
                 
-                def refresh_leaderboard():
-                    leaderboard_data = get_leaderboard()
-                    leaderboard_html = """
-                        <table style="width:100%; border: 1px solid #444; border-collapse: collapse; font-family: Arial, sans-serif; background-color: #2b2b2b;">
-                            <thead>
-                                <tr style="border: 1px solid #444; padding: 12px; background-color: #1a1a1a;">
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Rank</th>
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Model</th>
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Arena Elo</th>
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">95% CI</th>
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Votes</th>
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Organization</th>
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">License</th>
-                                    <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Knowledge Cutoff</th>
-                                </tr>
-                            </thead>
-                            <tbody>
-                    """
-                    
-                    for rank, model in enumerate(leaderboard_data, start=1):
-                        leaderboard_html += f"""
-                            <tr style="border: 1px solid #444; padding: 12px;">
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{rank}</td>
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['ModelID']}</td>
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['EloScore']}</td>
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['CI_Lower']} - {model['CI_Upper']}</td>
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['Votes']}</td>
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['Organization']}</td>
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['License']}</td>
-                                <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['KnowledgeCutoff']}</td>
-                            </tr>
-                        """
-                    leaderboard_html += """
-                            </tbody>
-                        </table>
-                    """
-                    return gr.update(value=leaderboard_html)
-                
-                # Initial load of the leaderboard
-                leaderboard_data = get_leaderboard()
-                leaderboard_html_initial = """
-                    <table style="width:100%; border: 1px solid #444; border-collapse: collapse; font-family: Arial, sans-serif; background-color: #2b2b2b;">
-                        <thead>
-                            <tr style="border: 1px solid #444; padding: 12px; background-color: #1a1a1a;">
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Rank</th>
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Model</th>
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Arena Elo</th>
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">95% CI</th>
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Votes</th>
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Organization</th>
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">License</th>
-                                <th style="border: 1px solid #444; padding: 12px; color: #ddd;">Knowledge Cutoff</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                """
-                
-                for rank, model in enumerate(leaderboard_data, start=1):
-                    leaderboard_html_initial += f"""
-                        <tr style="border: 1px solid #444; padding: 12px;">
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{rank}</td>
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['ModelID']}</td>
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['EloScore']}</td>
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['CI_Lower']} - {model['CI_Upper']}</td>
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['Votes']}</td>
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['Organization']}</td>
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['License']}</td>
-                            <td style="border: 1px solid #444; padding: 12px; color: #ddd;">{model['KnowledgeCutoff']}</td>
-                        </tr>
-                    """
-                leaderboard_html_initial += """
-                        </tbody>
-                    </table>
-                """
-
-                leaderboard_html = gr.HTML(leaderboard_html_initial)
+                # Only send the table when it changed since this session last saw it
+                def refresh_leaderboard(seen_etag):
+                    html_table, version, etag = leaderboard.get()
+                    if etag == seen_etag:
+                        return gr.update(), seen_etag
+                    return gr.update(value=html_table), etag
+
+                # Page loads never wait for storage
+                def load_leaderboard(seen_etag):
+                    html_table, version, etag = leaderboard.peek()
+                    if html_table is None or etag == seen_etag:
+                        return gr.update(), seen_etag
+                    return gr.update(value=html_table), etag
+
+                # The leaderboard loads in the background; pages show whatever is loaded when they open
+                leaderboard_etag = gr.State(None)
+                leaderboard_html = gr.HTML(LEADERBOARD_LOADING_HTML)
                 refresh_button = gr.Button("Refresh Leaderboard")
-                refresh_button.click(fn=refresh_leaderboard, inputs=[], outputs=[leaderboard_html])
+                refresh_button.click(fn=refresh_leaderboard, inputs=[leaderboard_etag], outputs=[leaderboard_html, leaderboard_etag])
+                demo.load(fn=load_leaderboard, inputs=[leaderboard_etag], outputs=[leaderboard_html, leaderboard_etag])
 
+    leaderboard.start()
+    vote_queue.start()
+    start_metrics_server()
     logging.debug("Gradio interface setup complete.")
     return demo
 
@@ -292,5 +426,11 @@ def setup_interface():
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     demo = setup_interface()
-    demo.launch()
+    startup_profile.phase('interface')
+    demo.launch(prevent_thread_lock=True)
+    startup_profile.phase('launch')
+    startup_profile.finish()
+    if STARTUP_WARMUP:
+        threading.Thread(target=warm_up, name='warmup', daemon=True).start()
+    demo.block_thread()
 
@@ -1,9 +1,13 @@
 import boto3
-import uuid
 import datetime
+import logging
 import os
-from decimal import Decimal, getcontext
+import random
+import time
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 from dotenv import load_dotenv
+from storage import Storage, LeaderboardConflict, VOTE_MAPPING, VOTE_COUNTERS, build_request_item, new_model_stats, apply_vote, calculate_elo, calculate_95_ci, vote_day
 
 try:
     load_dotenv()
@@ -19,148 +23,217 @@ aws_region = os.environ.get('AWS_REGION')
 dynamodb = boto3.resource('dynamodb',
                           region_name=aws_region,
                           aws_access_key_id=aws_access_key_id,
-                          aws_secret_access_key=aws_secret_access_key)
+                          aws_secret_access_key=aws_secret_access_key,
+                          endpoint_url=os.environ.get('DYNAMODB_ENDPOINT_URL'))
 
 # Define the tables
 requests_table = dynamodb.Table('reviewer_arena_requests')
 leaderboards_table = dynamodb.Table('reviewer_arena_leaderboard')
+# Global secondary index of the requests table on (VoteDay, Timestamp); see create_time_index
+REQUESTS_TIME_INDEX = os.environ.get('REQUESTS_TIME_INDEX', 'VoteDay-Timestamp-index')
 
 # Function to write a request to the Requests table
 def write_request(user_id, paper_id, model_a, model_b, vote):
-    request_id = str(uuid.uuid4())
-    timestamp = str(Decimal(datetime.datetime.now().timestamp()))
-    
     response = requests_table.put_item(
-        Item={
-            'RequestID': request_id,
-            'Timestamp': timestamp,
-            'UserID': user_id,
-            'PaperID': paper_id,
-            'ModelA': model_a,
-            'ModelB': model_b,
-            'Vote': vote
-        }
+        Item=build_request_item(user_id, paper_id, model_a, model_b, vote)
     )
     return response
 
-# Function to update leaderboard after a vote
-def update_leaderboard(model_a, model_b, vote):
-    # Map vote options to simpler keys
-    vote_mapping = {
-        "👍 A is better": "A is better",
-        "👍 B is better": "B is better",
-        "👔 Tie": "Tie",
-        "👎 Both are bad": "Tie"  # Assuming "Both are bad" is treated as a tie
-    }
-    vote = vote_mapping.get(vote, "Tie")  # Default to "Tie" if vote is not found
+# Function to write a batch of request items; unprocessed items are resent by the batch writer
+def write_requests(items):
+    with requests_table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
 
-    # Retrieve current stats for ModelA and ModelB
-    model_a_stats = leaderboards_table.get_item(Key={'ModelID': model_a}).get('Item', {})
-    model_b_stats = leaderboards_table.get_item(Key={'ModelID': model_b}).get('Item', {})
-    
-    # Initialize stats if they don't exist
-    if not model_a_stats:
-        model_a_stats = {'ModelID': model_a, 'Wins': 0, 'Losses': 0, 'Ties': 0, 'EloScore': Decimal(1200), 'Votes': 0}
-        leaderboards_table.put_item(Item=model_a_stats)
-    if not model_b_stats:
-        model_b_stats = {'ModelID': model_b, 'Wins': 0, 'Losses': 0, 'Ties': 0, 'EloScore': Decimal(1200), 'Votes': 0}
-        leaderboards_table.put_item(Item=model_b_stats)
-    
-    # Update stats based on the vote
-    update_expressions = {
-        "A is better": {
-            "model_a": "SET Wins = Wins + :inc, Votes = Votes + :inc",
-            "model_b": "SET Losses = Losses + :inc, Votes = Votes + :inc"
-        },
-        "B is better": {
-            "model_a": "SET Losses = Losses + :inc, Votes = Votes + :inc",
-            "model_b": "SET Wins = Wins + :inc, Votes = Votes + :inc"
-        },
-        "Tie": {
-            "model_a": "SET Ties = Ties + :inc, Votes = Votes + :inc",
-            "model_b": "SET Ties = Ties + :inc, Votes = Votes + :inc"
-        }
+MAX_UPDATE_ATTEMPTS = 8
+# Error codes of throttled, conflicting or failed-on-the-server requests, and
+# the cancellation reasons of transactions that failed for the same causes
+TRANSIENT_ERROR_CODES = {'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded',
+                         'TransactionConflictException', 'TransactionInProgressException',
+                         'InternalServerError', 'ServiceUnavailable'}
+TRANSIENT_CANCELLATION_REASONS = {'ThrottlingError', 'ProvisionedThroughputExceeded', 'TransactionConflict'}
+
+# Function to read both models' rows in one strongly consistent round trip
+def read_model_stats(model_ids):
+    request = {leaderboards_table.name: {'Keys': [{'ModelID': model_id} for model_id in model_ids], 'ConsistentRead': True}}
+    stats = {}
+    while request:
+        response = dynamodb.batch_get_item(RequestItems=request)
+        for item in response['Responses'].get(leaderboards_table.name, []):
+            stats[item['ModelID']] = item
+        request = response.get('UnprocessedKeys')
+    return stats
+
+# Function to build a transactional update that only applies if nobody else
+# has written the row since it was read. The resource's client serializes values itself.
+def versioned_update(item, expected_version):
+    fields = ['Wins', 'Losses', 'Ties', 'Votes', 'EloScore', 'CI_Lower', 'CI_Upper', 'Version']
+    update = {
+        'TableName': leaderboards_table.name,
+        'Key': {'ModelID': item['ModelID']},
+        'UpdateExpression': 'SET ' + ', '.join(f"#{field} = :{field}" for field in fields),
+        'ExpressionAttributeNames': {f"#{field}": field for field in fields},
+        'ExpressionAttributeValues': {f":{field}": item[field] for field in fields},
     }
-    
-    expression_a = update_expressions[vote]["model_a"]
-    expression_b = update_expressions[vote]["model_b"]
-    
-    # Update ModelA stats
-    leaderboards_table.update_item(
-        Key={'ModelID': model_a},
-        UpdateExpression=expression_a,
-        ExpressionAttributeValues={':inc': 1}
-    )
-    
-    # Update ModelB stats
-    leaderboards_table.update_item(
-        Key={'ModelID': model_b},
-        UpdateExpression=expression_b,
-        ExpressionAttributeValues={':inc': 1}
-    )
-    
-    # Calculate new Elo scores (simple Elo calculation for illustration)
-    new_elo_a, new_elo_b = calculate_elo(model_a_stats['EloScore'], model_b_stats['EloScore'], vote)
-
-    # Calculate 95% CI for new Elo scores
-    ci_a_lower, ci_a_upper = calculate_95_ci(new_elo_a, model_a_stats['Votes'] + 1)
-    ci_b_lower, ci_b_upper = calculate_95_ci(new_elo_b, model_b_stats['Votes'] + 1)
-
-    # Update Elo scores and 95% CI
-    leaderboards_table.update_item(
-        Key={'ModelID': model_a},
-        UpdateExpression="SET EloScore = :new_elo, CI_Lower = :ci_lower, CI_Upper = :ci_upper",
-        ExpressionAttributeValues={':new_elo': Decimal(new_elo_a), ':ci_lower': Decimal(ci_a_lower), ':ci_upper': Decimal(ci_a_upper)}
-    )
+    if expected_version is None:
+        update['ConditionExpression'] = 'attribute_not_exists(#Version)'
+    else:
+        update['ConditionExpression'] = '#Version = :expected_version'
+        update['ExpressionAttributeValues'][':expected_version'] = expected_version
+    return {'Update': update}
 
-    leaderboards_table.update_item(
-        Key={'ModelID': model_b},
-        UpdateExpression="SET EloScore = :new_elo, CI_Lower = :ci_lower, CI_Upper = :ci_upper",
-        ExpressionAttributeValues={':new_elo': Decimal(new_elo_b), ':ci_lower': Decimal(ci_b_lower), ':ci_upper': Decimal(ci_b_upper)}
-    )
+# Function to update leaderboard after a vote. Counters, Elo and CI for both
+# models are written in one conditional transaction; if another vote changed
+# either row in between, the rows are re-read and the update recomputed.
+# Given the vote's request item, the transaction also puts it, on condition
+# that no item with its RequestID exists; if one does, the vote was already
+# recorded and None is returned without changing anything.
+def update_leaderboard(model_a, model_b, vote, request_item=None):
+    vote = VOTE_MAPPING.get(vote, "Tie")  # Default to "Tie" if vote is not found
 
-# Set the precision for Decimal
-getcontext().prec = 28
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        stats = read_model_stats([model_a, model_b])
+        # Initialize stats if they don't exist
+        model_a_stats = stats.get(model_a) or new_model_stats(model_a)
+        model_b_stats = stats.get(model_b) or new_model_stats(model_b)
+        updated_a, updated_b = apply_vote(model_a_stats, model_b_stats, vote)
 
-# Function to calculate new Elo scores
-def calculate_elo(elo_a, elo_b, vote, k=32):
-    # Ensure elo_a and elo_b are Decimals
-    elo_a = Decimal(elo_a)
-    elo_b = Decimal(elo_b)
-    
-    expected_a = 1 / (1 + Decimal(10) ** ((elo_b - elo_a) / Decimal(400)))
-    expected_b = 1 / (1 + Decimal(10) ** ((elo_a - elo_b) / Decimal(400)))
-    
-    if vote == "A is better":
-        actual_a = Decimal(1)
-        actual_b = Decimal(0)
-    elif vote == "B is better":
-        actual_a = Decimal(0)
-        actual_b = Decimal(1)
-    else:  # Tie
-        actual_a = Decimal(0.5)
-        actual_b = Decimal(0.5)
-    
-    new_elo_a = elo_a + Decimal(k) * (actual_a - expected_a)
-    new_elo_b = elo_b + Decimal(k) * (actual_b - expected_b)
-    
-    return round(new_elo_a, 2), round(new_elo_b, 2)
+        items = [versioned_update(updated_a, model_a_stats.get('Version')),
+                 versioned_update(updated_b, model_b_stats.get('Version'))]
+        if request_item is not None:
+            items.append({'Put': {'TableName': requests_table.name, 'Item': request_item,
+                                  'ConditionExpression': 'attribute_not_exists(RequestID)'}})
+        try:
+            dynamodb.meta.client.transact_write_items(TransactItems=items)
+        except ClientError as e:
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            if request_item is not None and len(reasons) == 3 and reasons[2] == 'ConditionalCheckFailed':
+                return None
+            if not set(reasons) & {'ConditionalCheckFailed', 'TransactionConflict'}:
+                raise
+            # Lost the race to a concurrent vote; back off briefly and recompute
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+            continue
 
-# Function to calculate 95% CI for Elo scores
-def calculate_95_ci(elo, votes, z=1.96):
-    if votes == 0:
-        return Decimal(0), Decimal(0)
-    elo = Decimal(elo)  # Ensure elo is a Decimal
-    std_error = Decimal(400) / (Decimal(votes).sqrt())
-    margin = Decimal(z) * std_error
-    return round(elo - margin, 2), round(elo + margin, 2)
+        # Return the updated rows so cached leaderboards can be patched without a read
+        return [updated_a, updated_b]
+
+    raise LeaderboardConflict(f"Leaderboard update for {model_a} vs {model_b} kept conflicting after {MAX_UPDATE_ATTEMPTS} attempts")
 
 # Function to query leaderboard
 def get_leaderboard():
     response = leaderboards_table.scan()
     leaderboard = response.get('Items', [])
+    # Scans return at most 1 MB per page
+    while 'LastEvaluatedKey' in response:
+        response = leaderboards_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+        leaderboard.extend(response.get('Items', []))
     
     # Sort by EloScore in descending order
     leaderboard.sort(key=lambda x: x['EloScore'], reverse=True)
     
     return leaderboard
+
+# Function to load votes from the Requests table, optionally only those with a
+# Timestamp at or after since. All votes is a scan; votes since a time are a
+# query per day on the time index, so the cost of an incremental read scales
+# with the votes it returns. Votes written before items had a VoteDay are not
+# in the index, which only matters for reads that reach back before then.
+def load_votes(since=None):
+    names = {'#Timestamp': 'Timestamp'}
+    projection = 'RequestID, #Timestamp, ModelA, ModelB, Vote'
+    if since is not None:
+        try:
+            return query_votes_since(since, names, projection)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('ValidationException', 'ResourceNotFoundException'):
+                raise
+            logging.error(f"Requests table has no usable index {REQUESTS_TIME_INDEX} ({e}); "
+                          f"scanning the whole table instead. Create it with create_time_index().")
+    kwargs = {'ProjectionExpression': projection, 'ExpressionAttributeNames': names}
+    votes = []
+    while True:
+        response = requests_table.scan(**kwargs)
+        votes.extend(vote for vote in response.get('Items', []) if since is None or vote['Timestamp'] >= since)
+        if 'LastEvaluatedKey' not in response:
+            return votes
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def query_votes_since(since, names, projection):
+    day = datetime.datetime.strptime(vote_day(since), '%Y-%m-%d').date()
+    # A day past today covers hosts whose clocks run ahead
+    last_day = datetime.datetime.now(datetime.timezone.utc).date() + datetime.timedelta(days=1)
+    votes = []
+    while day <= last_day:
+        kwargs = {'IndexName': REQUESTS_TIME_INDEX, 'ProjectionExpression': projection, 'ExpressionAttributeNames': names,
+                  'KeyConditionExpression': Key('VoteDay').eq(day.isoformat()) & Key('Timestamp').gte(since)}
+        while True:
+            response = requests_table.query(**kwargs)
+            votes.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        day += datetime.timedelta(days=1)
+    return votes
+
+# Function to add the time index to the Requests table (on-demand billing).
+# DynamoDB backfills it from items that have a VoteDay.
+def create_time_index():
+    dynamodb.meta.client.update_table(
+        TableName=requests_table.name,
+        AttributeDefinitions=[{'AttributeName': 'VoteDay', 'AttributeType': 'S'},
+                              {'AttributeName': 'Timestamp', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexUpdates=[{'Create': {
+            'IndexName': REQUESTS_TIME_INDEX,
+            'KeySchema': [{'AttributeName': 'VoteDay', 'KeyType': 'HASH'},
+                          {'AttributeName': 'Timestamp', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['ModelA', 'ModelB', 'Vote']},
+        }}])
+
+# Function to write recomputed ratings back. Version is bumped so in-flight
+# online updates notice the change and recompute from the new values.
+def write_ratings(ratings):
+    for model, fields in ratings.items():
+        leaderboards_table.update_item(
+            Key={'ModelID': model},
+            UpdateExpression="SET EloScore = :elo, CI_Lower = :ci_lower, CI_Upper = :ci_upper, "
+                             "Votes = if_not_exists(Votes, :zero), #Version = if_not_exists(#Version, :zero) + :one",
+            ExpressionAttributeNames={'#Version': 'Version'},
+            ExpressionAttributeValues={':elo': fields['EloScore'], ':ci_lower': fields['CI_Lower'],
+                                       ':ci_upper': fields['CI_Upper'], ':zero': 0, ':one': 1}
+        )
+
+
+# Storage backend on the DynamoDB tables above
+class DynamoDBStorage(Storage):
+    def write_requests(self, items):
+        write_requests(items)
+
+    def write_request(self, user_id, paper_id, model_a, model_b, vote):
+        return write_request(user_id, paper_id, model_a, model_b, vote)
+
+    def update_leaderboard(self, model_a, model_b, vote):
+        return update_leaderboard(model_a, model_b, vote)
+
+    def record_vote(self, item):
+        return update_leaderboard(item['ModelA'], item['ModelB'], item['Vote'], request_item=item)
+
+    def get_leaderboard(self):
+        return get_leaderboard()
+
+    def load_votes(self, since=None):
+        return load_votes(since)
+
+    def write_ratings(self, ratings):
+        write_ratings(ratings)
+
+    def is_transient(self, error):
+        if isinstance(error, (BotoConnectionError, HTTPClientError)):
+            return True
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code')
+            reasons = {reason.get('Code') for reason in error.response.get('CancellationReasons', [])}
+            return code in TRANSIENT_ERROR_CODES or bool(reasons & TRANSIENT_CANCELLATION_REASONS)
+        return super().is_transient(error)
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+try:
+    load_dotenv()
+except:
+    pass
+
+import pdf_utils
+import providers
+import scheduler
+from models import Paper, PaperProcessor
+from cache_utils import review_cache, review_cache_key, prompt_set_version
+from logging_config import setup_logging
+from token_utils import prompt_char_limit
+from utils import MODELS, moderate_paper, with_review_deadline
+
+# Offline review of a whole corpus of papers by a list of models, e.g. a
+# conference batch ahead of time. Text is extracted in a process pool while
+# reviews run concurrently on the provider loop, at most --concurrency
+# (paper, model) reviews at a time; per-provider call limits still come from
+# the scheduler. Each finished review is appended to the JSONL output right
+# away, so a rerun with the same output resumes where the last one stopped:
+#   python batch_review.py papers/ --output reviews.jsonl --concurrency 16
+#   python batch_review.py manifest.txt --models gpt-4o command-r-plus --output reviews.jsonl
+# Reviews are also put in the review cache, so the arena serves them instantly.
+PROMPT_DIR = 'iclr2024'
+API_KEYS = {
+    'openai_api_key': os.environ.get('OPENAI_API_KEY'),
+    'claude_api_key': os.environ.get('ANTHROPIC_API_KEY'),
+    'gemini_api_key': os.environ.get('GEMINI_API_KEY'),
+    'commandr_api_key': os.environ.get('COMMANDR_API_KEY')
+}
+
+
+# Function to list the PDFs named by the inputs: PDF files, directories
+# (searched recursively) and manifests with one path per line, relative to
+# the manifest
+def find_papers(inputs):
+    papers = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                papers.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.pdf'))
+        elif path.lower().endswith('.pdf'):
+            papers.append(path)
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                papers.extend(os.path.join(os.path.dirname(path), line.strip()) for line in f if line.strip())
+    # The same file named twice is only reviewed once
+    return list(dict.fromkeys(os.path.normpath(paper) for paper in papers))
+
+# Function to get the (paper digest, model) pairs already in the output for this prompt set
+def load_finished(output_path, prompt_version):
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A run killed mid-write leaves a partial last line
+                continue
+            if record.get('status') == 'ok' and record.get('prompt_version') == prompt_version:
+                finished.add((record['paper_digest'], record['model']))
+    return finished
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha512(f.read()).hexdigest()
+
+# Function to extract a paper's text; runs in pool workers
+def extract_paper(path, max_chars, digest):
+    with open(path, 'rb') as f:
+        return pdf_utils.extract_text(f.read(), max_chars, digest, path)
+
+def init_worker():
+    # Workers are the pool already; they must not start pools of their own
+    pdf_utils.POOL_WORKERS = 1
+
+
+class BatchReview:
+    def __init__(self, models, output_path, prompt_dir=PROMPT_DIR, concurrency=8, workers=None):
+        self.models = models
+        self.output_path = output_path
+        self.prompt_dir = prompt_dir
+        self.prompt_version = prompt_set_version(prompt_dir)
+        self.max_chars = max(prompt_char_limit(model) for model in models)
+        self.concurrency = concurrency
+        self.workers = workers or os.cpu_count() or 1
+        self.finished = load_finished(output_path, self.prompt_version)
+        self.counts = {'ok': 0, 'failed': 0, 'cached': 0, 'skipped': 0}
+        self._output_lock = threading.Lock()
+
+    # Function to append one review to the output; it is durable once this
+    # returns. Runs in worker threads, so the provider loop never waits on fsync.
+    def write(self, record):
+        with self._output_lock:
+            self.output.write(json.dumps(record) + '\n')
+            self.output.flush()
+            os.fsync(self.output.fileno())
+
+    async def review_paper(self, path, pool, paper_slots, review_slots):
+        loop = asyncio.get_running_loop()
+        async with paper_slots:
+            try:
+                digest = await loop.run_in_executor(None, file_digest, path)
+            except OSError as e:
+                logging.error(f"Cannot read {path}: {e}")
+                self.counts['failed'] += len(self.models)
+                return
+            models = [model for model in self.models if (digest, model) not in self.finished]
+            self.counts['skipped'] += len(self.models) - len(models)
+            # The caches and the output do file I/O, so they are used off the provider loop
+            cached = {model: await asyncio.to_thread(review_cache.get, review_cache_key(digest, model, self.prompt_version))
+                      for model in models}
+            for model in models:
+                if cached[model] is not None:
+                    await self.record(path, digest, model, 'ok', review=cached[model], seconds=0)
+                    self.counts['cached'] += 1
+            models = [model for model in models if cached[model] is None]
+            if not models:
+                return
+
+            try:
+                text = await loop.run_in_executor(pool, extract_paper, path, self.max_chars, digest)
+            except Exception as e:
+                logging.error(f"Text extraction failed for {path}: {e!r}")
+                for model in models:
+                    await self.record(path, digest, model, 'failed', error=repr(e))
+                return
+            paper = Paper(os.path.basename(path), text)
+            scheduler.set_user(digest)
+            if await moderate_paper(text, digest):
+                for model in models:
+                    await asyncio.to_thread(review_cache.put, review_cache_key(digest, model, self.prompt_version),
+                                            PaperProcessor.DESK_REJECTION)
+                    await self.record(path, digest, model, 'ok', review=PaperProcessor.DESK_REJECTION, seconds=0)
+                return
+            await asyncio.gather(*[self.review_with_model(path, digest, paper, model, review_slots) for model in models])
+
+    async def review_with_model(self, path, digest, paper, model, review_slots):
+        async with review_slots:
+            started = time.monotonic()
+            try:
+                processor = PaperProcessor(self.prompt_dir, model, **API_KEYS)
+                result = await with_review_deadline(processor.process_paper_async(paper))
+            except Exception as e:
+                logging.error(f"Review of {path} by {model} failed: {e!r}")
+                await self.record(path, digest, model, 'failed', error=repr(e), seconds=time.monotonic() - started)
+                return
+        # Reviews with failed sections are recorded but redone on the next run
+        failed_sections = sum(section.endswith(' N/A') for section in result)
+        status = 'failed' if failed_sections else 'ok'
+        if status == 'ok':
+            await asyncio.to_thread(review_cache.put, review_cache_key(digest, model, self.prompt_version), result)
+        await self.record(path, digest, model, status, review=result, seconds=time.monotonic() - started,
+                    error=f"{failed_sections} sections failed" if failed_sections else None)
+
+    async def record(self, path, digest, model, status, review=None, error=None, seconds=None):
+        await asyncio.to_thread(self.write, {'paper': path, 'paper_digest': digest, 'model': model, 'prompt_version': self.prompt_version,
+                    'status': status, 'review': review, 'error': error, 'seconds': seconds})
+        if status == 'ok':
+            self.finished.add((digest, model))
+            self.counts['ok'] += 1
+        else:
+            self.counts['failed'] += 1
+        print(f"{status:<6} {model:<24} {path}", flush=True)
+
+    async def run_async(self, papers, pool):
+        # Papers in flight bound memory; a few more than reviews keeps extraction ahead of the models
+        paper_slots = asyncio.Semaphore(self.concurrency + self.workers)
+        review_slots = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self.review_paper(path, pool, paper_slots, review_slots) for path in papers])
+
+    # Extraction workers are spawned rather than forked from a process that runs the provider loop thread
+    def run(self, papers):
+        os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+        with open(self.output_path, 'a', encoding='utf-8') as self.output, \
+                ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                    mp_context=multiprocessing.get_context('spawn')) as pool:
+            providers.run(self.run_async(papers, pool))
+        return self.counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Review a corpus of papers offline, resuming from the output file.")
+    parser.add_argument('inputs', nargs='+', help="PDF files, directories of PDFs or manifests listing PDF paths")
+    parser.add_argument('--output', required=True, help="JSONL file reviews are appended to; also the checkpoint")
+    parser.add_argument('--models', nargs='+', default=MODELS, help="models every paper is reviewed by")
+    parser.add_argument('--prompt-dir', default=PROMPT_DIR)
+    parser.add_argument('--concurrency', type=int, default=8, help="(paper, model) reviews in flight")
+    parser.add_argument('--workers', type=int, default=None, help="text extraction processes")
+    args = parser.parse_args()
+
+    setup_logging()
+    papers = find_papers(args.inputs)
+    batch = BatchReview(args.models, args.output, args.prompt_dir, args.concurrency, args.workers)
+    print(f"{len(papers)} papers x {len(args.models)} models, {len(batch.finished)} reviews already in {args.output}")
+    started = time.time()
+    counts = batch.run(papers)
+    elapsed = time.time() - started
+    reviewed = counts['ok'] - counts['cached']
+    print(f"ok={counts['ok']} (cached {counts['cached']}) failed={counts['failed']} skipped={counts['skipped']} "
+          f"elapsed={elapsed:.0f}s reviews/day={reviewed / max(elapsed, 1e-9) * 86400:.0f}")
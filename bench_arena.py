@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# End-to-end load benchmark of the arena without real API calls. N simulated
+# users each upload a paper, stream both reviews (2 x 11 questions), vote and
+# refresh the leaderboard, while every model is served by a simulated provider
+# with configurable latency, error rate and token throughput. Storage, the
+# vote log and the review cache default to a scratch directory and SQLite:
+#   python bench_arena.py paper.pdf --users 8 --sessions 5
+#   python bench_arena.py paper.pdf --replay responses.jsonl --error-rate 0.02
+# Recording real responses for later replay does call the real providers:
+#   python bench_arena.py paper.pdf --users 1 --sessions 1 --record responses.jsonl
+SCRATCH_DIR = tempfile.mkdtemp(prefix='bench_arena_')
+os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+os.environ.setdefault('SQLITE_PATH', os.path.join(SCRATCH_DIR, 'arena.db'))
+os.environ.setdefault('VOTE_LOG_PATH', os.path.join(SCRATCH_DIR, 'vote_log', 'votes.jsonl'))
+os.environ.setdefault('REVIEW_CACHE_DIR', os.path.join(SCRATCH_DIR, 'review_cache'))
+os.environ.setdefault('UPLOAD_STORE_DIR', os.path.join(SCRATCH_DIR, 'upload_store'))
+os.environ.setdefault('MODERATION_CACHE_DIR', os.path.join(SCRATCH_DIR, 'moderation_cache'))
+os.environ.setdefault('VOTE_FLUSH_SECONDS', '0.1')
+
+import app
+import providers
+from storage import get_storage
+
+VOTE_OPTIONS = ["👍 A is better", "👍 B is better", "👔 Tie", "👎 Both are bad"]
+FILLER_WORDS = "the method results paper model proposed evaluation baseline experiments clearly".split()
+
+
+# Simulated errors look like a provider overload, so they are retried like real ones
+class FakeProviderError(Exception):
+    status_code = 503
+
+
+# Provider that answers after a simulated delay instead of calling an API. The
+# time to first token is lognormal with the given median and p95, and text then
+# arrives at tokens_per_second. Responses come from a replay file when one is
+# given, otherwise they are filler text of response_tokens words.
+class FakeProvider(providers.Provider):
+    def __init__(self, latency_median=2.0, latency_p95=6.0, error_rate=0.0, tokens_per_second=50,
+                 response_tokens=150, replay=None, seed=None):
+        super().__init__(api_key='')
+        self.mu = math.log(latency_median)
+        self.sigma = max(math.log(latency_p95 / latency_median), 0) / 1.645
+        self.error_rate = error_rate
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.replay = replay or {}
+        self.rng = random.Random(seed)
+        self.calls = []
+        self.errors = 0
+
+    def create_client(self):
+        return None
+
+    # Function to pick the reply: an exact (model, prompt) recording, else the
+    # next recording for the model, else filler text
+    def response(self, model, system_role, prompt):
+        recorded = self.replay.get((model, prompt_digest(system_role, prompt)))
+        if recorded is not None:
+            return recorded
+        responses = self.replay.get(model)
+        if responses:
+            return responses[self.rng.randrange(len(responses))]
+        return ' '.join(self.rng.choice(FILLER_WORDS) for _ in range(self.response_tokens))
+
+    async def first_token(self):
+        await asyncio.sleep(self.rng.lognormvariate(self.mu, self.sigma))
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise FakeProviderError("simulated provider error")
+
+    async def complete(self, model, system_role, prompt):
+        started = time.perf_counter()
+        await self.first_token()
+        text = self.response(model, system_role, prompt)
+        await asyncio.sleep(len(text.split()) / self.tokens_per_second)
+        self.calls.append(time.perf_counter() - started)
+        return text
+
+    async def stream(self, model, system_role, prompt):
+        started = time.perf_counter()
+        await self.first_token()
+        words = self.response(model, system_role, prompt).split(' ')
+        for i in range(0, len(words), 8):
+            await asyncio.sleep(len(words[i:i + 8]) / self.tokens_per_second)
+            yield ' '.join(words[i:i + 8]) + (' ' if i + 8 < len(words) else '')
+        self.calls.append(time.perf_counter() - started)
+
+    async def moderate(self, content):
+        await asyncio.sleep(0.05)
+        return False
+
+
+# Provider wrapper that appends every real response to a JSONL file for replay
+class RecordingProvider(providers.Provider):
+    def __init__(self, provider, path):
+        super().__init__(api_key='')
+        self.provider = provider
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, model, system_role, prompt, text):
+        line = json.dumps({'model': model, 'prompt_sha256': prompt_digest(system_role, prompt), 'response': text})
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    async def complete(self, model, system_role, prompt):
+        text = await self.provider.complete(model, system_role, prompt)
+        self.record(model, system_role, prompt, text)
+        return text
+
+    async def stream(self, model, system_role, prompt):
+        chunks = []
+        async for chunk in self.provider.stream(model, system_role, prompt):
+            chunks.append(chunk)
+            yield chunk
+        self.record(model, system_role, prompt, ''.join(chunks))
+
+    async def moderate(self, content):
+        return await self.provider.moderate(content)
+
+def prompt_digest(system_role, prompt):
+    return hashlib.sha256(f"{system_role}\n{prompt}".encode('utf-8')).hexdigest()
+
+# Function to load recorded responses, indexed by (model, prompt digest) and by model
+def load_replay(path):
+    replay = defaultdict(list)
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            replay[(record['model'], record['prompt_sha256'])] = record['response']
+            replay[record['model']].append(record['response'])
+    return dict(replay)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# Function to run one simulated user through its sessions; returns stage latencies and outcome counts
+def simulate_user(user, pdf_path, sessions, distinct):
+    stages = defaultdict(list)
+    outcomes = defaultdict(int)
+    for session in range(sessions):
+        path = pdf_path
+        if distinct:
+            # Bytes after %%EOF are ignored by PDF readers but change the digest,
+            # so every upload misses the review and text caches
+            path = os.path.join(SCRATCH_DIR, f"paper-{user}-{session}.pdf")
+            shutil.copyfile(pdf_path, path)
+            with open(path, 'ab') as f:
+                f.write(f"\n% bench {user} {session}\n".encode('ascii'))
+
+        started = time.perf_counter()
+        first_section = None
+        for review_a, review_b, vote_controls, _, model_a, model_b, paper_digest in app.review_papers(path):
+            if first_section is None and '<strong>' in review_a + review_b:
+                first_section = time.perf_counter() - started
+        stages['review'].append(time.perf_counter() - started)
+        if first_section is not None:
+            stages['first_section'].append(first_section)
+        for review in (review_a, review_b):
+            outcomes['reviews'] += 1
+            if '<strong>' not in review:
+                outcomes['failed_reviews'] += 1
+            outcomes['failed_sections'] += review.count('<span>N/A</span>')
+
+        # Like a user, the benchmark can only vote when the page offers it
+        if not vote_controls['visible']:
+            outcomes['unvotable'] += 1
+            continue
+        started = time.perf_counter()
+        app.handle_vote(random.choice(VOTE_OPTIONS), model_a, model_b, paper_digest)
+        stages['vote'].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        app.leaderboard.get()
+        stages['leaderboard'].append(time.perf_counter() - started)
+    return stages, outcomes
+
+# Function to wait until the vote log is flushed, which applies the leaderboard updates too
+def drain_votes(timeout=60):
+    return app.vote_queue.wait_flushed(timeout)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark with simulated LLM providers.")
+    parser.add_argument('pdf', help="paper to upload")
+    parser.add_argument('--users', type=int, default=4, help="concurrent simulated users")
+    parser.add_argument('--sessions', type=int, default=3, help="upload/review/vote rounds per user")
+    parser.add_argument('--latency-median', type=float, default=2.0, help="seconds to first token, median")
+    parser.add_argument('--latency-p95', type=float, default=6.0, help="seconds to first token, p95")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls that fail")
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--response-tokens', type=int, default=150, help="length of filler responses")
+    parser.add_argument('--profile', help="JSON file of per-model overrides of the options above")
+    parser.add_argument('--replay', help="JSONL file of recorded responses")
+    parser.add_argument('--record', help="call the real providers and append their responses to this JSONL file")
+    parser.add_argument('--cache-hits', action='store_true', help="upload identical bytes so repeat sessions hit the caches")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    fakes = {}
+    if args.record:
+        for model in providers.MODEL_PROVIDERS:
+            providers.override_provider(model, RecordingProvider(providers.get_provider(model), args.record))
+    else:
+        replay = load_replay(args.replay) if args.replay else None
+        profile = {}
+        if args.profile:
+            with open(args.profile, 'r', encoding='utf-8') as f:
+                profile = json.load(f)
+        defaults = {'latency_median': args.latency_median, 'latency_p95': args.latency_p95, 'error_rate': args.error_rate,
+                    'tokens_per_second': args.tokens_per_second, 'response_tokens': args.response_tokens}
+        for model in providers.MODEL_PROVIDERS:
+            fakes[model] = FakeProvider(**{**defaults, **profile.get(model, {})}, replay=replay, seed=random.random())
+            # Share the real provider's rate limits, so admission control is part of the measurement
+            fakes[model].name = providers.MODEL_PROVIDERS[model].name
+            providers.override_provider(model, fakes[model])
+
+    app.leaderboard.start()
+    app.vote_queue.start()
+
+    stages = defaultdict(list)
+    outcomes = defaultdict(int)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        futures = [executor.submit(simulate_user, user, args.pdf, args.sessions, not args.cache_hits)
+                   for user in range(args.users)]
+        for future in futures:
+            user_stages, user_outcomes = future.result()
+            for stage, latencies in user_stages.items():
+                stages[stage].extend(latencies)
+            for outcome, count in user_outcomes.items():
+                outcomes[outcome] += count
+    elapsed = time.perf_counter() - started
+    drain_started = time.perf_counter()
+    if not drain_votes():
+        print("warning: votes were still pending after 60s")
+    stages['vote_drain'].append(time.perf_counter() - drain_started)
+
+    for fake in fakes.values():
+        stages['model_call'].extend(fake.calls)
+    print(f"users={args.users} sessions={args.users * args.sessions} elapsed={elapsed:.1f}s storage={os.environ['STORAGE_BACKEND']}")
+    for stage in ('first_section', 'review', 'model_call', 'vote', 'leaderboard', 'vote_drain'):
+        latencies = stages[stage]
+        if latencies:
+            print(f"{stage:<14} n={len(latencies):<5} p50={percentile(latencies, 0.5) * 1000:9.1f}ms "
+                  f"p95={percentile(latencies, 0.95) * 1000:9.1f}ms p99={percentile(latencies, 0.99) * 1000:9.1f}ms")
+    completed = outcomes['reviews'] - outcomes['failed_reviews']
+    print(f"reviews/min={completed / elapsed * 60:.1f} failed_reviews={outcomes['failed_reviews']}/{outcomes['reviews']} "
+          f"failed_sections={outcomes['failed_sections']} provider_errors={sum(fake.errors for fake in fakes.values())}")
+    applied = sum(int(row['Votes']) for row in get_storage().get_leaderboard()) // 2
+    print(f"votes stored={len(get_storage().load_votes())} applied={applied} of "
+          f"{args.users * args.sessions - outcomes['unvotable']} ({outcomes['unvotable']} pairs could not be voted on)")
+    shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
@@ -0,0 +1,95 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+# Per-vote latency of the leaderboard update path, before (sequential
+# get/put/update calls) and after (one read plus one conditional transaction).
+# Runs against DynamoDB Local or another non-production endpoint only:
+#   DYNAMODB_ENDPOINT_URL=http://localhost:8000 python bench_vote_latency.py
+# or against a scratch SQLite database, where only the current path is measured:
+#   STORAGE_BACKEND=sqlite SQLITE_PATH=/tmp/bench.db python bench_vote_latency.py
+from storage import STORAGE_BACKEND, get_storage
+
+if STORAGE_BACKEND == 'dynamodb':
+    if not os.environ.get('DYNAMODB_ENDPOINT_URL'):
+        sys.exit("Set DYNAMODB_ENDPOINT_URL to a non-production DynamoDB endpoint (e.g. DynamoDB Local), or use STORAGE_BACKEND=sqlite.")
+    import aws_utils
+    from aws_utils import leaderboards_table, calculate_elo, calculate_95_ci, VOTE_MAPPING
+
+# The previous update path, kept here as the baseline
+def update_leaderboard_sequential(model_a, model_b, vote):
+    vote = VOTE_MAPPING.get(vote, "Tie")
+    model_a_stats = leaderboards_table.get_item(Key={'ModelID': model_a}).get('Item', {})
+    model_b_stats = leaderboards_table.get_item(Key={'ModelID': model_b}).get('Item', {})
+    if not model_a_stats:
+        model_a_stats = {'ModelID': model_a, 'Wins': 0, 'Losses': 0, 'Ties': 0, 'EloScore': Decimal(1200), 'Votes': 0}
+        leaderboards_table.put_item(Item=model_a_stats)
+    if not model_b_stats:
+        model_b_stats = {'ModelID': model_b, 'Wins': 0, 'Losses': 0, 'Ties': 0, 'EloScore': Decimal(1200), 'Votes': 0}
+        leaderboards_table.put_item(Item=model_b_stats)
+    counter_a, counter_b = aws_utils.VOTE_COUNTERS[vote]
+    leaderboards_table.update_item(Key={'ModelID': model_a}, UpdateExpression=f"SET {counter_a} = {counter_a} + :inc, Votes = Votes + :inc",
+                                   ExpressionAttributeValues={':inc': 1})
+    leaderboards_table.update_item(Key={'ModelID': model_b}, UpdateExpression=f"SET {counter_b} = {counter_b} + :inc, Votes = Votes + :inc",
+                                   ExpressionAttributeValues={':inc': 1})
+    new_elo_a, new_elo_b = calculate_elo(model_a_stats['EloScore'], model_b_stats['EloScore'], vote)
+    ci_a_lower, ci_a_upper = calculate_95_ci(new_elo_a, model_a_stats['Votes'] + 1)
+    ci_b_lower, ci_b_upper = calculate_95_ci(new_elo_b, model_b_stats['Votes'] + 1)
+    leaderboards_table.update_item(Key={'ModelID': model_a}, UpdateExpression="SET EloScore = :new_elo, CI_Lower = :ci_lower, CI_Upper = :ci_upper",
+                                   ExpressionAttributeValues={':new_elo': Decimal(new_elo_a), ':ci_lower': Decimal(ci_a_lower), ':ci_upper': Decimal(ci_a_upper)})
+    leaderboards_table.update_item(Key={'ModelID': model_b}, UpdateExpression="SET EloScore = :new_elo, CI_Lower = :ci_lower, CI_Upper = :ci_upper",
+                                   ExpressionAttributeValues={':new_elo': Decimal(new_elo_b), ':ci_lower': Decimal(ci_b_lower), ':ci_upper': Decimal(ci_b_upper)})
+
+def ensure_table():
+    try:
+        leaderboards_table.load()
+    except aws_utils.ClientError:
+        aws_utils.dynamodb.create_table(TableName=leaderboards_table.name,
+                                        KeySchema=[{'AttributeName': 'ModelID', 'KeyType': 'HASH'}],
+                                        AttributeDefinitions=[{'AttributeName': 'ModelID', 'AttributeType': 'S'}],
+                                        BillingMode='PAY_PER_REQUEST')
+        leaderboards_table.wait_until_exists()
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def run(name, update, votes, concurrency):
+    model_a, model_b = f"bench-{uuid.uuid4().hex[:8]}-a", f"bench-{uuid.uuid4().hex[:8]}-b"
+    latencies = []
+
+    def vote(i):
+        start = time.perf_counter()
+        update(model_a, model_b, ["👍 A is better", "👍 B is better", "👔 Tie"][i % 3])
+        latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(vote, range(votes)))
+    elapsed = time.perf_counter() - started
+
+    rows = {row['ModelID']: row for row in get_storage().get_leaderboard()}
+    recorded = int(rows[model_a]['Votes'])
+    print(f"{name:<12} concurrency={concurrency:<3} mean={statistics.mean(latencies) * 1000:7.1f}ms "
+          f"p50={percentile(latencies, 0.5) * 1000:7.1f}ms p95={percentile(latencies, 0.95) * 1000:7.1f}ms "
+          f"p99={percentile(latencies, 0.99) * 1000:7.1f}ms votes/s={votes / elapsed:6.1f} "
+          f"recorded={recorded}/{votes}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-vote leaderboard update latency.")
+    parser.add_argument('--votes', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    args = parser.parse_args()
+
+    storage = get_storage()
+    if STORAGE_BACKEND == 'dynamodb':
+        ensure_table()
+    for concurrency in args.concurrency:
+        if STORAGE_BACKEND == 'dynamodb':
+            run('before', update_leaderboard_sequential, args.votes, concurrency)
+        run('after', storage.update_leaderboard, args.votes, concurrency)
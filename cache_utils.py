@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Cache settings, overridable from the environment
+CACHE_DIR = os.environ.get('REVIEW_CACHE_DIR', 'review_cache')
+CACHE_MAX_ENTRIES = int(os.environ.get('REVIEW_CACHE_MAX_ENTRIES', 256))
+CACHE_MAX_BYTES = int(os.environ.get('REVIEW_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+CACHE_TTL = float(os.environ['REVIEW_CACHE_TTL']) if os.environ.get('REVIEW_CACHE_TTL') else None
+# Eviction frees space down to this share of the cap, so it runs once per
+# tenth of the cap written rather than on every write once the cache is full
+EVICT_TO = 0.9
+# Moderation verdicts are tiny, so their cache only needs its own directory
+MODERATION_CACHE_DIR = os.environ.get('MODERATION_CACHE_DIR', 'moderation_cache')
+
+# Function to hash the prompt set so edited prompts never serve stale reviews
+def prompt_set_version(prompt_dir):
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(prompt_dir)):
+        if not name.endswith(('.txt', '.json')):
+            continue
+        digest.update(name.encode('utf-8'))
+        with open(os.path.join(prompt_dir, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+# Function to build the cache key for one model's review of one paper
+def review_cache_key(paper_digest, model, prompt_version):
+    return hashlib.sha256(f"{paper_digest}:{model}:{prompt_version}".encode('utf-8')).hexdigest()
+
+
+# Two-tier review cache: an in-memory LRU in front of a size-capped directory
+# of JSON files. Entries older than the TTL (if set) are treated as misses.
+# The directory's size is counted once and then tracked as files are written
+# and removed, so only a write that goes over max_bytes walks the directory.
+class ReviewCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remember(self, key, created, value):
+        with self._lock:
+            self._memory[key] = (created, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.error(f"Unreadable review cache entry {path}: {e}")
+            return None
+
+        if self._expired(entry['created']):
+            self._remove(path)
+            return None
+        # Touch the file so disk eviction is least-recently-used
+        os.utime(path)
+        self._remember(key, entry['created'], entry['value'])
+        return entry['value']
+
+    def put(self, key, value):
+        created = time.time()
+        self._remember(key, created, value)
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A unique temp file, since worker processes and threads share the directory
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path),
+                                         prefix=f"{os.path.basename(path)}.", suffix='.tmp', delete=False) as f:
+            tmp_path = f.name
+            try:
+                json.dump({'created': created, 'value': value}, f)
+            except BaseException:
+                f.close()
+                os.remove(tmp_path)
+                raise
+            size = f.tell()
+        # Counted before the file lands, so the first put does not count it twice
+        self.total_bytes()
+        replaced = self._size(path)
+        os.replace(tmp_path, path)
+        if self.total_bytes(size - replaced) > self.max_bytes:
+            self.evict()
+
+    # Function to get the directory's size in bytes after adding delta; the
+    # first call counts it. Other processes sharing the directory are only
+    # seen at the next eviction, which recounts.
+    def total_bytes(self, delta=0):
+        with self._lock:
+            counted = self._total_bytes is not None
+        if not counted:
+            total = sum(size for _, size, _ in self._entries())
+            with self._lock:
+                if self._total_bytes is None:
+                    self._total_bytes = total
+        with self._lock:
+            self._total_bytes += delta
+            return self._total_bytes
+
+    def _size(self, path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._total_bytes = total
+
+    def _remove(self, path):
+        size = self._size(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes -= size
+
+
+review_cache = ReviewCache()
+moderation_cache = ReviewCache(MODERATION_CACHE_DIR, max_entries=4096, max_bytes=16 * 1024 * 1024)
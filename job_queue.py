@@ -0,0 +1,208 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Database file shared by the web tier and the review workers
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', 'jobs.db')
+# Seconds a worker holds a job without reporting progress before another may take it over
+LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 60))
+# Claims of one job before it is failed, so a paper that crashes workers cannot loop forever
+MAX_JOB_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+# Finished jobs older than this are deleted
+JOB_TTL = float(os.environ.get('JOB_TTL', 24 * 3600))
+# Recent finished jobs averaged for the queue time estimate
+RECENT_JOBS = 20
+# Model health reports older than this are ignored, as from a stopped worker
+HEALTH_MAX_AGE = float(os.environ.get('JOB_HEALTH_MAX_AGE', 600))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    JobID TEXT PRIMARY KEY,
+    PaperDigest TEXT NOT NULL,
+    Models TEXT NOT NULL,
+    UserID TEXT,
+    Status TEXT NOT NULL,
+    Worker TEXT,
+    LeaseUntil REAL,
+    Attempts INTEGER NOT NULL DEFAULT 0,
+    Reviews TEXT,
+    Error TEXT,
+    Created REAL NOT NULL,
+    Started REAL,
+    Updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (Status, Created);
+CREATE TABLE IF NOT EXISTS model_health (
+    Worker TEXT NOT NULL,
+    Model TEXT NOT NULL,
+    Latency REAL,
+    ErrorRate REAL,
+    Attempts INTEGER NOT NULL,
+    Updated REAL NOT NULL,
+    PRIMARY KEY (Worker, Model)
+);
+"""
+
+JSON_FIELDS = ('Models', 'Reviews')
+
+
+# Persistent queue of review jobs on a local SQLite database in WAL mode, so
+# the web processes and any number of worker processes on the host can share
+# it. The web tier enqueues a (paper digest, model pair) job and polls it by
+# id; a worker claims the oldest queued job with a lease, which it renews with
+# every progress write. A job whose worker died (its lease ran out) is queued
+# for the next worker, so a restart loses no jobs; reviews that had finished
+# before the crash are served from the review cache when it is redone.
+class JobQueue:
+    def __init__(self, path=JOB_DB_PATH, lease_seconds=LEASE_SECONDS, max_attempts=MAX_JOB_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Transactions are managed explicitly with BEGIN/COMMIT
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # Function to run fn(conn) in one write transaction
+    def transaction(self, fn):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    # Function to queue a review of a stored upload by the given models; returns the job id
+    def enqueue(self, paper_digest, models, user_id=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self.transaction(lambda conn: conn.execute(
+            'INSERT INTO jobs (JobID, PaperDigest, Models, UserID, Status, Created, Updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, paper_digest, json.dumps(list(models)), user_id, 'queued', now, now)))
+        return job_id
+
+    # Function to take the oldest job that is queued or whose lease ran out;
+    # returns the job as a dict, or None when there is nothing to do
+    def claim(self, worker):
+        def claim_job(conn):
+            now = time.time()
+            # Jobs that used up their attempts are failed rather than claimed again
+            conn.execute(
+                "UPDATE jobs SET Status = 'failed', Error = 'worker lost too many times', Updated = ? "
+                "WHERE Status = 'running' AND LeaseUntil < ? AND Attempts >= ?", (now, now, self.max_attempts))
+            row = conn.execute(
+                "SELECT JobID FROM jobs WHERE Status = 'queued' OR (Status = 'running' AND LeaseUntil < ?) "
+                "ORDER BY Created LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET Status = 'running', Worker = ?, LeaseUntil = ?, Attempts = Attempts + 1, "
+                "Started = ?, Updated = ? WHERE JobID = ?",
+                (worker, now + self.lease_seconds, now, now, row['JobID']))
+            return row['JobID']
+        job_id = self.transaction(claim_job)
+        return None if job_id is None else self.get(job_id)
+
+    # Function to save a running job's partial reviews and the models writing
+    # them, renewing the lease; False if the job is no longer this worker's
+    def progress(self, job_id, worker, reviews, models):
+        now = time.time()
+        cursor = self.transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET Reviews = ?, Models = ?, LeaseUntil = ?, Updated = ? "
+            "WHERE JobID = ? AND Worker = ? AND Status = 'running'",
+            (json.dumps(reviews), json.dumps(models), now + self.lease_seconds, now, job_id, worker)))
+        return cursor.rowcount > 0
+
+    def complete(self, job_id, worker, reviews, models):
+        return self.finish(job_id, worker, 'done', reviews=reviews, models=models)
+
+    def fail(self, job_id, worker, error):
+        return self.finish(job_id, worker, 'failed', error=error)
+
+    def finish(self, job_id, worker, status, reviews=None, models=None, error=None):
+        now = time.time()
+        cursor = self.transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET Status = ?, Reviews = COALESCE(?, Reviews), Models = COALESCE(?, Models), "
+            "Error = ?, LeaseUntil = NULL, Updated = ? WHERE JobID = ? AND Worker = ? AND Status = 'running'",
+            (status, None if reviews is None else json.dumps(reviews), None if models is None else json.dumps(models),
+             error, now, job_id, worker)))
+        return cursor.rowcount > 0
+
+    # Function to get a job as a dict, or None for an unknown id
+    def get(self, job_id):
+        row = self.connection().execute('SELECT * FROM jobs WHERE JobID = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for field in JSON_FIELDS:
+            job[field] = json.loads(job[field]) if job[field] else []
+        return job
+
+    # Function to get (jobs ahead, estimated seconds until it starts) for a
+    # queued job, or None once it is running
+    def queue_status(self, job_id):
+        conn = self.connection()
+        job = conn.execute('SELECT Status, Created FROM jobs WHERE JobID = ?', (job_id,)).fetchone()
+        if job is None or job['Status'] != 'queued':
+            return None
+        ahead = conn.execute("SELECT COUNT(*) FROM jobs WHERE Status = 'queued' AND Created < ?",
+                             (job['Created'],)).fetchone()[0]
+        running = conn.execute("SELECT COUNT(*) FROM jobs WHERE Status = 'running'").fetchone()[0]
+        durations = [row[0] for row in conn.execute(
+            "SELECT Updated - Started FROM jobs WHERE Status = 'done' AND Started IS NOT NULL "
+            "ORDER BY Updated DESC LIMIT ?", (RECENT_JOBS,))]
+        job_seconds = sum(durations) / len(durations) if durations else 60
+        # Jobs ahead are shared among at least as many workers as are busy now
+        return ahead, (ahead + 1) * job_seconds / max(running, 1)
+
+    # Function to delete finished jobs older than the TTL; returns how many
+    def purge(self, ttl=JOB_TTL):
+        def purge_rows(conn):
+            conn.execute('DELETE FROM model_health WHERE Updated < ?', (time.time() - HEALTH_MAX_AGE,))
+            return conn.execute(
+                "DELETE FROM jobs WHERE Status IN ('done', 'failed') AND Updated < ?", (time.time() - ttl,)).rowcount
+        return self.transaction(purge_rows)
+
+    # Function to save a worker process's providers.health_report(), so the
+    # web tier, which makes no provider calls in queue mode, can weigh models by it
+    def report_health(self, worker, report):
+        now = time.time()
+        self.transaction(lambda conn: conn.executemany(
+            'INSERT OR REPLACE INTO model_health (Worker, Model, Latency, ErrorRate, Attempts, Updated) VALUES (?, ?, ?, ?, ?, ?)',
+            [(worker, model, latency, error_rate, attempts, now) for model, (latency, error_rate, attempts) in report.items()]))
+
+    # Function to get each model's (latency, error rate) over the workers'
+    # recent reports, weighted by their attempts; either is None without samples
+    def model_health(self, max_age=HEALTH_MAX_AGE):
+        rows = self.connection().execute(
+            'SELECT Model, SUM(Latency * Attempts) / SUM(CASE WHEN Latency IS NULL THEN 0 ELSE Attempts END), '
+            'SUM(ErrorRate * Attempts) / SUM(Attempts) FROM model_health WHERE Updated >= ? GROUP BY Model',
+            (time.time() - max_age,))
+        return {model: (latency, error_rate) for model, latency, error_rate in rows}
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+# Function to get the job queue, opening the database on first use
+def get_job_queue():
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
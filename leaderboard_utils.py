@@ -0,0 +1,89 @@
+import hashlib
+import logging
+import os
+import threading
+from metrics_utils import span
+
+# Seconds between background refreshes of the materialized leaderboard
+REFRESH_INTERVAL = float(os.environ.get('LEADERBOARD_REFRESH_SECONDS', 60))
+
+
+# Process-level copy of the leaderboard and its rendered HTML. Reads are served
+# from memory; a background thread refreshes it from storage, and votes patch
+# the affected rows in place. Every change bumps the version and ETag.
+class MaterializedLeaderboard:
+    def __init__(self, fetch, render, refresh_interval=REFRESH_INTERVAL):
+        self.fetch = fetch
+        self.render = render
+        self.refresh_interval = refresh_interval
+        self.rows = None
+        self.html = None
+        self.version = 0
+        self.etag = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    # Function to get (html, version, etag), loading synchronously only on first use
+    def get(self):
+        if self.html is None:
+            self.refresh()
+        with self._lock:
+            return self.html, self.version, self.etag
+
+    # Function to get (html, version, etag) without ever touching storage; html
+    # is None until the first refresh has finished
+    def peek(self):
+        with self._lock:
+            return self.html, self.version, self.etag
+
+    def refresh(self):
+        try:
+            with span('leaderboard_refresh'):
+                rows = self.fetch()
+        except Exception as e:
+            logging.error(f"Leaderboard refresh failed: {e}")
+            return
+        with self._lock:
+            self._publish(rows)
+
+    # Function to apply items returned by update_leaderboard without a storage read
+    def apply(self, updated_items):
+        with self._lock:
+            if self.rows is None:
+                return
+            rows = {row['ModelID']: row for row in self.rows}
+            if any(item['ModelID'] not in rows for item in updated_items):
+                # New models need their metadata columns from storage
+                self._wake.set()
+                return
+            for item in updated_items:
+                rows[item['ModelID']] = {**rows[item['ModelID']], **item}
+            self._publish(list(rows.values()))
+
+    def invalidate(self):
+        self._wake.set()
+
+    def _publish(self, rows):
+        rows.sort(key=lambda x: x['EloScore'], reverse=True)
+        self.rows = rows
+        self.html = self.render(rows)
+        self.version += 1
+        self.etag = hashlib.sha1(self.html.encode('utf-8')).hexdigest()[:16]
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='leaderboard-refresh', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # The first load happens here rather than on the startup path, and is
+        # retried every few seconds until storage answers
+        if self.html is None:
+            self.refresh()
+        while True:
+            self._wake.wait(self.refresh_interval if self.html is not None else min(self.refresh_interval, 5))
+            self._wake.clear()
+            self.refresh()
@@ -1,9 +1,83 @@
+import atexit
+import hashlib
 import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Log settings, overridable from the environment
+LOG_FILE = os.environ.get('LOG_FILE', 'arena.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+# Records waiting for the writer thread; 0 writes synchronously instead
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Prompts and responses are logged at DEBUG for this fraction of calls, cut to LOG_PAYLOAD_CHARS
+LOG_PAYLOAD_CHARS = int(os.environ.get('LOG_PAYLOAD_CHARS', 2000))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 0.05))
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+# Queue handler that never blocks the caller: when the writer falls behind,
+# records are dropped and the number dropped is logged once there is room again
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.makeLogRecord({'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                             'msg': f"Log queue full, dropped {dropped} records"})
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                self.dropped += dropped
+
 
 def setup_logging():
-    logging.basicConfig(
-        filename="arena.log",
-        level=logging.INFO,  # Change to INFO level
-        format='%(asctime)s - %(levelname)s - %(message)s'
-    )
-    logging.info("Logging setup complete.")
\ No newline at end of file
+    root = logging.getLogger()
+    # Like basicConfig, leave an already configured root logger alone
+    if root.handlers:
+        return
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if LOG_QUEUE_SIZE > 0:
+        # Request threads only enqueue; a listener thread formats and writes
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        root.addHandler(DroppingQueueHandler(log_queue))
+        listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        root.addHandler(file_handler)
+    root.setLevel(LOG_LEVEL)
+    logging.info("Logging setup complete.")
+
+# Function to identify a payload without logging it: its hash, size and first characters
+def describe_payload(text, head=80):
+    text = str(text)
+    digest = hashlib.sha256(text.encode('utf-8', 'replace')).hexdigest()[:12]
+    description = f"sha256={digest} chars={len(text)}"
+    if head:
+        preview = text[:head].replace('\n', ' ')
+        description += f" head={preview!r}"
+    return description
+
+# Function to log a prompt or response at DEBUG for a sample of calls, cut to
+# LOG_PAYLOAD_CHARS. Nothing is formatted unless the record will be written.
+def log_payload(label, text, sample_rate=None):
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    if random.random() >= (LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate):
+        return
+    text = str(text)
+    suffix = f"... [{len(text) - LOG_PAYLOAD_CHARS} more characters]" if len(text) > LOG_PAYLOAD_CHARS else ''
+    logging.debug(f"{label} ({describe_payload(text, 0)}): {text[:LOG_PAYLOAD_CHARS]}{suffix}")
@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port of the Prometheus-style /metrics endpoint; metrics are off when unset
+METRICS_PORT = int(os.environ['METRICS_PORT']) if os.environ.get('METRICS_PORT') else None
+METRICS_HOST = os.environ.get('METRICS_HOST', '0.0.0.0')
+# File finished spans are appended to as JSON lines; trace export is off when unset
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH')
+# With neither configured, span() returns a shared no-op and records nothing
+ENABLED = METRICS_PORT is not None or bool(TRACE_EXPORT_PATH)
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Span attributes that become metric labels; the rest only go to the trace
+LABEL_ATTRIBUTES = ('model', 'provider')
+
+_current_span = ContextVar('current_span', default=None)
+_trace_id = ContextVar('trace_id', default=None)
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_export_file = None
+
+
+# Timed section of the pipeline. Entering it makes it the parent of spans
+# started in the same context (including asyncio tasks created inside it); on
+# exit its duration feeds the arena_stage_seconds histogram and, if enabled,
+# the span is written to the trace export.
+class Span:
+    recording = True
+
+    def __init__(self, name, attributes, trace_id=None):
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = trace_id
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        if self.parent is not None:
+            self.trace_id = self.parent.trace_id
+        self.trace_id = self.trace_id or _trace_id.get() or os.urandom(8).hex()
+        self.span_id = os.urandom(8).hex()
+        self._token = _current_span.set(self)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attributes.setdefault('error', exc_type.__name__)
+        finish_span(self, duration)
+        return False
+
+
+class NoopSpan:
+    recording = False
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_noop_span = NoopSpan()
+
+# Function to time a stage: with span('extract', model=...) as s: ...; s.set(tokens=...)
+def span(name, trace_id=None, **attributes):
+    if not ENABLED:
+        return _noop_span
+    return Span(name, attributes, trace_id)
+
+# Function to make spans started later in this context (thread or asyncio task)
+# part of the given trace, e.g. one trace per uploaded paper
+def set_trace(trace_id):
+    if ENABLED:
+        _trace_id.set(trace_id)
+
+def finish_span(span, duration):
+    labels = (('stage', span.name),) + tuple(
+        (key, str(span.attributes[key])) for key in LABEL_ATTRIBUTES if key in span.attributes)
+    observe('arena_stage_seconds', duration, labels)
+    if 'error' in span.attributes:
+        increment('arena_stage_errors_total', labels)
+    for direction in ('input', 'output'):
+        if f"{direction}_tokens" in span.attributes:
+            increment('arena_tokens_total', labels + (('direction', direction),), span.attributes[f"{direction}_tokens"])
+    if TRACE_EXPORT_PATH:
+        export_span(span, duration)
+
+def observe(name, value, labels=()):
+    with _lock:
+        histogram = _histograms.setdefault((name, labels), [[0] * len(BUCKETS), 0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+def increment(name, labels=(), value=1):
+    with _lock:
+        _counters[(name, labels)] = _counters.get((name, labels), 0) + value
+
+def export_span(span, duration):
+    global _export_file
+    record = {'trace_id': span.trace_id, 'span_id': span.span_id,
+              'parent_id': span.parent.span_id if span.parent is not None else None,
+              'name': span.name, 'start': span.start_time, 'duration': duration, 'attributes': span.attributes}
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        if _export_file is None:
+            os.makedirs(os.path.dirname(TRACE_EXPORT_PATH) or '.', exist_ok=True)
+            _export_file = open(TRACE_EXPORT_PATH, 'a', encoding='utf-8')
+        _export_file.write(line)
+        _export_file.flush()
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+# Function to render all metrics in the Prometheus text exposition format
+def render_metrics():
+    with _lock:
+        histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+
+# Function to serve /metrics from a daemon thread, if METRICS_PORT is set
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    global _server
+    with _lock:
+        if port is None or _server is not None:
+            return _server
+        _server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f"Serving metrics on {host}:{port}/metrics")
+    return _server
@@ -1,14 +1,15 @@
 import os
+import asyncio
 import logging
-import openai
-import tiktoken
 import re
-import anthropic
-import cohere
-import google.generativeai as genai
+import json
 import time
+import providers
 from file_utils import read_file
-from openai import OpenAI
+from metrics_utils import span, increment
+from logging_config import describe_payload, log_payload
+from token_utils import TokenBudget
+from paper_compression import COMPRESS_PAPERS, compress_paper, paper_token_budget
 
 class Paper:
     def __init__(self, arxiv_id, tex_file):
@@ -16,107 +17,97 @@ class Paper:
         self.tex_file = tex_file
 
 class PaperProcessor:
-    MAX_TOKENS = 127192
-    encoding = tiktoken.encoding_for_model("gpt-4")
+    # Review given instead of answers when moderation flags the paper
+    DESK_REJECTION = ["Desk Rejected", "The paper contains inappropriate or harmful content."]
+    HEADER = ['Summary:', 'Soundness:', 'Presentation:', 'Contribution:', 'Strengths:', 'Weaknesses:', 'Questions:', 'Flag For Ethics Review:', 'Rating:', 'Confidence:', 'Code Of Conduct:']
+    # JSON field, minimum and maximum (None for free text) of each question in structured mode
+    REVIEW_FIELDS = [
+        ('summary', None, None),
+        ('soundness', 1, 4),
+        ('presentation', 1, 4),
+        ('contribution', 1, 4),
+        ('strengths', None, None),
+        ('weaknesses', None, None),
+        ('questions', None, None),
+        ('flag_for_ethics_review', None, None),
+        ('rating', 1, 10),
+        ('confidence', 1, 5),
+        ('code_of_conduct', None, None),
+    ]
+    STRUCTURED_REVIEW = os.environ.get('STRUCTURED_REVIEW', '').lower() in ('1', 'true', 'yes')
 
-    def __init__(self, prompt_dir, model, openai_api_key, claude_api_key, gemini_api_key, commandr_api_key):
+    def __init__(self, prompt_dir, model, openai_api_key, claude_api_key, gemini_api_key, commandr_api_key, structured_review=None):
         self.prompt_dir = prompt_dir
         self.model = model
+        self.structured_review = self.STRUCTURED_REVIEW if structured_review is None else structured_review
         self.openai_api_key = os.environ.get('OPENAI_API_KEY')      
         self.claude_api_key = os.environ.get('ANTHROPIC_API_KEY')
         self.gemini_api_key = os.environ.get('GEMINI_API_KEY')
         self.commandr_api_key = os.environ.get('COMMANDR_API_KEY')
+        # The system role is sent with every prompt, so it comes off the model's budget up front
+        system_role_file_path = os.path.join(prompt_dir, "systemrole.txt")
+        system_role = read_file(system_role_file_path) if os.path.exists(system_role_file_path) else ''
+        self.token_budget = TokenBudget(model, reserved_text=system_role)
 
     def count_tokens(self, text):
-        return len(self.encoding.encode(text))
+        return self.token_budget.count(text)
 
     def truncate_content(self, content):
-        token_count = self.count_tokens(content)
-        logging.debug(f"Token count before truncation: {token_count}")
-        if token_count > self.MAX_TOKENS:
-            tokens = self.encoding.encode(content)
-            truncated_tokens = tokens[:self.MAX_TOKENS]
-            truncated_content = self.encoding.decode(truncated_tokens)
-            logging.debug(f"Content truncated. Token count after truncation: {self.count_tokens(truncated_content)}")
-            return truncated_content
-        return content
+        return self.token_budget.build(content)[0]
 
+    # Function to get the paper text for this model's prompts, compressed to its budget
     def prepare_base_prompt(self, paper):
         logging.debug(f"Preparing base prompt for paper: {paper.arxiv_id}")
-        logging.debug(f"Paper content: {paper.tex_file[:500]}")  # Log the first 500 characters
-        return paper.tex_file
+        if not COMPRESS_PAPERS:
+            log_payload("Paper content", paper.tex_file)
+            return paper.tex_file
+        with span('compress', model=self.model) as compress_span:
+            text, stats = compress_paper(paper.tex_file, paper_token_budget(self.token_budget.limit), self.token_budget)
+            compress_span.set(**stats)
+        increment('arena_compression_tokens_saved_total', (('model', self.model),), stats['tokens_before'] - stats['tokens_after'])
+        log_payload("Paper content", text)
+        return text
 
-    def call_model(self, prompt, model_type):
+    # When on_text is given the completion is streamed and on_text receives the
+    # text so far. token_count is the prompt's size from the token budget, for metrics.
+    async def call_model_async(self, prompt, model_type, on_text=None, token_count=None):
         system_role_file_path = os.path.join(self.prompt_dir, "systemrole.txt")
         if not os.path.exists(system_role_file_path):
             logging.error(f"System role file not found: {system_role_file_path}")
             return None
 
         system_role = read_file(system_role_file_path)
-        logging.debug(f"Token count of full prompt: {self.count_tokens(prompt)}")
-        logging.info(f"Sending the following prompt to {model_type}: {prompt}")
+        logging.info(f"Sending prompt to {model_type} ({describe_payload(prompt)})")
+        log_payload(f"Prompt to {model_type}", prompt)
 
-        try:
-            if model_type == 'gpt-4-turbo-2024-04-09':
-                client = OpenAI(api_key=self.openai_api_key)
-                messages = [{"role": "system", "content": system_role}, {"role": "user", "content": prompt}]
-                completion = client.chat.completions.create(
-                    model="gpt-4-turbo-2024-04-09",
-                    messages=messages,
-                    temperature=1
-                )
-                print(completion)
-                return completion.choices[0].message.content.strip()
-            
-            elif model_type == 'gpt-4o':
-                client = OpenAI(api_key=self.openai_api_key)
-                messages = [{"role": "system", "content": system_role}, {"role": "user", "content": prompt}]
-                completion = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=messages,
-                    temperature=1
-                )
-                print(completion)
-                return completion.choices[0].message.content.strip()
-
-            elif model_type == 'claude-3-opus-20240229':
-                client = anthropic.Anthropic(api_key=self.claude_api_key)
-                response = client.messages.create(
-                    model='claude-3-opus-20240229',
-                    max_tokens=4096,
-                    system=system_role,
-                    temperature=0.5, 
-                    messages=[{"role": "user", "content": prompt}]
-                )
-                print(response)
-                return response.content[0].text
-
-            elif model_type == 'command-r-plus':
-                co = cohere.Client(self.commandr_api_key)
-                response = co.chat(
-                    model="command-r-plus",
-                    message=prompt,
-                    preamble=system_role
-                )
-                print(response)
-                return response.text
-
-            elif model_type == 'gemini-pro':
-                genai.configure(api_key=self.gemini_api_key)
-                model = genai.GenerativeModel('gemini-pro')
-                response = model.generate_content(prompt)
-                print(response)
-                return response.candidates[0].content.parts[0].text
+        with span('model_call', model=model_type) as model_span:
+            started = time.perf_counter()
+            try:
+                if on_text is None:
+                    text = await providers.complete(model_type, system_role, prompt)
+                else:
+                    text = ''
+                    async for chunk in providers.stream(model_type, system_role, prompt):
+                        if not text:
+                            model_span.set(first_chunk_seconds=time.perf_counter() - started)
+                        text += chunk
+                        on_text(text)
+                    text = text.strip()
+            except Exception as e:
+                logging.error(f"Exception occurred: {e!r}")
+                model_span.set(error=type(e).__name__)
+                return None
+            if model_span.recording:
+                model_span.set(input_tokens=token_count, output_tokens=self.count_tokens(text))
+            log_payload(f"Response from {model_type}", text)
+            return text
 
-        except Exception as e:
-            logging.error(f"Exception occurred: {e}")
-            print(e)
-            return None
+    def call_model(self, prompt, model_type):
+        return providers.run(self.call_model_async(prompt, model_type))
 
     def is_content_appropriate(self, content):
         try:
-            response = openai.moderations.create(input=content)
-            return not response["results"][0]["flagged"]
+            return not providers.run(providers.moderate(content))
         except Exception as e:
             logging.error(f"Exception occurred while checking content appropriateness: {e}")
             return True  # In case of an error, default to content being appropriate
@@ -125,53 +116,190 @@ class PaperProcessor:
         return [f for f in os.listdir(prompt_dir) if f.endswith('.txt') and f.startswith('question')]
 
     def process_paper(self, paper):
-        openai.api_key = self.openai_api_key
+        return providers.run(self.process_paper_async(paper))
+
+    # on_section(i, text, final) is called as question i's answer streams in and
+    # once it is final. Moderation is up to the caller (see utils.moderate_paper),
+    # so it happens once per paper rather than once per model.
+    async def process_paper_async(self, paper, on_section=None):
+        with span('review', model=self.model):
+            return await self._process_paper_async(paper, on_section)
+
+    async def _process_paper_async(self, paper, on_section=None):
         start_time = time.time()
 
-        base_prompt = self.prepare_base_prompt(paper)
-        print("BASE PROMPT:", base_prompt)
+        # Compression tokenizes the whole paper, so it runs off the provider loop
+        base_prompt = await asyncio.to_thread(self.prepare_base_prompt, paper)
+        log_payload("Base prompt", base_prompt)
         if base_prompt is None:
             return "Error: Base prompt could not be prepared."
 
-        moderation_response = openai.moderations.create(input=base_prompt)
-        if moderation_response.results[0].flagged:
-            return ["Desk Rejected", "The paper contains inappropriate or harmful content."]
+        answers = {}
+        if self.structured_review:
+            answers = await self.structured_review_async(base_prompt)
+            if on_section is not None:
+                for i, answer in answers.items():
+                    on_section(i, answer, True)
 
-        review_output = []
-        previous_responses = []
-        header = ['Summary:', 'Soundness:', 'Presentation:', 'Contribution:', 'Strengths:', 'Weaknesses:', 'Questions:', 'Flag For Ethics Review:', 'Rating:', 'Confidence:', 'Code Of Conduct:']
-        for i in range(1, 12):
-            question_file = os.path.join(self.prompt_dir, f"question{i}.txt")
-            question_text = read_file(question_file)
+        # Questions run as soon as the answers they depend on are available; in
+        # structured mode only sections that failed validation are asked
+        graph = self.load_question_graph()
+        tasks = {}
+        for i in self.question_order(graph):
+            if i in answers:
+                tasks[i] = asyncio.get_running_loop().create_future()
+                tasks[i].set_result(answers[i])
+            else:
+                tasks[i] = asyncio.ensure_future(self.answer_question_async(i, base_prompt, graph[i], tasks, on_section))
+        answers = dict(zip(tasks, await asyncio.gather(*tasks.values())))
 
-            if i == 1:
-                prompt = f"{question_text}\n\n####\n{base_prompt}\n####"
+        review_output = [f"{self.HEADER[i-1]} {answers[i]}" for i in range(1, 12)]
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        logging.info(f"Time taken to process paper with {self.model}: {elapsed_time:.2f} seconds")
+        return review_output
+
+    async def answer_question_async(self, i, base_prompt, node, tasks, on_section=None):
+        include_paper, depends_on = node
+        previous_responses = [f"{self.HEADER[j-1]} {await tasks[j]}" for j in depends_on]
+        # The span starts once the dependencies are answered, so it does not include waiting for them
+        with span('question', model=self.model, question=i):
+            return await self._answer_question_async(i, base_prompt, include_paper, previous_responses, on_section)
+
+    async def _answer_question_async(self, i, base_prompt, include_paper, previous_responses, on_section=None):
+        question_file = os.path.join(self.prompt_dir, f"question{i}.txt")
+        question_text = read_file(question_file)
+
+        if previous_responses:
+            review_so_far = '\n'.join(previous_responses)
+            prompt = f"\nHere is your review so far:\n{review_so_far}\n\nHere are your reviewer instructions. Please answer the following question:\n{question_text}"
+        else:
+            prompt = question_text
+        # Only the paper is cut when the prompt is over budget, keeping the closing delimiter
+        with span('tokenize', model=self.model) as tokenize_span:
+            if include_paper:
+                truncated_prompt, token_count = self.token_budget.build(f"{prompt}\n\n####\n", base_prompt, "\n####", truncate=1)
             else:
-                prompt = f"\nHere is your review so far:\n{' '.join(previous_responses)}\n\nHere are your reviewer instructions. Please answer the following question:\n{question_text}"
+                truncated_prompt, token_count = self.token_budget.build(prompt)
+            tokenize_span.set(tokens=token_count)
+        logging.info(f"Processing prompt for question {i} ({token_count} tokens)")
+
+        on_text = None if on_section is None else lambda text: on_section(i, text, False)
+        response = await self.call_model_async(truncated_prompt, self.model, on_text, token_count)
+        if response is None:
+            response = "N/A"
+        with span('score_parse', model=self.model):
+            response = self.format_response(i, response)
+        if on_section is not None:
+            on_section(i, response, True)
+        return response
 
-            truncated_prompt = self.truncate_content(prompt)
-            logging.info(f"Processing prompt for question {i}")
+    # Function to read questions.json from the prompt directory, mapping each
+    # question number to (include paper, question numbers it depends on).
+    # Without a manifest every question depends on all earlier answers.
+    def load_question_graph(self):
+        manifest_path = os.path.join(self.prompt_dir, "questions.json")
+        if not os.path.exists(manifest_path):
+            return {i: (i == 1, list(range(1, i))) for i in range(1, 12)}
 
-            response = self.call_model(truncated_prompt, self.model)
-            if response is None:
-                response = "N/A"
+        manifest = json.loads(read_file(manifest_path))
+        graph = {}
+        for i in range(1, 12):
+            entry = manifest.get(f"question{i}", {})
+            depends_on = [int(name[len("question"):]) for name in entry.get("depends_on", [])]
+            graph[i] = (entry.get("paper", False), depends_on)
+        return graph
 
-            if i in [2, 3, 4, 10]:
-                number_match = re.search(r'\b\d+\b', response)
-                if number_match:
-                    number = int(number_match.group(0))
-                    response = '5/5' if number > 5 else number_match.group(0) + '/5'
-            elif i == 9:
-                number_match = re.search(r'\b\d+\b', response)
-                if number_match:
-                    response = number_match.group(0) + '/10'
+    def question_order(self, graph):
+        order = []
+        visiting = set()
 
-            response_with_header = f"{header[i-1]} {response}"
-            review_output.append(response_with_header)
-            previous_responses.append(response)
+        def visit(i):
+            if i in order:
+                return
+            if i in visiting:
+                raise ValueError(f"Question manifest has a dependency cycle at question{i}")
+            if i not in graph:
+                raise ValueError(f"Question manifest references unknown question{i}")
+            visiting.add(i)
+            for j in graph[i][1]:
+                visit(j)
+            visiting.discard(i)
+            order.append(i)
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"Time taken to process paper: {elapsed_time:.2f} seconds")
-        return review_output
+        for i in sorted(graph):
+            visit(i)
+        return order
+
+    def format_response(self, i, response):
+        if i in [2, 3, 4, 10]:
+            number_match = re.search(r'\b\d+\b', response)
+            if number_match:
+                number = int(number_match.group(0))
+                response = '5/5' if number > 5 else number_match.group(0) + '/5'
+        elif i == 9:
+            number_match = re.search(r'\b\d+\b', response)
+            if number_match:
+                response = number_match.group(0) + '/10'
+        return response
 
+    def review_schema(self):
+        properties = {}
+        for i, (field, minimum, maximum) in enumerate(self.REVIEW_FIELDS, start=1):
+            question_text = read_file(os.path.join(self.prompt_dir, f"question{i}.txt")).strip()
+            if minimum is None:
+                properties[field] = {"type": "string", "description": question_text}
+            else:
+                properties[field] = {"type": "integer", "minimum": minimum, "maximum": maximum, "description": question_text}
+        return {"type": "object", "properties": properties, "required": [field for field, _, _ in self.REVIEW_FIELDS]}
+
+    # Function to ask for the whole review in one call. Returns the valid
+    # sections keyed by question number; invalid or missing ones are left out.
+    async def structured_review_async(self, base_prompt):
+        system_role_file_path = os.path.join(self.prompt_dir, "systemrole.txt")
+        if not os.path.exists(system_role_file_path):
+            logging.error(f"System role file not found: {system_role_file_path}")
+            return {}
+        system_role = read_file(system_role_file_path)
+
+        schema = self.review_schema()
+        instructions = "\n\n".join(f"{field}: {schema['properties'][field]['description']}" for field, _, _ in self.REVIEW_FIELDS)
+        prompt = (f"Write a complete review of the paper below. Answer every reviewer instruction and respond with a single JSON object "
+                  f"with one key per instruction, matching this JSON schema:\n{json.dumps(schema)}\n\n"
+                  f"Reviewer instructions:\n{instructions}\n\n####\n")
+        with span('tokenize', model=self.model) as tokenize_span:
+            truncated_prompt, token_count = self.token_budget.build(prompt, base_prompt, "\n####", truncate=1)
+            tokenize_span.set(tokens=token_count)
+        logging.info(f"Requesting structured review from {self.model} ({token_count} tokens)")
+
+        with span('model_call', model=self.model, structured=True) as model_span:
+            try:
+                result = await providers.complete_json(self.model, system_role, truncated_prompt, schema)
+            except Exception as e:
+                logging.error(f"Structured review failed for {self.model}: {e!r}")
+                model_span.set(error=type(e).__name__)
+                return {}
+            if model_span.recording:
+                model_span.set(input_tokens=token_count, output_tokens=self.count_tokens(json.dumps(result)))
+
+        answers = {}
+        with span('score_parse', model=self.model, structured=True):
+            for i, (field, minimum, maximum) in enumerate(self.REVIEW_FIELDS, start=1):
+                value = self.validate_field(result.get(field), minimum, maximum)
+                if value is None:
+                    logging.info(f"Structured review field {field} failed validation, falling back to question {i}")
+                else:
+                    answers[i] = self.format_response(i, value)
+        return answers
+
+    def validate_field(self, value, minimum, maximum):
+        if minimum is None:
+            if isinstance(value, str) and value.strip():
+                return value.strip()
+            return None
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value.strip())
+        if isinstance(value, bool) or not isinstance(value, int) or not minimum <= value <= maximum:
+            return None
+        return str(value)
@@ -0,0 +1,130 @@
+import logging
+import math
+import os
+import random
+import threading
+import time
+import providers
+from storage import get_storage
+
+# 'adaptive' prefers the comparisons the leaderboard learns most from; 'uniform' picks any pair
+PAIR_SAMPLING = os.environ.get('PAIR_SAMPLING', 'adaptive')
+# Share of uploads that get a uniformly random pair, so no pair is ever starved
+EXPLORATION = float(os.environ.get('PAIR_EXPLORATION', 0.2))
+# Seconds between reloads of ratings and pair counts
+STATS_INTERVAL = float(os.environ.get('PAIR_STATS_SECONDS', 300))
+# Median seconds to first chunk at which a model's weight is halved
+LATENCY_SCALE = float(os.environ.get('PAIR_LATENCY_SCALE', 30))
+# CI half-width assumed for a model without one, about that of a handful of votes
+DEFAULT_CI_HALF_WIDTH = 200.0
+
+
+# Picks which two models review an upload. A pair's weight estimates how much
+# one more vote on it would tell us: the outcome variance p(1-p) predicted by
+# the ratings (highest for close pairs), times the pair's combined CI width,
+# shrunk by the votes the pair already has. Each model's weight is further
+# scaled down by its recent error rate and latency, since slow or failing
+# reviews rarely get voted on. That health comes from this process's provider
+# calls, or with worker_health set (reviews run by review_worker.py) from what
+# the workers report to the job queue. Ratings, pair counts and worker health
+# are reloaded in the background; until the first load every pair is equally likely.
+# rating_utils loads numpy, so it is imported where used rather than at startup.
+class PairSampler:
+    def __init__(self, exploration=EXPLORATION, stats_interval=STATS_INTERVAL, worker_health=False):
+        self.exploration = exploration
+        self.stats_interval = stats_interval
+        self.worker_health = worker_health
+        self.ratings = {}
+        self.health = {}
+        self.pair_counts = {}
+        self.loaded_at = None
+        self._loading = False
+        self._lock = threading.Lock()
+
+    def sample(self, models):
+        self.maybe_reload()
+        pairs = [(a, b) for i, a in enumerate(models) for b in models[i + 1:]]
+        if PAIR_SAMPLING != 'adaptive' or random.random() < self.exploration:
+            pair = random.choice(pairs)
+        else:
+            pair = random.choices(pairs, weights=[self.pair_weight(a, b) for a, b in pairs])[0]
+        # Which model is shown as A is random, so position bias averages out
+        return random.sample(pair, 2)
+
+    def pair_weight(self, a, b):
+        import rating_utils
+        with self._lock:
+            elo_a, width_a = self.ratings.get(a, (rating_utils.ELO_BASE, DEFAULT_CI_HALF_WIDTH))
+            elo_b, width_b = self.ratings.get(b, (rating_utils.ELO_BASE, DEFAULT_CI_HALF_WIDTH))
+            votes = self.pair_counts.get(tuple(sorted((a, b))), 0)
+        p = 1 / (1 + 10 ** ((elo_b - elo_a) / rating_utils.ELO_SCALE))
+        information = p * (1 - p) * math.sqrt(width_a ** 2 + width_b ** 2) / math.sqrt(1 + votes)
+        # Never exactly 0, so random.choices always has something to pick
+        return max(information * self.model_weight(a) * self.model_weight(b), 1e-12)
+
+    def model_weight(self, model):
+        if self.worker_health:
+            with self._lock:
+                latency, error_rate = self.health.get(model, (None, None))
+        else:
+            latency, error_rate = providers.model_health(model)
+        weight = 1.0
+        if error_rate is not None:
+            weight *= 1 - error_rate
+        if latency is not None:
+            weight *= LATENCY_SCALE / (LATENCY_SCALE + latency)
+        return weight
+
+    # Function to count a vote right away, before the next reload sees it
+    def record_vote(self, model_a, model_b):
+        pair = tuple(sorted((model_a, model_b)))
+        with self._lock:
+            self.pair_counts[pair] = self.pair_counts.get(pair, 0) + 1
+
+    def maybe_reload(self):
+        with self._lock:
+            if self._loading or (self.loaded_at is not None and time.time() - self.loaded_at < self.stats_interval):
+                return
+            self._loading = True
+        threading.Thread(target=self.reload, name='pair-stats', daemon=True).start()
+
+    # Function to load ratings and CI half-widths from the leaderboard,
+    # per-pair vote counts from the rating checkpoint, if there is one, and
+    # the workers' model health when reviews run on them
+    def reload(self):
+        import rating_utils
+        try:
+            if self.worker_health:
+                from job_queue import get_job_queue
+                health = get_job_queue().model_health()
+                with self._lock:
+                    self.health = health
+            ratings = {}
+            for row in get_storage().get_leaderboard():
+                elo = float(row['EloScore'])
+                if row.get('CI_Lower') is not None and row.get('CI_Upper') is not None and row.get('Votes'):
+                    width = (float(row['CI_Upper']) - float(row['CI_Lower'])) / 2
+                else:
+                    width = DEFAULT_CI_HALF_WIDTH
+                ratings[row['ModelID']] = (elo, width)
+            pair_counts = {}
+            checkpoint = rating_utils.load_checkpoint()
+            if checkpoint is not None:
+                games = checkpoint['counts'].sum(axis=2)
+                models = checkpoint['models']
+                for i, a in enumerate(models):
+                    for j in range(i + 1, len(models)):
+                        pair_counts[tuple(sorted((a, models[j])))] = int(games[i, j] + games[j, i])
+            with self._lock:
+                self.ratings = ratings
+                # Votes since the checkpoint was written are only known locally
+                for pair, count in pair_counts.items():
+                    self.pair_counts[pair] = max(count, self.pair_counts.get(pair, 0))
+        except Exception as e:
+            logging.error(f"Loading pair sampling statistics failed: {e}")
+        finally:
+            with self._lock:
+                self.loaded_at = time.time()
+                self._loading = False
+
+pair_sampler = PairSampler()
@@ -0,0 +1,181 @@
+import logging
+import os
+import re
+from collections import Counter
+from token_utils import encode, decode
+
+# Compress extracted paper text before it is put in prompts
+COMPRESS_PAPERS = os.environ.get('COMPRESS_PAPERS', 'true').lower() in ('1', 'true', 'yes')
+# Reference lists are dropped unless this is set
+KEEP_REFERENCES = os.environ.get('COMPRESS_KEEP_REFERENCES', '').lower() in ('1', 'true', 'yes')
+# Optional cap on paper tokens per prompt, below what the model would allow
+MAX_PAPER_TOKENS = int(os.environ['MAX_PAPER_TOKENS']) if os.environ.get('MAX_PAPER_TOKENS') else None
+# Tokens of each model's budget left for the question, earlier answers and delimiters
+PROMPT_RESERVE_TOKENS = 8000
+# Sections left with fewer tokens than this are dropped rather than cut
+MIN_PARTIAL_TOKENS = 200
+# Short lines seen at least this often are running headers or footers
+REPEATED_LINE_COUNT = 4
+
+# Unnumbered headings and the kind of section they start
+NAMED_HEADINGS = {
+    'abstract': 'front',
+    'references': 'references', 'bibliography': 'references', 'literature cited': 'references',
+    'acknowledgments': 'acknowledgements', 'acknowledgements': 'acknowledgements',
+    'acknowledgment': 'acknowledgements', 'acknowledgement': 'acknowledgements',
+    'appendix': 'appendix', 'appendices': 'appendix', 'supplementary material': 'appendix',
+    'ethics statement': 'statement', 'reproducibility statement': 'statement',
+    'broader impact': 'statement', 'broader impacts': 'statement', 'impact statement': 'statement',
+}
+# "3 Method", "4.2. Ablations", "B.1 Proofs": a number or appendix letter, then a
+# short title. A lone letter takes no dot, so "A. Smith" in a reference list is not one.
+NUMBERED_HEADING = re.compile(r'^(\d{1,2}(?:\.\d{1,2})*\.?|[A-H](?:\.\d{1,2})+\.?|[A-H])\s+([A-Z][^\n,]{1,79})$')
+# Body sections a reviewer needs most when the budget is tight
+KEY_SECTION_WORDS = ('introduction', 'conclusion', 'discussion', 'limitation')
+# Lower is kept first when the paper does not fit
+PRIORITIES = {'front': 0, 'key': 1, 'body': 2, 'statement': 3, 'appendix': 4, 'acknowledgements': 5, 'references': 6}
+PAGE_NUMBER = re.compile(r'^\s*(?:page\s+)?\d{1,4}(?:\s*(?:/|of)\s*\d{1,4})?\s*$', re.IGNORECASE)
+
+
+class Section:
+    def __init__(self, kind, title, lines):
+        self.kind = kind
+        self.title = title
+        self.lines = lines
+
+    @property
+    def text(self):
+        return '\n'.join(self.lines)
+
+
+# Function to get how many tokens of paper fit in prompts within a model's token limit
+def paper_token_budget(limit):
+    budget = limit - PROMPT_RESERVE_TOKENS
+    return budget if MAX_PAPER_TOKENS is None else min(budget, MAX_PAPER_TOKENS)
+
+# Function to remove extraction junk: page numbers, running headers and
+# footers, words hyphenated across lines and runs of blank lines
+def clean_text(text):
+    text = re.sub(r'([a-z])-\n([a-z])', r'\1\2', text)
+    lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in text.split('\n')]
+    shapes = Counter(re.sub(r'\d+', '#', line) for line in lines if 10 <= len(line) <= 100)
+    repeated = {shape for shape, count in shapes.items() if count >= REPEATED_LINE_COUNT}
+    cleaned = []
+    for line in lines:
+        if PAGE_NUMBER.match(line) or re.sub(r'\d+', '#', line) in repeated:
+            continue
+        if not line and (not cleaned or not cleaned[-1]):
+            continue
+        cleaned.append(line)
+    return '\n'.join(cleaned).strip()
+
+# Function to get a heading's (number, title) or None. Numbered headings must
+# continue the numbering seen so far, so body lines starting with a number
+# are not mistaken for headings.
+def parse_heading(line, last_number, in_appendix):
+    if line.lower().rstrip(':') in NAMED_HEADINGS:
+        return None, line.rstrip(':')
+    match = NUMBERED_HEADING.match(line)
+    # Headings are short lines; a wrapped line of body text is usually near full width
+    if match is None or len(line) > 60 or len(match.group(2).split()) > 8 or match.group(2).endswith(('.', ';', ':')):
+        return None
+    number = match.group(1).rstrip('.')
+    top = number.split('.')[0]
+    previous = last_number.split('.')[0] if last_number else None
+    if top.isdigit():
+        previous = int(previous) if previous and previous.isdigit() else 0
+        if in_appendix or int(top) not in (previous, previous + 1):
+            return None
+    else:
+        # Lettered sections only exist in appendices, starting from A
+        previous = previous if previous and previous.isalpha() else chr(ord('A') - 1)
+        if not in_appendix or top not in (previous, chr(ord(previous) + 1)):
+            return None
+    return number, match.group(2)
+
+# Function to split cleaned text into sections of a kind each
+def split_sections(text):
+    sections = [Section('front', None, [])]
+    last_number = None
+    in_appendix = False
+    for line in text.split('\n'):
+        heading = parse_heading(line, last_number, in_appendix) if line else None
+        if heading is None:
+            sections[-1].lines.append(line)
+            continue
+        number, title = heading
+        kind = NAMED_HEADINGS.get(title.lower())
+        if kind is None:
+            if number[0].isalpha():
+                kind = 'appendix'
+            elif any(word in title.lower() for word in KEY_SECTION_WORDS):
+                kind = 'key'
+            else:
+                kind = 'body'
+        if kind in ('references', 'appendix'):
+            # Whatever follows the references is supplementary
+            in_appendix = True
+        if number is not None:
+            last_number = number
+        if kind == 'front' and sections[-1].kind == 'front':
+            sections[-1].lines.append(line)
+        elif sections[-1].kind == 'appendix' and kind in ('body', 'key'):
+            # Subsections within an appendix stay appendix
+            sections[-1].lines.append(line)
+        else:
+            sections.append(Section(kind, line, [line]))
+    return [section for section in sections if section.text.strip()]
+
+# Function to compress extracted paper text to at most budget tokens. Junk is
+# removed, references and acknowledgements dropped, and if the rest is still
+# over budget, sections are kept in priority order (front matter, intro and
+# conclusion, other body sections, statements, appendix) with the last one
+# that fits cut short. Sections stay in document order and a one-line note
+# marks each dropped one. Returns the text and a dict of statistics.
+# Each section is tokenized once, with token_budget's encodings when given;
+# the counts are sums over sections, so tokens_before is that of the cleaned
+# text. The compressed text's tokens are handed to token_budget, so building
+# prompts with it does not tokenize the paper again.
+def compress_paper(text, budget=None, token_budget=None):
+    encode_text = encode if token_budget is None else token_budget.encode
+    sections = split_sections(clean_text(text))
+    section_tokens = [encode_text(section.text) for section in sections]
+    kept = {}
+    # Room for the notes that replace dropped sections
+    remaining = None if budget is None else budget - 15 * len(sections)
+    for i in sorted(range(len(sections)), key=lambda i: (PRIORITIES[sections[i].kind], i)):
+        section = sections[i]
+        if section.kind == 'acknowledgements' or (section.kind == 'references' and not KEEP_REFERENCES):
+            continue
+        tokens = section_tokens[i]
+        if remaining is None or len(tokens) <= remaining:
+            kept[i] = section.text, tokens
+            remaining = None if remaining is None else remaining - len(tokens)
+        elif remaining >= MIN_PARTIAL_TOKENS:
+            prefix = tokens[:remaining - 10]
+            kept[i] = decode(prefix) + "\n[...]", list(prefix) + encode_text("\n[...]")
+            remaining = 0
+
+    parts = []
+    compressed_tokens = []
+    separator = encode_text('\n\n')
+    dropped = []
+    for i, section in enumerate(sections):
+        if i in kept:
+            part, tokens = kept[i]
+        else:
+            dropped.append(section.title or section.kind)
+            part = f"[{section.title or section.kind} omitted]"
+            tokens = encode_text(part)
+        if parts:
+            compressed_tokens += separator
+        parts.append(part)
+        compressed_tokens += tokens
+    compressed = '\n\n'.join(parts)
+    if token_budget is not None:
+        token_budget.remember(compressed, compressed_tokens)
+    stats = {'tokens_before': sum(len(tokens) for tokens in section_tokens), 'tokens_after': len(compressed_tokens),
+             'sections': len(sections), 'dropped_sections': len(dropped)}
+    logging.info(f"Compressed paper from {stats['tokens_before']} to {stats['tokens_after']} tokens, "
+                 f"dropped {dropped}")
+    return compressed, stats
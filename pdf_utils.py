@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Documents with at least this many pages are split across a process pool
+POOL_MIN_PAGES = int(os.environ.get('PDF_POOL_MIN_PAGES', 64))
+POOL_WORKERS = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+PAGES_PER_CHUNK = 16
+# Number of extracted papers kept in memory, keyed by content digest
+TEXT_CACHE_ENTRIES = int(os.environ.get('PDF_TEXT_CACHE_ENTRIES', 32))
+
+# Characters the prompt pipeline cannot carry are replaced like latin-1 'replace' would
+NON_LATIN1 = re.compile('[^\x00-\xff]')
+
+_pool = None
+_text_cache = OrderedDict()
+_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            # Workers are spawned, not forked: this process already runs the
+            # provider loop and server threads, whose locks a fork would copy
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+# Function to extract a range of pages; runs in pool workers, which open the
+# document from its file, so the PDF is never sent through the pool
+def extract_pages(path, start, stop):
+    import fitz
+    with fitz.open(path, filetype='pdf') as pdf_document:
+        return [NON_LATIN1.sub('?', pdf_document[i].get_text()) for i in range(start, stop)]
+
+# Function to extract the text of an in-memory PDF. Extraction stops once
+# max_chars characters have been collected, since anything beyond the largest
+# model budget would be truncated anyway. path, if the PDF is also on disk,
+# saves a copy for the process pool.
+def extract_text(pdf_bytes, max_chars=None, digest=None, path=None):
+    digest = digest or hashlib.sha512(pdf_bytes).hexdigest()
+    key = (digest, max_chars)
+    with _lock:
+        if key in _text_cache:
+            _text_cache.move_to_end(key)
+            return _text_cache[key]
+
+    import fitz
+    pages = []
+    length = 0
+    with fitz.open(stream=pdf_bytes, filetype='pdf') as pdf_document:
+        page_count = pdf_document.page_count
+        use_pool = page_count >= POOL_MIN_PAGES and POOL_WORKERS > 1
+        if not use_pool:
+            for page in pdf_document:
+                pages.append(NON_LATIN1.sub('?', page.get_text()))
+                length += len(pages[-1])
+                if max_chars is not None and length >= max_chars:
+                    break
+
+    if use_pool:
+        tmp_path = None
+        if path is None:
+            # Workers share one copy on disk (in the page cache) rather than a pickle each
+            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+                f.write(pdf_bytes)
+                tmp_path = path = f.name
+        # Keep at most one chunk per worker in flight so an early stop wastes little work
+        pool = _get_pool()
+        starts = iter(range(0, page_count, PAGES_PER_CHUNK))
+        pending = deque()
+
+        def submit_next():
+            start = next(starts, None)
+            if start is not None:
+                pending.append(pool.submit(extract_pages, path, start, min(start + PAGES_PER_CHUNK, page_count)))
+
+        try:
+            for _ in range(POOL_WORKERS):
+                submit_next()
+            while pending and (max_chars is None or length < max_chars):
+                chunk = pending.popleft().result()
+                pages.extend(chunk)
+                length += sum(len(page) for page in chunk)
+                submit_next()
+        finally:
+            for future in pending:
+                future.cancel()
+            # A running chunk may still have the file open; unlinking it is safe on POSIX
+            if tmp_path is not None:
+                os.remove(tmp_path)
+
+    text = ''.join(pages)
+    if max_chars is not None:
+        text = text[:max_chars]
+    logging.info(f"Extracted {len(pages)}/{page_count} pages ({len(text)} characters)")
+
+    with _lock:
+        _text_cache[key] = text
+        while len(_text_cache) > TEXT_CACHE_ENTRIES:
+            _text_cache.popitem(last=False)
+    return text
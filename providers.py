@@ -0,0 +1,448 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+import scheduler
+
+# Seconds a single provider call may take before it is abandoned;
+# PROVIDER_TIMEOUTS (JSON) sets it per provider name
+DEFAULT_TIMEOUT = float(os.environ.get('PROVIDER_TIMEOUT', 300))
+PROVIDER_TIMEOUTS = json.loads(os.environ.get('PROVIDER_TIMEOUTS') or '{}')
+# Attempts per call for transient errors, with jittered exponential backoff
+MAX_ATTEMPTS = int(os.environ.get('PROVIDER_MAX_ATTEMPTS', 3))
+RETRY_BACKOFF = float(os.environ.get('PROVIDER_RETRY_BACKOFF', 1.0))
+# Send a duplicate request once a call is slower than this quantile of recent
+# calls to the same model, if the provider has idle capacity
+HEDGE_REQUESTS = os.environ.get('PROVIDER_HEDGE', '').lower() in ('1', 'true', 'yes')
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+
+# Errors worth retrying: timeouts, rate limits, overload and server errors
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+TRANSIENT_ERROR_NAMES = {'APIConnectionError', 'APITimeoutError', 'RateLimitError', 'InternalServerError',
+                         'ServiceUnavailable', 'ResourceExhausted', 'DeadlineExceeded', 'TooManyRequestsError'}
+
+# Base class for all providers. Each provider owns one async client that is
+# created on first use and then shared by every review in the process. SDKs
+# are imported in create_client, so startup does not pay for them.
+class Provider:
+    # Rate limits in scheduler.PROVIDER_LIMITS are looked up by this name
+    name = None
+    api_key_env = None
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key if api_key is not None else os.environ.get(self.api_key_env)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.create_client()
+        return self._client
+
+    def create_client(self):
+        raise NotImplementedError
+
+    async def complete(self, model, system_role, prompt):
+        raise NotImplementedError
+
+    # Providers without token streaming yield the whole completion as one chunk
+    async def stream(self, model, system_role, prompt):
+        yield await self.complete(model, system_role, prompt)
+
+    # Providers without a native structured-output mode are asked for JSON in
+    # the prompt and the first JSON object in the reply is parsed.
+    async def complete_json(self, model, system_role, prompt, schema):
+        return parse_json_object(await self.complete(model, system_role, prompt))
+
+
+class OpenAIProvider(Provider):
+    name = 'openai'
+    api_key_env = 'OPENAI_API_KEY'
+
+    def create_client(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=self.api_key)
+
+    async def complete(self, model, system_role, prompt):
+        messages = [{"role": "system", "content": system_role}, {"role": "user", "content": prompt}]
+        completion = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=1
+        )
+        return completion.choices[0].message.content.strip()
+
+    async def stream(self, model, system_role, prompt):
+        messages = [{"role": "system", "content": system_role}, {"role": "user", "content": prompt}]
+        completion = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=1,
+            stream=True
+        )
+        async for chunk in completion:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def complete_json(self, model, system_role, prompt, schema):
+        messages = [{"role": "system", "content": system_role}, {"role": "user", "content": prompt}]
+        completion = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=1,
+            response_format={"type": "json_object"}
+        )
+        return parse_json_object(completion.choices[0].message.content)
+
+    # content is a string or a list of strings; flagged if any of them is
+    async def moderate(self, content):
+        response = await self.client.moderations.create(input=content)
+        return any(result.flagged for result in response.results)
+
+
+class AnthropicProvider(Provider):
+    name = 'anthropic'
+    api_key_env = 'ANTHROPIC_API_KEY'
+
+    def create_client(self):
+        import anthropic
+        return anthropic.AsyncAnthropic(api_key=self.api_key)
+
+    async def complete(self, model, system_role, prompt):
+        response = await self.client.messages.create(
+            model=model,
+            max_tokens=4096,
+            system=system_role,
+            temperature=0.5,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        return response.content[0].text
+
+    async def stream(self, model, system_role, prompt):
+        response = await self.client.messages.create(
+            model=model,
+            max_tokens=4096,
+            system=system_role,
+            temperature=0.5,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True
+        )
+        async for event in response:
+            if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                yield event.delta.text
+
+    async def complete_json(self, model, system_role, prompt, schema):
+        response = await self.client.beta.tools.messages.create(
+            model=model,
+            max_tokens=4096,
+            system=system_role,
+            temperature=0.5,
+            tools=[{"name": "submit_review", "description": "Submit the completed review.", "input_schema": schema}],
+            messages=[{"role": "user", "content": f"{prompt}\n\nSubmit your review with the submit_review tool."}]
+        )
+        for block in response.content:
+            if block.type == 'tool_use':
+                return block.input
+        return parse_json_object(''.join(block.text for block in response.content if block.type == 'text'))
+
+
+class CohereProvider(Provider):
+    name = 'cohere'
+    api_key_env = 'COMMANDR_API_KEY'
+
+    def create_client(self):
+        import cohere
+        return cohere.AsyncClient(self.api_key)
+
+    async def complete(self, model, system_role, prompt):
+        response = await self.client.chat(
+            model=model,
+            message=prompt,
+            preamble=system_role
+        )
+        return response.text
+
+    async def stream(self, model, system_role, prompt):
+        async for event in self.client.chat_stream(
+            model=model,
+            message=prompt,
+            preamble=system_role
+        ):
+            if event.event_type == 'text-generation':
+                yield event.text
+
+
+class GeminiProvider(Provider):
+    name = 'gemini'
+    api_key_env = 'GEMINI_API_KEY'
+
+    def __init__(self, api_key=None):
+        super().__init__(api_key)
+        self._models = {}
+
+    def create_client(self):
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        return genai
+
+    def get_model(self, model):
+        if model not in self._models:
+            self._models[model] = self.client.GenerativeModel(model)
+        return self._models[model]
+
+    async def complete(self, model, system_role, prompt):
+        response = await self.get_model(model).generate_content_async(prompt)
+        return response.candidates[0].content.parts[0].text
+
+    async def stream(self, model, system_role, prompt):
+        response = await self.get_model(model).generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.candidates and chunk.candidates[0].content.parts:
+                yield chunk.candidates[0].content.parts[0].text
+
+
+# Which provider serves each model offered in the arena
+MODEL_PROVIDERS = {
+    'gpt-4-turbo-2024-04-09': OpenAIProvider,
+    'gpt-4o': OpenAIProvider,
+    'claude-3-opus-20240229': AnthropicProvider,
+    'gemini-pro': GeminiProvider,
+    'command-r-plus': CohereProvider,
+}
+
+_providers = {}
+_overrides = {}
+_loop = None
+_lock = threading.Lock()
+
+# Function to get the process-wide provider instance for a model
+def get_provider(model):
+    if model in _overrides:
+        return _overrides[model]
+    provider_class = MODEL_PROVIDERS.get(model)
+    if provider_class is None:
+        raise ValueError(f"Unknown model: {model}")
+    with _lock:
+        if provider_class not in _providers:
+            _providers[provider_class] = provider_class()
+        return _providers[provider_class]
+
+# Function to serve a model from the given provider instance instead of its
+# default one, e.g. the simulated providers of bench_arena
+def override_provider(model, provider):
+    with _lock:
+        _overrides[model] = provider
+
+# Function to get the event loop all provider calls run on. The loop lives in
+# a daemon thread so that synchronous callers (Gradio handlers) can share it.
+def get_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='provider-loop', daemon=True).start()
+        return _loop
+
+# Function to run a coroutine on the provider loop from synchronous code
+def run(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+# Function to get the name a provider's rate limits are kept under
+def provider_name(provider):
+    return provider.name or type(provider).__name__
+
+# Function to get the deadline of a single call to a provider
+def call_timeout(provider, timeout=None):
+    if timeout is not None:
+        return timeout
+    return float(PROVIDER_TIMEOUTS.get(provider_name(provider), DEFAULT_TIMEOUT))
+
+def is_transient(error):
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int) and status in TRANSIENT_STATUS_CODES:
+        return True
+    return type(error).__name__ in TRANSIENT_ERROR_NAMES
+
+# Recent call latencies per model key and attempt outcomes per model
+_latencies = {}
+_outcomes = {}
+
+def record_latency(key, seconds):
+    _latencies.setdefault(key, deque(maxlen=200)).append(seconds)
+
+def record_outcome(model, ok):
+    _outcomes.setdefault(model, deque(maxlen=200)).append(ok)
+
+# Function to get a model's recent (median seconds to first chunk or
+# completion, error rate); either is None without samples
+def model_health(model):
+    samples = _latencies.get(f"{model}:first_chunk") or _latencies.get(model)
+    latency = sorted(samples)[len(samples) // 2] if samples else None
+    outcomes = _outcomes.get(model)
+    error_rate = 1 - sum(outcomes) / len(outcomes) if outcomes else None
+    return latency, error_rate
+
+# Function to get (latency, error rate, attempts) as in model_health for every
+# model this process has called, for sharing with other processes
+def health_report():
+    return {model: (*model_health(model), len(outcomes)) for model, outcomes in list(_outcomes.items()) if outcomes}
+
+# Function to get how long to wait before hedging a call, or None to not hedge
+def hedge_delay(key):
+    samples = _latencies.get(key)
+    if not HEDGE_REQUESTS or samples is None or len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return sorted(samples)[int(HEDGE_QUANTILE * (len(samples) - 1))]
+
+# Function to retry a call on transient errors with jittered exponential
+# backoff; attempts count towards the model's error rate
+async def with_retries(name, call, model=None):
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            result = await call()
+            if model is not None:
+                record_outcome(model, True)
+            return result
+        except Exception as e:
+            if model is not None:
+                record_outcome(model, False)
+            if attempt == MAX_ATTEMPTS or not is_transient(e):
+                raise
+            delay = random.uniform(0, RETRY_BACKOFF * 2 ** (attempt - 1))
+            logging.warning(f"Transient {name} error {e!r}, retry {attempt}/{MAX_ATTEMPTS - 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+# Function to run a call, starting a duplicate once it takes longer than the
+# hedge delay for key; whichever succeeds first wins and the other is
+# cancelled. discard(result) disposes of a result that lost the race.
+async def hedged(name, key, call, discard=None):
+    delay = hedge_delay(key)
+    if delay is None:
+        return await call()
+    tasks = {asyncio.ensure_future(call())}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        # Duplicates only use idle capacity; they never queue behind other users
+        if not done and not scheduler.get_scheduler(name).queues:
+            logging.info(f"Hedging {key} call after {delay:.1f}s")
+            tasks.add(asyncio.ensure_future(call()))
+        pending = tasks
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                for task in succeeded[1:]:
+                    if discard is not None:
+                        await discard(task.result())
+                return succeeded[0].result()
+            if not pending:
+                return done.pop().result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+# Function to send a prompt to a model. Each attempt first waits for admission
+# by the provider's scheduler and is then bounded by the provider's deadline;
+# transient failures are retried and slow calls optionally hedged.
+async def complete(model, system_role, prompt, timeout=None):
+    provider = get_provider(model)
+    name = provider_name(provider)
+
+    async def attempt():
+        async with scheduler.slot(name, system_role, prompt):
+            started = time.monotonic()
+            text = await asyncio.wait_for(provider.complete(model, system_role, prompt), call_timeout(provider, timeout))
+            record_latency(model, time.monotonic() - started)
+            return text
+
+    return await with_retries(name, lambda: hedged(name, model, attempt), model)
+
+# Function to stream a completion chunk by chunk; the deadline covers the whole
+# stream. Retries and hedging only apply until the first chunk arrives, since
+# what was already streamed cannot be taken back.
+async def stream(model, system_role, prompt, timeout=None):
+    provider = get_provider(model)
+    name = provider_name(provider)
+    key = f"{model}:first_chunk"
+
+    # The opening and the rest of a stream run in different tasks, so the
+    # deadline is applied to each chunk rather than with asyncio.timeout
+    async def attempt_chunks():
+        async with scheduler.slot(name, system_role, prompt):
+            started = time.monotonic()
+            deadline = started + call_timeout(provider, timeout)
+            chunks = provider.stream(model, system_role, prompt)
+            try:
+                first = True
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(anext(chunks), deadline - time.monotonic())
+                    except StopAsyncIteration:
+                        return
+                    if first:
+                        record_latency(key, time.monotonic() - started)
+                        first = False
+                    yield chunk
+            finally:
+                await chunks.aclose()
+
+    async def open_stream():
+        chunks = attempt_chunks()
+        try:
+            return chunks, await chunks.__anext__()
+        except StopAsyncIteration:
+            return chunks, ''
+        except BaseException:
+            await chunks.aclose()
+            raise
+
+    async def close_stream(opened):
+        await opened[0].aclose()
+
+    chunks, first_chunk = await with_retries(name, lambda: hedged(name, key, open_stream, close_stream), model)
+    try:
+        if first_chunk:
+            yield first_chunk
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+# Function to ask a model for a JSON object matching a JSON schema
+async def complete_json(model, system_role, prompt, schema, timeout=None):
+    provider = get_provider(model)
+    name = provider_name(provider)
+    key = f"{model}:json"
+
+    async def attempt():
+        async with scheduler.slot(name, system_role, prompt):
+            started = time.monotonic()
+            result = await asyncio.wait_for(provider.complete_json(model, system_role, prompt, schema), call_timeout(provider, timeout))
+            record_latency(key, time.monotonic() - started)
+            return result
+
+    return await with_retries(name, lambda: hedged(name, key, attempt), model)
+
+# Function to check content with the OpenAI moderation endpoint
+async def moderate(content, timeout=None):
+    provider = get_provider('gpt-4o')
+    return await with_retries(provider_name(provider), lambda: asyncio.wait_for(provider.moderate(content), call_timeout(provider, timeout)))
+
+# Function to extract the outermost JSON object from a model reply
+def parse_json_object(text):
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        raise ValueError("No JSON object found in model response")
+    value = json.loads(text[start:end + 1])
+    if not isinstance(value, dict):
+        raise ValueError("Model response is not a JSON object")
+    return value
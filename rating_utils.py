@@ -0,0 +1,234 @@
+import argparse
+import json
+import logging
+import os
+import time
+import numpy as np
+from decimal import Decimal
+from storage import get_storage, VOTE_MAPPING
+
+# Elo scale: a 400 point gap means 10:1 odds, and the average model sits at 1200
+ELO_SCALE = 400
+ELO_BASE = 1200
+# Strength of the virtual opponent every model is assumed to have drawn against
+# once; keeps models with no wins (or no losses) at a finite rating
+PRIOR_GAMES = 1.0
+# Newton steps per rescaling of the strengths under the prior
+PRIOR_SCALE_STEPS = 4
+# Outcome index per mapped vote: 0 = ModelB won, 1 = tie, 2 = ModelA won
+VOTE_OUTCOMES = {"B is better": 0, "Tie": 1, "A is better": 2}
+
+# Where the incremental job keeps its counts and position between runs
+CHECKPOINT_PATH = os.environ.get('RATING_CHECKPOINT_PATH', os.path.join('rating_state', 'checkpoint.json'))
+# Votes are written behind (see vote_queue), so a vote can land with a Timestamp
+# older than votes already counted. Each run rereads this many seconds before
+# the checkpoint and skips the RequestIDs it has already counted. Votes stored
+# later than this (the flusher was down for longer) are logged and counted in
+# arena_late_votes_total, and picked up by the next full recompute.
+LATE_VOTE_SECONDS = Decimal(os.environ.get('RATING_LATE_VOTE_SECONDS', 3600))
+# Seconds between full recomputes that verify the incremental counts
+FULL_RECOMPUTE_SECONDS = float(os.environ.get('RATING_FULL_RECOMPUTE_SECONDS', 24 * 3600))
+
+# Function to summarize votes as counts per (ModelA, ModelB, outcome) cell.
+# Returns the sorted model ids and an array of shape (n_models, n_models, 3).
+def vote_counts(votes, models=None):
+    models = models or sorted({vote['ModelA'] for vote in votes} | {vote['ModelB'] for vote in votes})
+    index = {model: i for i, model in enumerate(models)}
+    n = len(models)
+    cells = np.fromiter(
+        ((index[vote['ModelA']] * n + index[vote['ModelB']]) * 3 + VOTE_OUTCOMES[VOTE_MAPPING.get(vote['Vote'], "Tie")]
+         for vote in votes), dtype=np.int64, count=len(votes))
+    return models, np.bincount(cells, minlength=n * n * 3).reshape(n, n, 3)
+
+# Function to turn cell counts of shape (..., n, n, 3) into win matrices of
+# shape (..., n, n); wins[i, j] is how often i beat j, ties counting half.
+def win_matrix(counts):
+    wins_a = counts[..., 2] + 0.5 * counts[..., 1]
+    wins_b = counts[..., 0] + 0.5 * counts[..., 1]
+    return wins_a + np.swapaxes(wins_b, -1, -2)
+
+# Function to get, per batch row, the factor that rescales strengths to best
+# fit the prior games against the strength-1 opponent. Rescaling every
+# strength leaves the likelihood of the real votes unchanged, so only the prior
+# decides it: the root u of sum(tanh((u + log s) / 2)) = 0, by Newton's method
+# from minus the mean log strength.
+def prior_scale(strength):
+    log_strength = np.log(strength)
+    u = -log_strength.mean(axis=1, keepdims=True)
+    for _ in range(PRIOR_SCALE_STEPS):
+        t = np.tanh((u + log_strength) / 2)
+        u -= t.sum(axis=1, keepdims=True) / (0.5 * (1 - t ** 2)).sum(axis=1, keepdims=True)
+    return np.exp(u)
+
+# Function to fit Bradley-Terry strengths for a batch of win matrices at once
+# with the minorization-maximization updates of Hunter (2004). wins has shape
+# (batch, n, n); returns Elo ratings of shape (batch, n). The virtual opponent
+# has strength 1 (Elo ELO_BASE) and anchors the scale, so the fixed point is
+# the maximum of the prior-regularized likelihood. Each update is followed by
+# the best rescaling under the prior (see prior_scale), which only speeds up
+# the weakly determined overall scale. initial_elo warm starts the fit from
+# earlier ratings, which cuts the iterations needed when only a few votes changed.
+def fit_bradley_terry(wins, iterations=500, tol=1e-9, initial_elo=None):
+    games = wins + np.swapaxes(wins, 1, 2)
+    total_wins = wins.sum(axis=2) + PRIOR_GAMES
+    if initial_elo is None:
+        strength = np.ones(wins.shape[:2])
+    else:
+        strength = np.broadcast_to(10 ** ((np.asarray(initial_elo, dtype=float) - ELO_BASE) / ELO_SCALE), wins.shape[:2])
+    for _ in range(iterations):
+        pair_sum = strength[:, :, None] + strength[:, None, :]
+        denominator = (games / pair_sum).sum(axis=2) + 2 * PRIOR_GAMES / (strength + 1)
+        updated = total_wins / denominator
+        updated *= prior_scale(updated)
+        # Relative change, since strengths span orders of magnitude
+        converged = np.max(np.abs(updated / strength - 1)) < tol
+        strength = updated
+        if converged:
+            break
+    return ELO_BASE + ELO_SCALE * np.log10(strength)
+
+# Function to compute 95% CIs by resampling votes with replacement. Votes only
+# matter through their (pair, outcome) cell, so resampling the vote log is the
+# same as drawing multinomial counts over the cells, which is done for every
+# resample in one call and fitted as one batch.
+def bootstrap_ratings(counts, rounds=1000, seed=None, initial_elo=None):
+    rng = np.random.default_rng(seed)
+    total = counts.sum()
+    samples = rng.multinomial(total, counts.ravel() / total, size=rounds).reshape((rounds,) + counts.shape)
+    ratings = fit_bradley_terry(win_matrix(samples), initial_elo=initial_elo)
+    return np.percentile(ratings, 2.5, axis=0), np.percentile(ratings, 97.5, axis=0)
+
+# Function to recompute ratings from vote counts and return leaderboard fields per model
+def compute_ratings(models, counts, rounds=1000, seed=None, initial_elo=None):
+    elo = fit_bradley_terry(win_matrix(counts)[None], initial_elo=initial_elo)[0]
+    # Resamples scatter around the point estimate, so it is a good start for them
+    ci_lower, ci_upper = bootstrap_ratings(counts, rounds, seed, initial_elo=elo)
+    return {model: {'EloScore': round(Decimal(float(elo[i])), 2),
+                    'CI_Lower': round(Decimal(float(ci_lower[i])), 2),
+                    'CI_Upper': round(Decimal(float(ci_upper[i])), 2)}
+            for i, model in enumerate(models)}
+
+# Function to resize a counts array from one model list to a superset of it
+def align_counts(models, counts, all_models):
+    index = [all_models.index(model) for model in models]
+    aligned = np.zeros((len(all_models), len(all_models), 3), dtype=np.int64)
+    aligned[np.ix_(index, index)] = counts
+    return aligned
+
+# Function to build a checkpoint holding the sufficient statistics for a set of votes
+def new_checkpoint(votes=()):
+    checkpoint = {'models': [], 'counts': np.zeros((0, 0, 3), dtype=np.int64),
+                  'timestamp': None, 'recent': {}, 'elo': {}, 'full_at': 0}
+    return add_votes(checkpoint, votes)
+
+# Function to fold votes into a checkpoint. Votes already counted (within the
+# late-vote window) are skipped, so overlapping reads are harmless.
+def add_votes(checkpoint, votes):
+    votes = [vote for vote in votes if vote['RequestID'] not in checkpoint['recent']]
+    if not votes:
+        return checkpoint
+    models = checkpoint['models']
+    all_models = sorted(set(models) | {vote['ModelA'] for vote in votes} | {vote['ModelB'] for vote in votes})
+    counts = align_counts(models, checkpoint['counts'], all_models) + vote_counts(votes, all_models)[1]
+
+    recent = dict(checkpoint['recent'])
+    recent.update((vote['RequestID'], vote['Timestamp']) for vote in votes)
+    latest = max(Decimal(timestamp) for timestamp in recent.values())
+    if checkpoint['timestamp'] is not None:
+        latest = max(latest, Decimal(checkpoint['timestamp']))
+    # Only the late-vote window can be read again, so older ids are dropped
+    horizon = latest - LATE_VOTE_SECONDS
+    recent = {request_id: timestamp for request_id, timestamp in recent.items() if Decimal(timestamp) >= horizon}
+    return {**checkpoint, 'models': all_models, 'counts': counts, 'timestamp': str(latest), 'recent': recent}
+
+# Function to get the Timestamp to read new votes from
+def checkpoint_since(checkpoint):
+    if checkpoint['timestamp'] is None:
+        return None
+    return str(Decimal(checkpoint['timestamp']) - LATE_VOTE_SECONDS)
+
+def load_checkpoint(path=CHECKPOINT_PATH):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    n = len(checkpoint['models'])
+    checkpoint['counts'] = np.array(checkpoint['counts'], dtype=np.int64).reshape(n, n, 3)
+    return checkpoint
+
+def save_checkpoint(checkpoint, path=CHECKPOINT_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({**checkpoint, 'counts': checkpoint['counts'].tolist()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Function to count votes that differ between two checkpoints' counts
+def count_mismatches(checkpoint, reference):
+    all_models = sorted(set(checkpoint['models']) | set(reference['models']))
+    counts = align_counts(checkpoint['models'], checkpoint['counts'], all_models)
+    reference_counts = align_counts(reference['models'], reference['counts'], all_models)
+    return int(np.abs(counts - reference_counts).sum())
+
+# Function to bring the checkpoint up to date and recompute ratings from it.
+# Normally only votes since the checkpoint are read; the whole table is read on
+# the first run, on request, or once FULL_RECOMPUTE_SECONDS have passed, and
+# the incremental counts are then checked against it and replaced.
+def refresh_ratings(rounds=1000, seed=None, full=False, path=CHECKPOINT_PATH):
+    checkpoint = load_checkpoint(path)
+    now = time.time()
+    if checkpoint is None or full or now - checkpoint['full_at'] >= FULL_RECOMPUTE_SECONDS:
+        votes = get_storage().load_votes()
+        reference = new_checkpoint(votes)
+        if checkpoint is not None:
+            # Catch up from the same read, so votes arriving mid-run do not show up as drift
+            since = checkpoint_since(checkpoint)
+            checkpoint = add_votes(checkpoint, [vote for vote in votes if since is None or vote['Timestamp'] >= since])
+            mismatches = count_mismatches(checkpoint, reference)
+            if mismatches:
+                logging.warning(f"Incremental rating counts drifted from a full recompute by {mismatches} votes; resetting")
+            else:
+                logging.info("Incremental rating counts match a full recompute")
+        checkpoint = {**reference, 'elo': checkpoint['elo'] if checkpoint else {}, 'full_at': now}
+        logging.info(f"Full recompute over {len(votes)} votes")
+    else:
+        since = checkpoint_since(checkpoint)
+        votes = get_storage().load_votes(since)
+        checkpoint = add_votes(checkpoint, votes)
+        logging.info(f"Incremental recompute: read {len(votes)} votes since {since}")
+
+    models = checkpoint['models']
+    if not models:
+        return checkpoint, {}
+    initial_elo = [checkpoint['elo'].get(model, ELO_BASE) for model in models]
+    ratings = compute_ratings(models, checkpoint['counts'], rounds, seed, initial_elo=initial_elo)
+    checkpoint['elo'] = {model: float(fields['EloScore']) for model, fields in ratings.items()}
+    return checkpoint, ratings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute Bradley-Terry ratings and bootstrap CIs from all votes.")
+    parser.add_argument('--rounds', type=int, default=1000, help="bootstrap resamples")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true', help="print ratings without writing them or the checkpoint")
+    parser.add_argument('--full', action='store_true', help="read every vote and verify the checkpoint against it")
+    parser.add_argument('--interval', type=float, default=None, help="keep running, refreshing every INTERVAL seconds")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    while True:
+        started = time.time()
+        checkpoint, ratings = refresh_ratings(args.rounds, args.seed, args.full, args.checkpoint)
+        for model, fields in sorted(ratings.items(), key=lambda item: item[1]['EloScore'], reverse=True):
+            print(f"{model:<28} {fields['EloScore']:>8} [{fields['CI_Lower']}, {fields['CI_Upper']}]")
+        if not args.dry_run:
+            get_storage().write_ratings(ratings)
+            save_checkpoint(checkpoint, args.checkpoint)
+        if args.interval is None:
+            break
+        args.full = False
+        time.sleep(max(0, args.interval - (time.time() - started)))
@@ -0,0 +1,154 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from dotenv import load_dotenv
+
+try:
+    load_dotenv()
+except:
+    pass
+
+import providers
+import scheduler
+from job_queue import get_job_queue
+from logging_config import setup_logging
+from upload_store import upload_store
+from utils import stream_paper
+
+# Pool of review worker processes behind the job queue. The web tier only
+# stores the upload and enqueues a job when REVIEW_JOBS=queue; these processes
+# run extraction and the reviews and write progress back for the page to poll:
+#   python review_worker.py --processes 4 --jobs-per-process 8
+# Workers can be started, stopped and restarted at any time; a job left by a
+# killed worker is taken over once its lease runs out.
+PAPER_DIR = 'path_to_temp_storage'
+PROMPT_DIR = 'iclr2024'
+API_KEYS = {
+    'openai_api_key': os.environ.get('OPENAI_API_KEY'),
+    'claude_api_key': os.environ.get('ANTHROPIC_API_KEY'),
+    'gemini_api_key': os.environ.get('GEMINI_API_KEY'),
+    'commandr_api_key': os.environ.get('COMMANDR_API_KEY')
+}
+# Seconds an idle worker waits before looking for a job again
+POLL_INTERVAL = float(os.environ.get('JOB_POLL_SECONDS', 0.5))
+# Minimum seconds between progress writes of one job
+PROGRESS_INTERVAL = 1.0
+# Seconds between purges of old finished jobs
+PURGE_INTERVAL = 3600
+# Seconds between reports of this process's model latencies and error rates
+HEALTH_INTERVAL = 30
+
+
+# Function to run one claimed job to completion, writing progress as sections arrive
+def run_job(jobs, job, worker):
+    job_id = job['JobID']
+    path = upload_store.path(job['PaperDigest'])
+    if not os.path.exists(path):
+        jobs.fail(job_id, worker, "upload no longer stored")
+        return
+    logging.info(f"Worker {worker} running job {job_id} (attempt {job['Attempts']}) with {job['Models']}")
+    written = None
+    last_write = 0
+    updates = stream_paper(path, PAPER_DIR, PROMPT_DIR, API_KEYS, job['UserID'], job['PaperDigest'], job['Models'])
+    try:
+        for reviews, models, done in updates:
+            if done:
+                jobs.complete(job_id, worker, reviews, models)
+                return
+            now = time.monotonic()
+            # Unchanged progress is still written now and then, to keep the lease
+            changed = (reviews, models) != written
+            if (changed and now - last_write >= PROGRESS_INTERVAL) or now - last_write >= jobs.lease_seconds / 3:
+                if not jobs.progress(job_id, worker, reviews, models):
+                    logging.warning(f"Worker {worker} lost job {job_id}")
+                    return
+                written = (reviews, models)
+                last_write = now
+    finally:
+        updates.close()
+
+# Function to claim and run jobs until the process exits
+def work(worker):
+    jobs = get_job_queue()
+    while True:
+        try:
+            job = jobs.claim(worker)
+        except Exception as e:
+            logging.error(f"Worker {worker} could not claim a job: {e}")
+            job = None
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        try:
+            run_job(jobs, job, worker)
+        except Exception as e:
+            logging.error(f"Job {job['JobID']} failed: {e!r}")
+            jobs.fail(job['JobID'], worker, repr(e))
+
+def purge_jobs():
+    while True:
+        try:
+            purged = get_job_queue().purge()
+            if purged:
+                logging.info(f"Purged {purged} finished jobs")
+        except Exception as e:
+            logging.error(f"Purging finished jobs failed: {e}")
+        time.sleep(PURGE_INTERVAL)
+
+# Function to share this process's model health through the job database;
+# the web tier weighs model pairs by it (see pair_sampling)
+def report_health(worker):
+    while True:
+        time.sleep(HEALTH_INTERVAL)
+        try:
+            report = providers.health_report()
+            if report:
+                get_job_queue().report_health(worker, report)
+        except Exception as e:
+            logging.error(f"Reporting model health failed: {e}")
+
+# Function to run one worker process: a thread per concurrent job, all
+# sharing the process's provider loop. The provider limits are split evenly
+# among the processes, so together they stay within them.
+def run_process(index, jobs_per_process, processes=1):
+    setup_logging()
+    scheduler.share_limits(processes)
+    threads = [threading.Thread(target=work, args=(f"{socket.gethostname()}-{os.getpid()}-{i}",), name=f'job-worker-{i}', daemon=True)
+               for i in range(jobs_per_process)]
+    threads.append(threading.Thread(target=report_health, args=(f"{socket.gethostname()}-{os.getpid()}",),
+                                    name='health-report', daemon=True))
+    if index == 0:
+        threads.append(threading.Thread(target=purge_jobs, name='job-purge', daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run review workers for queued arena jobs.")
+    # Reviews mostly wait on providers, so a few processes with many jobs each go further than one per core
+    parser.add_argument('--processes', type=int, default=2, help="worker processes; provider limits are split among them")
+    parser.add_argument('--jobs-per-process', type=int, default=4, help="jobs each process runs at once")
+    args = parser.parse_args()
+
+    setup_logging()
+    # Create the database before the workers race to
+    get_job_queue()
+    # Spawned rather than forked, since this process already runs the logging thread
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_process, args=(i, args.jobs_per_process, args.processes), name=f'review-worker-{i}')
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {args.processes} review worker processes, {args.jobs_per_process} jobs each")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from metrics_utils import span
+
+# Concurrency and per-minute request/token limits per provider; 0 means
+# unlimited. PROVIDER_LIMITS (JSON, same shape) overrides entries.
+DEFAULT_LIMITS = {
+    'openai': {'concurrency': 32, 'rpm': 500, 'tpm': 300000},
+    'anthropic': {'concurrency': 8, 'rpm': 50, 'tpm': 40000},
+    'cohere': {'concurrency': 16, 'rpm': 1000, 'tpm': 0},
+    'gemini': {'concurrency': 8, 'rpm': 60, 'tpm': 0},
+}
+FALLBACK_LIMITS = {'concurrency': 8, 'rpm': 0, 'tpm': 0}
+PROVIDER_LIMITS = {**DEFAULT_LIMITS, **json.loads(os.environ.get('PROVIDER_LIMITS') or '{}')}
+# Output tokens counted against the TPM budget for each call, on top of the prompt
+EXPECTED_OUTPUT_TOKENS = 1000
+# Seconds assumed per call until real calls have been timed
+INITIAL_CALL_SECONDS = 20.0
+
+# Processes the limits are split among; see share_limits
+_shares = 1
+_current_user = ContextVar('scheduler_user', default=None)
+_call_tracker = ContextVar('scheduler_call_tracker', default=None)
+_schedulers = {}
+
+
+# Continuously refilling budget of amount per minute
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    # Function to get the seconds until amount is available; 0 if it is now
+    def delay(self, amount):
+        if not self.capacity:
+            return 0
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # A single request larger than the whole budget only waits for a full bucket
+        return max(0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+
+class Waiter:
+    def __init__(self, user, tokens, future):
+        self.user = user
+        self.tokens = tokens
+        self.future = future
+
+
+# Admission control for one provider. Calls wait until a concurrency slot and
+# enough of both per-minute budgets are free. Waiting calls are kept in one
+# FIFO per user and users are served round-robin, so one large burst cannot
+# starve everyone else. All methods run on the provider event loop.
+class ProviderScheduler:
+    def __init__(self, name, concurrency, rpm, tpm):
+        self.name = name
+        self.concurrency = concurrency or float('inf')
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.queues = OrderedDict()
+        self.active = 0
+        self.call_seconds = INITIAL_CALL_SECONDS
+        self._timer = None
+
+    async def acquire(self, user, tokens):
+        waiter = Waiter(user, tokens, asyncio.get_running_loop().create_future())
+        self.queues.setdefault(user, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as the caller gave up
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+
+    def release(self, seconds=None):
+        self.active -= 1
+        if seconds is not None:
+            # Moving average of call time, used for ETAs
+            self.call_seconds = 0.8 * self.call_seconds + 0.2 * seconds
+        self._dispatch()
+
+    def _remove(self, waiter):
+        queue = self.queues.get(waiter.user)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[waiter.user]
+
+    def _dispatch(self):
+        while self.active < self.concurrency and self.queues:
+            user, queue = next(iter(self.queues.items()))
+            waiter = queue[0]
+            delay = max(self.requests.delay(1), self.tokens.delay(waiter.tokens))
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+            queue.popleft()
+            # Round-robin: the user goes to the back of the line
+            del self.queues[user]
+            if queue:
+                self.queues[user] = queue
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            self.active += 1
+            waiter.future.set_result(None)
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    # Function to estimate (calls ahead, seconds) until all of a user's queued calls have started
+    def queue_status(self, user):
+        mine = len(self.queues.get(user, ()))
+        if not mine:
+            return None
+        # Round-robin serves at most `mine` calls of every other user first
+        ahead = sum(min(len(queue), mine) for other, queue in self.queues.items() if other != user)
+        calls = ahead + mine
+        eta = calls / min(self.concurrency, calls) * self.call_seconds
+        if self.requests.capacity:
+            eta = max(eta, calls / self.requests.rate)
+        return ahead, eta
+
+
+def get_scheduler(name):
+    if name not in _schedulers:
+        limits = {**FALLBACK_LIMITS, **PROVIDER_LIMITS.get(name, {})}
+        # Every process keeps at least one slot of a limited provider
+        concurrency = max(1, limits['concurrency'] // _shares) if limits['concurrency'] else 0
+        _schedulers[name] = ProviderScheduler(name, concurrency, limits['rpm'] / _shares, limits['tpm'] / _shares)
+    return _schedulers[name]
+
+# Function to split every provider's limits evenly among this many processes
+# calling the providers with the same keys, such as a pool of review workers.
+# Call it before the first provider call.
+def share_limits(shares):
+    global _shares
+    _shares = max(1, shares)
+    _schedulers.clear()
+
+# Function to attribute calls made later in this context (thread or asyncio
+# task) to a user, for fair queuing
+def set_user(user):
+    _current_user.set(user)
+
+# Function to report calls made later in this context to tracker, e.g. to
+# pause a deadline while they are queued: tracker.update(waiting=n, running=n)
+# is called with the change in queued and in-flight calls
+def track_calls(tracker):
+    _call_tracker.set(tracker)
+
+# Function to hold a slot of the provider's scheduler for the duration of a call
+@asynccontextmanager
+async def slot(provider_name, system_role, prompt):
+    scheduler = get_scheduler(provider_name)
+    # About 4 characters per token; the budget only needs to be roughly right
+    tokens = (len(system_role) + len(prompt)) // 4 + EXPECTED_OUTPUT_TOKENS
+    tracker = _call_tracker.get()
+    if tracker is not None:
+        tracker.update(waiting=1)
+    try:
+        with span('queue_wait', provider=provider_name):
+            await scheduler.acquire(_current_user.get(), tokens)
+    except BaseException:
+        if tracker is not None:
+            tracker.update(waiting=-1)
+        raise
+    if tracker is not None:
+        tracker.update(waiting=-1, running=1)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        scheduler.release(time.monotonic() - started)
+        if tracker is not None:
+            tracker.update(running=-1)
+
+# Function to get a user's queue position and ETA across providers as
+# (calls ahead, seconds), or None when nothing of theirs is waiting. Must run
+# on the provider event loop.
+def queue_status(user):
+    statuses = [status for status in (scheduler.queue_status(user) for scheduler in _schedulers.values()) if status]
+    if not statuses:
+        return None
+    return max(ahead for ahead, _ in statuses), max(eta for _, eta in statuses)
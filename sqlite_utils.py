@@ -0,0 +1,162 @@
+import os
+import sqlite3
+import threading
+from decimal import Decimal
+from storage import Storage, VOTE_MAPPING, new_model_stats, apply_vote
+
+# Database file for the single-node backend
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'arena.db')
+
+# Decimals are stored as text so scores round-trip exactly like DynamoDB numbers
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    RequestID TEXT PRIMARY KEY,
+    Timestamp TEXT NOT NULL,
+    UserID TEXT,
+    PaperID TEXT,
+    ModelA TEXT NOT NULL,
+    ModelB TEXT NOT NULL,
+    Vote TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requests_timestamp ON requests (Timestamp);
+CREATE TABLE IF NOT EXISTS leaderboard (
+    ModelID TEXT PRIMARY KEY,
+    Wins INTEGER NOT NULL DEFAULT 0,
+    Losses INTEGER NOT NULL DEFAULT 0,
+    Ties INTEGER NOT NULL DEFAULT 0,
+    Votes INTEGER NOT NULL DEFAULT 0,
+    EloScore TEXT NOT NULL,
+    CI_Lower TEXT,
+    CI_Upper TEXT,
+    Version INTEGER NOT NULL DEFAULT 0,
+    Organization TEXT,
+    License TEXT,
+    KnowledgeCutoff TEXT
+);
+"""
+
+REQUEST_FIELDS = ['RequestID', 'Timestamp', 'UserID', 'PaperID', 'ModelA', 'ModelB', 'Vote']
+DECIMAL_FIELDS = ('EloScore', 'CI_Lower', 'CI_Upper')
+UPDATE_FIELDS = ['Wins', 'Losses', 'Ties', 'Votes', 'EloScore', 'CI_Lower', 'CI_Upper', 'Version']
+
+
+# Storage backend on a local SQLite database in WAL mode. Each thread gets its
+# own connection; readers never block the writer, and leaderboard updates take
+# the write lock up front so both rows change in one serialized transaction.
+# A recorded vote's request row is inserted in that same transaction, which
+# is what makes recording it twice a no-op.
+class SQLiteStorage(Storage):
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Transactions are managed explicitly with BEGIN/COMMIT
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode NORMAL survives application crashes; only a power loss
+            # can drop the last commits, and the vote log replays those
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def write_requests(self, items):
+        # Replace, like put_item, so replayed batches are harmless
+        self.transaction(lambda conn: conn.executemany(
+            f"INSERT OR REPLACE INTO requests ({', '.join(REQUEST_FIELDS)}) VALUES ({', '.join('?' * len(REQUEST_FIELDS))})",
+            [[item.get(field) for field in REQUEST_FIELDS] for item in items]))
+
+    def update_leaderboard(self, model_a, model_b, vote):
+        return self.transaction(lambda conn: self._apply_vote(conn, model_a, model_b, vote))
+
+    def record_vote(self, item):
+        def record(conn):
+            # Only a duplicate RequestID is ignored; a row that breaks another
+            # constraint (a missing model) still raises
+            cursor = conn.execute(
+                f"INSERT INTO requests ({', '.join(REQUEST_FIELDS)}) VALUES ({', '.join('?' * len(REQUEST_FIELDS))}) "
+                f"ON CONFLICT (RequestID) DO NOTHING",
+                [item.get(field) for field in REQUEST_FIELDS])
+            if cursor.rowcount == 0:
+                return None
+            return self._apply_vote(conn, item['ModelA'], item['ModelB'], item['Vote'])
+        return self.transaction(record)
+
+    # Function to run fn(conn) in one transaction. BEGIN IMMEDIATE takes the
+    # write lock before any read, so no other vote can change the rows fn
+    # reads before it writes them.
+    def transaction(self, fn):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def _apply_vote(self, conn, model_a, model_b, vote):
+        vote = VOTE_MAPPING.get(vote, "Tie")  # Default to "Tie" if vote is not found
+        rows = {row['ModelID']: to_item(row) for row in conn.execute(
+            'SELECT * FROM leaderboard WHERE ModelID IN (?, ?)', (model_a, model_b))}
+        updated_a, updated_b = apply_vote(rows.get(model_a) or new_model_stats(model_a),
+                                          rows.get(model_b) or new_model_stats(model_b), vote)
+        for updated in (updated_a, updated_b):
+            conn.execute(
+                f"INSERT INTO leaderboard (ModelID, {', '.join(UPDATE_FIELDS)}) VALUES (?{', ?' * len(UPDATE_FIELDS)}) "
+                f"ON CONFLICT (ModelID) DO UPDATE SET {', '.join(f'{field} = excluded.{field}' for field in UPDATE_FIELDS)}",
+                [updated['ModelID']] + [to_column(field, updated[field]) for field in UPDATE_FIELDS])
+        # Return the updated rows so cached leaderboards can be patched without a read
+        return [updated_a, updated_b]
+
+    # A busy or locked database is worth retrying; constraint violations are not
+    def is_transient(self, error):
+        return isinstance(error, sqlite3.OperationalError) or super().is_transient(error)
+
+    def get_leaderboard(self):
+        leaderboard = [to_item(row) for row in self.connection().execute('SELECT * FROM leaderboard')]
+        # Sort by EloScore in descending order
+        leaderboard.sort(key=lambda x: x['EloScore'], reverse=True)
+        return leaderboard
+
+    def load_votes(self, since=None):
+        query = 'SELECT RequestID, Timestamp, ModelA, ModelB, Vote FROM requests'
+        params = ()
+        if since is not None:
+            # Timestamps compare as strings, the same way the DynamoDB filter does
+            query += ' WHERE Timestamp >= ?'
+            params = (since,)
+        return [dict(row) for row in self.connection().execute(query, params)]
+
+    def write_ratings(self, ratings):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for model, fields in ratings.items():
+                conn.execute(
+                    "INSERT INTO leaderboard (ModelID, EloScore, CI_Lower, CI_Upper, Version) VALUES (?, ?, ?, ?, 1) "
+                    "ON CONFLICT (ModelID) DO UPDATE SET EloScore = excluded.EloScore, CI_Lower = excluded.CI_Lower, "
+                    "CI_Upper = excluded.CI_Upper, Version = Version + 1",
+                    [model] + [to_column(field, fields[field]) for field in DECIMAL_FIELDS])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+# Function to convert a leaderboard row to an item shaped like a DynamoDB one;
+# unset optional columns are left out rather than returned as None
+def to_item(row):
+    item = {key: row[key] for key in row.keys() if row[key] is not None}
+    for field in DECIMAL_FIELDS:
+        if field in item:
+            item[field] = Decimal(item[field])
+    return item
+
+def to_column(field, value):
+    return str(value) if field in DECIMAL_FIELDS else value
@@ -0,0 +1,74 @@
+import builtins
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# File the startup profile is written to as JSON; empty turns profiling off
+PROFILE_PATH = os.environ.get('STARTUP_PROFILE_PATH', 'startup_profile.json')
+# Slowest imports kept in the profile
+TOP_IMPORTS = 30
+
+_original_import = builtins.__import__
+_lock = threading.Lock()
+_imports = {}
+_phases = []
+_started = None
+_depth = threading.local()
+
+
+# Replacement for __import__ that times the first import of each module. Times
+# are cumulative, so a package includes everything it imports; depth 0 marks
+# imports made by the module that called start().
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    depth = getattr(_depth, 'value', 0)
+    _depth.value = depth + 1
+    started = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth.value = depth
+        with _lock:
+            _imports.setdefault(name, (time.perf_counter() - started, depth))
+
+# Function to start profiling; call it before the imports worth measuring
+def start():
+    global _started
+    if not PROFILE_PATH or _started is not None:
+        return
+    _started = time.perf_counter()
+    builtins.__import__ = _timed_import
+
+# Function to record that a startup phase ended, e.g. 'imports' or 'interface';
+# it is timed from the end of the previous phase
+def phase(name):
+    if _started is not None:
+        elapsed = time.perf_counter() - _started
+        _phases.append((name, elapsed - sum(seconds for _, seconds in _phases)))
+
+# Function to stop profiling and write the profile; returns seconds since start()
+def finish():
+    global _started
+    if _started is None:
+        return None
+    builtins.__import__ = _original_import
+    total = time.perf_counter() - _started
+    _started = None
+    with _lock:
+        imports = sorted(_imports.items(), key=lambda item: item[1][0], reverse=True)[:TOP_IMPORTS]
+    profile = {'total_seconds': total,
+               'phases': [{'name': name, 'seconds': seconds} for name, seconds in _phases],
+               'imports': [{'module': module, 'seconds': seconds, 'depth': depth} for module, (seconds, depth) in imports]}
+    try:
+        with open(PROFILE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(profile, f, indent=2)
+    except OSError as e:
+        logging.error(f"Writing startup profile failed: {e}")
+    phases = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in _phases)
+    slowest = [f"{module} {seconds:.2f}s" for module, (seconds, depth) in imports if depth == 0][:5]
+    logging.info(f"Ready in {total:.2f}s ({phases}); slowest imports: {', '.join(slowest)}")
+    return total
@@ -0,0 +1,180 @@
+import datetime
+import os
+import threading
+import uuid
+from decimal import Decimal, getcontext
+from dotenv import load_dotenv
+
+try:
+    load_dotenv()
+except:
+    pass
+
+# Storage backend for votes and the leaderboard: 'dynamodb' or 'sqlite'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'dynamodb')
+
+# Map vote options to simpler keys
+VOTE_MAPPING = {
+    "👍 A is better": "A is better",
+    "👍 B is better": "B is better",
+    "👔 Tie": "Tie",
+    "👎 Both are bad": "Tie"  # Assuming "Both are bad" is treated as a tie
+}
+
+# Counter incremented for ModelA and ModelB by each vote
+VOTE_COUNTERS = {
+    "A is better": ('Wins', 'Losses'),
+    "B is better": ('Losses', 'Wins'),
+    "Tie": ('Ties', 'Ties')
+}
+
+# Set the precision for Decimal
+getcontext().prec = 28
+
+
+# Raised when a leaderboard update kept losing races to concurrent votes;
+# retrying it later is expected to succeed
+class LeaderboardConflict(RuntimeError):
+    pass
+
+
+# Interface shared by the storage backends. Requests are vote records built by
+# build_request_item; leaderboard rows are dicts keyed like the DynamoDB items.
+class Storage:
+    # Function to write a batch of request items. Items keep their RequestID,
+    # so writing the same item twice must be harmless.
+    def write_requests(self, items):
+        raise NotImplementedError
+
+    # Function to write a request to the Requests table
+    def write_request(self, user_id, paper_id, model_a, model_b, vote):
+        self.write_requests([build_request_item(user_id, paper_id, model_a, model_b, vote)])
+
+    # Function to update both models' rows for a vote as one atomic change;
+    # returns the updated rows
+    def update_leaderboard(self, model_a, model_b, vote):
+        raise NotImplementedError
+
+    # Function to store a vote's request item and apply it to both models'
+    # rows as one atomic change. Returns the updated rows, or None if a vote
+    # with the item's RequestID was already recorded, so replays are harmless.
+    def record_vote(self, item):
+        raise NotImplementedError
+
+    # Function to get all leaderboard rows sorted by EloScore
+    def get_leaderboard(self):
+        raise NotImplementedError
+
+    # Function to load votes, optionally only those with a Timestamp at or after since
+    def load_votes(self, since=None):
+        raise NotImplementedError
+
+    # Function to overwrite EloScore and CI per model with recomputed ratings
+    def write_ratings(self, ratings):
+        raise NotImplementedError
+
+    # Function to check whether an error raised by this backend is worth
+    # retrying (throttling, a conflict, a lost connection) rather than caused
+    # by the data written
+    def is_transient(self, error):
+        return isinstance(error, (ConnectionError, TimeoutError, LeaderboardConflict))
+
+
+_storage = None
+_lock = threading.Lock()
+
+# Function to get the configured backend, created on first use. Backends are
+# imported here so a deployment only loads the client library it uses.
+def get_storage():
+    global _storage
+    with _lock:
+        if _storage is None:
+            if STORAGE_BACKEND == 'dynamodb':
+                from aws_utils import DynamoDBStorage
+                _storage = DynamoDBStorage()
+            elif STORAGE_BACKEND == 'sqlite':
+                from sqlite_utils import SQLiteStorage
+                _storage = SQLiteStorage()
+            else:
+                raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+        return _storage
+
+# Function to get the UTC day ("2024-06-01") of a vote Timestamp. Votes are
+# indexed by day and Timestamp, so new votes can be queried without a scan.
+def vote_day(timestamp):
+    return datetime.datetime.fromtimestamp(float(timestamp), datetime.timezone.utc).strftime('%Y-%m-%d')
+
+# Function to build a Requests table item for a vote
+def build_request_item(user_id, paper_id, model_a, model_b, vote):
+    request_id = str(uuid.uuid4())
+    timestamp = str(Decimal(datetime.datetime.now().timestamp()))
+    return {
+        'RequestID': request_id,
+        'Timestamp': timestamp,
+        'VoteDay': vote_day(timestamp),
+        'UserID': user_id,
+        'PaperID': paper_id,
+        'ModelA': model_a,
+        'ModelB': model_b,
+        'Vote': vote
+    }
+
+# Function to get the row of a model that has not been voted on yet
+def new_model_stats(model_id):
+    return {'ModelID': model_id, 'Wins': 0, 'Losses': 0, 'Ties': 0, 'EloScore': Decimal(1200), 'Votes': 0}
+
+# Function to compute both models' rows after a mapped vote. Each row's Version
+# is bumped so backends can detect concurrent writers.
+def apply_vote(model_a_stats, model_b_stats, vote):
+    # Rows created by a rating recompute may not have counters yet
+    model_a_stats = {'Wins': 0, 'Losses': 0, 'Ties': 0, 'Votes': 0, **model_a_stats}
+    model_b_stats = {'Wins': 0, 'Losses': 0, 'Ties': 0, 'Votes': 0, **model_b_stats}
+    counter_a, counter_b = VOTE_COUNTERS[vote]
+
+    # Calculate new Elo scores (simple Elo calculation for illustration)
+    new_elo_a, new_elo_b = calculate_elo(model_a_stats['EloScore'], model_b_stats['EloScore'], vote)
+
+    # Calculate 95% CI for new Elo scores
+    ci_a_lower, ci_a_upper = calculate_95_ci(new_elo_a, model_a_stats['Votes'] + 1)
+    ci_b_lower, ci_b_upper = calculate_95_ci(new_elo_b, model_b_stats['Votes'] + 1)
+
+    updated_a = {**model_a_stats, counter_a: model_a_stats[counter_a] + 1, 'Votes': model_a_stats['Votes'] + 1,
+                 'EloScore': Decimal(new_elo_a), 'CI_Lower': Decimal(ci_a_lower), 'CI_Upper': Decimal(ci_a_upper),
+                 'Version': model_a_stats.get('Version', 0) + 1}
+    updated_b = {**model_b_stats, counter_b: model_b_stats[counter_b] + 1, 'Votes': model_b_stats['Votes'] + 1,
+                 'EloScore': Decimal(new_elo_b), 'CI_Lower': Decimal(ci_b_lower), 'CI_Upper': Decimal(ci_b_upper),
+                 'Version': model_b_stats.get('Version', 0) + 1}
+    return updated_a, updated_b
+
+# Function to calculate new Elo scores
+def calculate_elo(elo_a, elo_b, vote, k=32):
+    # Ensure elo_a and elo_b are Decimals
+    elo_a = Decimal(elo_a)
+    elo_b = Decimal(elo_b)
+
+    expected_a = 1 / (1 + Decimal(10) ** ((elo_b - elo_a) / Decimal(400)))
+    expected_b = 1 / (1 + Decimal(10) ** ((elo_a - elo_b) / Decimal(400)))
+
+    if vote == "A is better":
+        actual_a = Decimal(1)
+        actual_b = Decimal(0)
+    elif vote == "B is better":
+        actual_a = Decimal(0)
+        actual_b = Decimal(1)
+    else:  # Tie
+        actual_a = Decimal(0.5)
+        actual_b = Decimal(0.5)
+
+    new_elo_a = elo_a + Decimal(k) * (actual_a - expected_a)
+    new_elo_b = elo_b + Decimal(k) * (actual_b - expected_b)
+
+    return round(new_elo_a, 2), round(new_elo_b, 2)
+
+# Function to calculate 95% CI for Elo scores
+def calculate_95_ci(elo, votes, z=1.96):
+    if votes == 0:
+        return Decimal(0), Decimal(0)
+    elo = Decimal(elo)  # Ensure elo is a Decimal
+    std_error = Decimal(400) / (Decimal(votes).sqrt())
+    margin = Decimal(z) * std_error
+    return round(elo - margin, 2), round(elo + margin, 2)
@@ -0,0 +1,138 @@
+import pytest
+import paper_compression
+from paper_compression import clean_text, compress_paper, parse_heading, split_sections
+
+NUMBERED_PAPER = """Learning to Review
+Alice Smith, Bob Jones
+Abstract
+We propose a method.
+1 Introduction
+Reviews matter.
+2 Method
+2.1 Setup
+We ran the setup.
+12 Monkeys were observed in the study.
+3 Conclusion
+It works.
+Acknowledgments
+We thank everyone.
+References
+A. Smith. A paper title, 2020.
+B. Jones and C. Lee. Another paper. In Proc. 2021.
+A Proofs
+The proof.
+A.1 Lemma
+More proof.
+B Extra Results
+Tables."""
+
+
+def outline(text):
+    return [(section.kind, section.title) for section in split_sections(text)]
+
+
+def test_numbered_paper_outline():
+    assert outline(NUMBERED_PAPER) == [
+        ('front', None),
+        ('key', '1 Introduction'),
+        ('body', '2 Method'),
+        ('body', '2.1 Setup'),
+        ('key', '3 Conclusion'),
+        ('acknowledgements', 'Acknowledgments'),
+        ('references', 'References'),
+        ('appendix', 'A Proofs'),
+        ('appendix', 'A.1 Lemma'),
+        ('appendix', 'B Extra Results'),
+    ]
+
+def test_abstract_heading_stays_in_front_matter():
+    front = split_sections(NUMBERED_PAPER)[0]
+    assert front.lines == ['Learning to Review', 'Alice Smith, Bob Jones', 'Abstract', 'We propose a method.']
+
+def test_body_line_starting_with_a_number_is_not_a_heading():
+    setup = split_sections(NUMBERED_PAPER)[3]
+    assert '12 Monkeys were observed in the study.' in setup.lines
+
+def test_reference_entries_are_not_headings():
+    references = split_sections(NUMBERED_PAPER)[6]
+    assert references.lines[1:] == ['A. Smith. A paper title, 2020.', 'B. Jones and C. Lee. Another paper. In Proc. 2021.']
+
+@pytest.mark.parametrize('line, last_number, in_appendix, expected', [
+    ('1 Introduction', None, False, ('1', 'Introduction')),
+    ('4.2. Ablations', '4.1', False, ('4.2', 'Ablations')),
+    ('5 Discussion', '3', False, None),  # skips a number
+    ('2 Method', '3.1', False, None),  # goes back
+    ('A. Smith', None, True, None),  # a reference entry
+    ('A Proofs', None, False, None),  # letters only in appendices
+    ('B Proofs', '4', True, None),  # appendices start at A
+    ('B.1 Proofs', 'A.2', True, ('B.1', 'Proofs')),
+    ('3 We show that the bound holds for all inputs considered here', '2', False, None),  # a wrapped sentence
+    ('Broader Impact:', '5', False, (None, 'Broader Impact')),
+])
+def test_parse_heading(line, last_number, in_appendix, expected):
+    assert parse_heading(line, last_number, in_appendix) == expected
+
+def test_unnumbered_headings():
+    text = "Title\nIntroduction text.\nBroader Impact\nNone.\nBibliography\n[1] Someone. 2020."
+    assert outline(text) == [('front', None), ('statement', 'Broader Impact'), ('references', 'Bibliography')]
+
+def test_paper_without_references_heading():
+    text = "Title\n1 Introduction\nText.\n2 Results\nMore text.\nA Proofs\nNot an appendix without references."
+    sections = split_sections(text)
+    assert [(section.kind, section.title) for section in sections] == [
+        ('front', None), ('key', '1 Introduction'), ('body', '2 Results')]
+    # The lettered line stays body text, since nothing has started the appendices
+    assert sections[-1].lines[-2:] == ['A Proofs', 'Not an appendix without references.']
+
+def test_clean_text_drops_running_headers_and_page_numbers():
+    header = "Under review as a conference paper at ICLR 2024"
+    bodies = ["We study reviews.", "Our method is simple.", "It uses two models.", "Results are good.", "We conclude."]
+    pages = [f"{header}\n{body}\n{i}" for i, body in enumerate(bodies, start=1)]
+    cleaned = clean_text('\n'.join(pages) + "\nPage 6 of 6")
+    assert cleaned.split('\n') == bodies
+
+def test_clean_text_drops_headers_that_differ_only_in_numbers():
+    pages = [f"Smith et al. (2024), page {i}\nText {'abcde'[i]}." for i in range(5)]
+    assert clean_text('\n'.join(pages)).split('\n') == [f"Text {letter}." for letter in 'abcde']
+
+def test_clean_text_keeps_lines_seen_a_few_times():
+    text = "\n".join(["Table 1: Accuracy of the model."] * 3 + ["Other text."])
+    assert clean_text(text).count("Table 1: Accuracy of the model.") == 3
+
+def test_clean_text_joins_hyphenated_words_and_blank_runs():
+    assert clean_text("we ran experi-\nments   here\n\n\n\nnext  paragraph") == "we ran experiments here\n\nnext paragraph"
+
+
+# Words as tokens, so budgets are easy to reason about without the BPE files
+@pytest.fixture
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(paper_compression, 'encode', lambda text: text.split())
+    monkeypatch.setattr(paper_compression, 'decode', lambda tokens: ' '.join(tokens))
+
+def test_compress_drops_references_and_acknowledgements(word_tokens):
+    compressed, stats = compress_paper(NUMBERED_PAPER)
+    assert 'A. Smith. A paper title' not in compressed and 'We thank everyone.' not in compressed
+    assert '[References omitted]' in compressed and '[Acknowledgments omitted]' in compressed
+    assert stats['dropped_sections'] == 2 and stats['tokens_after'] < stats['tokens_before']
+
+def test_compress_keeps_priority_sections_within_budget(word_tokens, monkeypatch):
+    monkeypatch.setattr(paper_compression, 'MIN_PARTIAL_TOKENS', 1000)
+    body = ' '.join(['word'] * 300)
+    text = f"Title\nAbstract\nShort abstract.\n1 Introduction\nIntro.\n2 Method\n{body}\n3 Conclusion\nDone."
+    compressed, stats = compress_paper(text, budget=200)
+    assert stats['tokens_after'] <= 200
+    assert 'Intro.' in compressed and 'Done.' in compressed and '[2 Method omitted]' in compressed
+    # Sections stay in document order
+    assert compressed.index('Intro.') < compressed.index('[2 Method omitted]') < compressed.index('Done.')
+
+def test_paper_is_tokenized_once_per_budget(monkeypatch):
+    import token_utils
+    encoded = []
+    monkeypatch.setattr(token_utils, 'encode', lambda text: encoded.append(text) or text.split())
+    monkeypatch.setattr(token_utils, 'decode', lambda tokens: ' '.join(tokens))
+    token_budget = token_utils.TokenBudget('gpt-4o')
+    compressed, stats = compress_paper(NUMBERED_PAPER, budget=1000, token_budget=token_budget)
+    prompt, count = token_budget.build("Question\n####\n", compressed, "\n####", truncate=1)
+    # Sections, notes and delimiters are each encoded once; the compressed text is not encoded again
+    assert len(encoded) == len(set(encoded)) and compressed not in encoded
+    assert count == len(prompt.split()) and stats['tokens_after'] == len(compressed.split())
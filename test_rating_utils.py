@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import rating_utils
+from rating_utils import ELO_BASE, ELO_SCALE, PRIOR_GAMES
+
+
+# Function to get, per model, the derivative of the prior-regularized
+# log-likelihood with respect to log strength; zero at the maximum
+def score(wins, elo):
+    strength = 10 ** ((elo - ELO_BASE) / ELO_SCALE)
+    games = wins + wins.T
+    expected = (games * strength[:, None] / (strength[:, None] + strength[None, :])).sum(axis=1)
+    return wins.sum(axis=1) + PRIOR_GAMES - expected - 2 * PRIOR_GAMES * strength / (strength + 1)
+
+def fit(wins, **kwargs):
+    return rating_utils.fit_bradley_terry(np.asarray(wins, dtype=float)[None], **kwargs)[0]
+
+
+@pytest.mark.parametrize('wins', [
+    [[0, 1], [1, 0]],
+    [[0, 9], [1, 0]],
+    [[0, 900], [100, 0]],
+    [[0, 5, 0], [0, 0, 5], [0, 0, 0]],
+    [[0, 30, 60, 10], [20, 0, 40, 5], [3, 10, 0, 8], [12, 40, 30, 0]],
+])
+def test_fit_is_the_regularized_maximum(wins):
+    wins = np.asarray(wins, dtype=float)
+    assert np.abs(score(wins, fit(wins))).max() < 1e-6
+
+def test_even_record_rates_at_base():
+    assert fit([[0, 7], [7, 0]]) == pytest.approx([ELO_BASE, ELO_BASE])
+
+def test_large_samples_approach_the_win_ratio():
+    elo = fit([[0, 9000], [1000, 0]])
+    assert elo[0] - elo[1] == pytest.approx(ELO_SCALE * np.log10(9), abs=1)
+
+def test_unbeaten_model_stays_finite():
+    elo = fit([[0, 5, 5], [0, 0, 5], [0, 0, 0]])
+    assert np.isfinite(elo).all()
+    assert elo[0] > elo[1] > elo[2]
+
+def test_batch_rows_are_fitted_independently():
+    a = [[0, 9], [1, 0]]
+    b = [[0, 2], [6, 0]]
+    batch = rating_utils.fit_bradley_terry(np.array([a, b], dtype=float))
+    assert batch[0] == pytest.approx(fit(a))
+    assert batch[1] == pytest.approx(fit(b))
+
+def test_warm_start_gives_the_same_fit():
+    wins = [[0, 30, 60], [20, 0, 40], [3, 10, 0]]
+    assert fit(wins, initial_elo=[1500, 1000, 900]) == pytest.approx(fit(wins), abs=1e-6)
+
+def test_bootstrap_interval_brackets_the_estimate():
+    votes = ([{'ModelA': 'a', 'ModelB': 'b', 'Vote': "👍 A is better"}] * 30 +
+             [{'ModelA': 'a', 'ModelB': 'b', 'Vote': "👍 B is better"}] * 10 +
+             [{'ModelA': 'b', 'ModelB': 'c', 'Vote': "👔 Tie"}] * 20)
+    models, counts = rating_utils.vote_counts(votes)
+    elo = fit(rating_utils.win_matrix(counts))
+    lower, upper = rating_utils.bootstrap_ratings(counts, rounds=200, seed=0)
+    assert (lower <= elo).all() and (elo <= upper).all()
+    again = rating_utils.bootstrap_ratings(counts, rounds=200, seed=0)
+    assert again[0] == pytest.approx(lower) and again[1] == pytest.approx(upper)
+
+
+class EmptyStorage:
+    def load_votes(self, since=None):
+        return []
+
+def test_checkpoint_without_votes(tmp_path, monkeypatch):
+    monkeypatch.setattr(rating_utils, 'get_storage', EmptyStorage)
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint, ratings = rating_utils.refresh_ratings(rounds=10, path=path)
+    assert ratings == {}
+    assert checkpoint['models'] == [] and checkpoint['counts'].shape == (0, 0, 3)
+
+    rating_utils.save_checkpoint(checkpoint, path)
+    loaded = rating_utils.load_checkpoint(path)
+    assert loaded['models'] == [] and loaded['counts'].shape == (0, 0, 3)
+    assert rating_utils.checkpoint_since(loaded) is None
+    # The next run is incremental and still finds nothing to rate
+    checkpoint, ratings = rating_utils.refresh_ratings(rounds=10, path=path)
+    assert ratings == {}
@@ -0,0 +1,82 @@
+import functools
+import logging
+
+# All counting uses the GPT-4 BPE. Models with other tokenizers get a ratio of
+# their tokens per cl100k token so the budget errs on the safe side.
+DEFAULT_ENCODING = 'cl100k_base'
+
+# Context window, tokens reserved for the completion and tokens-per-cl100k-token ratio per model
+MODEL_LIMITS = {
+    'gpt-4-turbo-2024-04-09': (128000, 4096, 1.0),
+    'gpt-4o': (128000, 4096, 1.0),
+    'claude-3-opus-20240229': (200000, 4096, 1.2),
+    'gemini-pro': (30720, 0, 1.1),  # 30720 is the input limit; output has its own 2048 budget
+    'command-r-plus': (128000, 4000, 1.1),
+}
+DEFAULT_LIMIT = (128000, 4096, 1.0)
+# Upper bound on characters per cl100k token, used to stop PDF extraction early
+MAX_CHARS_PER_TOKEN = 8
+
+# Function to load a BPE; tiktoken is imported on first use since loading it is slow
+@functools.lru_cache(maxsize=None)
+def get_encoding(name=DEFAULT_ENCODING):
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+def encode(text, encoding_name=DEFAULT_ENCODING):
+    return get_encoding(encoding_name).encode_ordinary(text)
+
+def decode(tokens, encoding_name=DEFAULT_ENCODING):
+    return get_encoding(encoding_name).decode(tokens)
+
+# Function to get the prompt budget of a model, in cl100k tokens
+def prompt_token_limit(model):
+    context, reserved_output, ratio = MODEL_LIMITS.get(model, DEFAULT_LIMIT)
+    return int((context - reserved_output) / ratio)
+
+# Function to get how many characters of paper text can possibly fit a model's budget
+def prompt_char_limit(model):
+    return prompt_token_limit(model) * MAX_CHARS_PER_TOKEN
+
+
+# Prompt budget of one model for one review. Every text it counts is encoded
+# once and kept for the budget's lifetime, so the paper, which is in several
+# prompts, is only tokenized once per review and freed with it.
+class TokenBudget:
+    def __init__(self, model, reserved_text=''):
+        self.model = model
+        self._tokens = {}
+        self.limit = prompt_token_limit(model) - self.count(reserved_text)
+
+    def encode(self, text):
+        tokens = self._tokens.get(text)
+        if tokens is None:
+            tokens = self._tokens[text] = encode(text)
+        return tokens
+
+    # Function to record tokens already known to decode to text, so it is not encoded again
+    def remember(self, text, tokens):
+        self._tokens[text] = tokens
+
+    def count(self, text):
+        return len(self.encode(text))
+
+    def decode_prefix(self, text, length):
+        return decode(self.encode(text)[:length])
+
+    # Function to join prompt pieces into a prompt that fits the budget. When
+    # over budget the piece at index `truncate` (default: the last one) is cut
+    # from its end. Returns the prompt and its token count.
+    def build(self, *parts, truncate=None):
+        counts = [self.count(part) for part in parts]
+        total = sum(counts)
+        if total <= self.limit:
+            return ''.join(parts), total
+
+        if truncate is None:
+            truncate = len(parts) - 1
+        keep = max(counts[truncate] - (total - self.limit), 0)
+        parts = list(parts)
+        parts[truncate] = self.decode_prefix(parts[truncate], keep)
+        logging.debug(f"Prompt truncated for {self.model}: {total} -> {total - counts[truncate] + keep} tokens")
+        return ''.join(parts), total - counts[truncate] + keep
@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+# Store settings, overridable from the environment
+UPLOAD_STORE_DIR = os.environ.get('UPLOAD_STORE_DIR', 'upload_store')
+UPLOAD_STORE_MAX_BYTES = int(os.environ.get('UPLOAD_STORE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+UPLOAD_STORE_TTL = float(os.environ.get('UPLOAD_STORE_TTL', 7 * 24 * 3600))
+# Seconds between garbage collections, which run in the background after an upload
+GC_INTERVAL = float(os.environ.get('UPLOAD_STORE_GC_SECONDS', 600))
+CHUNK_SIZE = 1024 * 1024
+# Partial writes older than this were abandoned by a crashed worker
+STALE_TMP_SECONDS = 3600
+
+
+# Content-addressed store of uploaded PDFs. Each upload is hashed (SHA-512)
+# while it is copied in, in one pass, and kept once under its digest however
+# often it is uploaded. A file's mtime is its last upload; garbage collection
+# drops files past the TTL and then the least recently uploaded ones until
+# the store fits in max_bytes.
+class UploadStore:
+    def __init__(self, root=UPLOAD_STORE_DIR, max_bytes=UPLOAD_STORE_MAX_BYTES, ttl=UPLOAD_STORE_TTL, gc_interval=GC_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.gc_interval = gc_interval
+        self._lock = threading.Lock()
+        self._last_gc = 0
+        self._collecting = False
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], f"{digest}.pdf")
+
+    # Function to add an upload, given as a path or a binary file object; returns its digest
+    def put_file(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                return self.put_file(f)
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        digest = hashlib.sha512()
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            path = self.path(digest)
+            try:
+                # Already stored: only mark it as recently used
+                os.utime(path)
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.maybe_gc()
+        return digest
+
+    # Function to read a stored upload; None once it has been collected
+    def read(self, digest):
+        try:
+            with open(self.path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def maybe_gc(self):
+        with self._lock:
+            if self._collecting or time.time() - self._last_gc < self.gc_interval:
+                return
+            self._collecting = True
+        threading.Thread(target=self.gc, name='upload-gc', daemon=True).start()
+
+    # Function to delete expired and least recently uploaded files; returns (files, bytes) freed
+    def gc(self):
+        freed_files = freed_bytes = 0
+        try:
+            now = time.time()
+            entries = []
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if name.endswith('.pdf'):
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                    elif now - stat.st_mtime > STALE_TMP_SECONDS:
+                        entries.append((0, stat.st_size, path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                if now - mtime <= self.ttl and total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                freed_files += 1
+                freed_bytes += size
+            if freed_files:
+                logging.info(f"Upload store GC freed {freed_files} files ({freed_bytes} bytes)")
+        except Exception as e:
+            logging.error(f"Upload store GC failed: {e}")
+        finally:
+            with self._lock:
+                self._last_gc = time.time()
+                self._collecting = False
+        return freed_files, freed_bytes
+
+upload_store = UploadStore()
@@ -1,60 +1,303 @@
-import fitz
 import os
 import logging
 import random
+import asyncio
+import hashlib
+import queue
+import time
+import providers
+import scheduler
 from models import Paper, PaperProcessor
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
+from cache_utils import review_cache, review_cache_key, prompt_set_version, moderation_cache
+from pdf_utils import extract_text
+from token_utils import prompt_char_limit
+from metrics_utils import span, set_trace
+from pair_sampling import pair_sampler
+from logging_config import log_payload
 
-def extract_text_from_pdf(filename):
-    with fitz.open(filename) as pdf_document:
-        text = ""
-        for page in pdf_document:
-            text += page.get_text()
-    return text.encode('latin-1', 'replace').decode('latin-1')
+# Models a paper can be reviewed by; each upload gets the two pair_sampler picks
+MODELS = ['gpt-4-turbo-2024-04-09', 'gpt-4o', 'claude-3-opus-20240229', 'gemini-pro', 'command-r-plus']
+# Papers are moderated in chunks of about this many characters, several
+# chunks per request and several requests at a time
+MODERATION_CHUNK_CHARS = int(os.environ.get('MODERATION_CHUNK_CHARS', 2000))
+MODERATION_BATCH = int(os.environ.get('MODERATION_BATCH', 8))
+MODERATION_CONCURRENCY = int(os.environ.get('MODERATION_CONCURRENCY', 4))
+# Seconds between snapshots while nothing arrives, so queue status stays current
+STATUS_INTERVAL = 1.0
+# Seconds a model has to finish its whole review, not counting time its calls
+# spend queued behind other users' calls; 0 means no deadline
+REVIEW_DEADLINE = float(os.environ.get('REVIEW_DEADLINE', 600))
+# Replace a model that misses the deadline or fails every section with an unused one
+MODEL_FALLBACK = os.environ.get('MODEL_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
+
+# Clock of a review's deadline. It is stopped while the review has calls
+# queued in the scheduler and none in flight: time spent queued behind other
+# users is load, not a slow model, and falling back to another model for it
+# would only add more load. Updated from the provider loop only.
+class ReviewClock:
+    def __init__(self):
+        self.used = 0.0
+        self.waiting = 0
+        self.running = 0
+        self.started = time.monotonic()
+
+    def update(self, waiting=0, running=0):
+        self.waiting += waiting
+        self.running += running
+        now = time.monotonic()
+        if self.waiting > 0 and self.running == 0:
+            if self.started is not None:
+                self.used += now - self.started
+                self.started = None
+        elif self.started is None:
+            self.started = now
+
+    def elapsed(self):
+        return self.used + (time.monotonic() - self.started if self.started is not None else 0)
+
+# Function to await a review under REVIEW_DEADLINE, as measured by a ReviewClock
+async def with_review_deadline(review):
+    if REVIEW_DEADLINE <= 0:
+        return await review
+    clock = ReviewClock()
+    # Set before the task is created, so the task's copy of the context has it
+    scheduler.track_calls(clock)
+    task = asyncio.ensure_future(review)
+    try:
+        while True:
+            # The clock may have been stopped meanwhile, so time left is checked again on waking
+            left = REVIEW_DEADLINE - clock.elapsed()
+            if left <= 0:
+                raise asyncio.TimeoutError()
+            done, _ = await asyncio.wait({task}, timeout=left)
+            if done:
+                return task.result()
+    finally:
+        task.cancel()
+
+def extract_text_from_pdf(filename, max_chars=None):
+    with open(filename, "rb") as f:
+        return extract_text(f.read(), max_chars, path=filename)
 
 
 def process_paper(pdf_file, paper_dir, prompt_dir, api_keys):
+    reviews, selected_models = [], []
+    for reviews, selected_models, done in stream_paper(pdf_file, paper_dir, prompt_dir, api_keys):
+        pass
+    # Models that failed have an empty review; they are dropped from both
+    # lists, so each review stays paired with the model that wrote it
+    answered = [(review, model) for review, model in zip(reviews, selected_models) if review]
+    return [review for review, _ in answered], [model for _, model in answered]
+
+
+# Generator form of process_paper. Yields (reviews, selected_models, done)
+# whenever a section arrives or grows, and every STATUS_INTERVAL seconds
+# otherwise; reviews holds one list of "Header: text" sections per selected
+# model, in header order. Provider calls are queued fairly per user_id. A
+# model that fails is swapped for an unused one, so selected_models can change
+# between yields. Callers that already hashed the PDF pass its paper_digest.
+def stream_paper(pdf_file, paper_dir, prompt_dir, api_keys, user_id=None, paper_digest=None, selected_models=None):
     logging.info(f"Processing file type in process_paper: {type(pdf_file)}")
     logging.debug(f"Starting to process paper: {pdf_file}")
-    os.makedirs(paper_dir, exist_ok=True)
 
+    # Only a PDF known to be on disk is passed to extraction by path
+    file_path = None
     if isinstance(pdf_file, str):
-        pdf_path = pdf_file
+        pdf_path = file_path = pdf_file
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
     elif hasattr(pdf_file, 'name') and hasattr(pdf_file, 'read'):
-        pdf_path = os.path.join(paper_dir, pdf_file.name)
-        with open(pdf_path, "wb") as f:
-            f.write(pdf_file.read())
+        # Uploads are extracted from memory, so same-named uploads cannot clobber each other on disk
+        pdf_path = pdf_file.name
+        pdf_bytes = pdf_file.read()
     else:
         logging.error(
             "Received object is neither a path nor a file-like object.")
-        return [], []
+        yield [], [], True
+        return
 
-    extracted_text = extract_text_from_pdf(pdf_path)
-    paper = Paper(pdf_file.name if hasattr(pdf_file, 'name')
-                  else os.path.basename(pdf_path), extracted_text)
-
-    models = ['gpt-4-turbo-2024-04-09', 'gpt-4o', 'claude-3-opus-20240229', 'gemini-pro', 'command-r-plus']
-    selected_models = random.sample(models, 2)
+    # Queued jobs come with the pair the web tier picked
+    selected_models = list(selected_models) if selected_models else pair_sampler.sample(MODELS)
 
     # REPLACE ONE OF THE MODELS WITH command-r-plus
     # selected_models = ['gpt-4o', 'command-r-plus']
 
+    # Serve reviews of previously seen (paper, model, prompt set) triples from the cache
+    paper_digest = paper_digest or hashlib.sha512(pdf_bytes).hexdigest()
+    prompt_version = prompt_set_version(prompt_dir)
+    cache_keys = {model: review_cache_key(paper_digest, model, prompt_version) for model in selected_models}
+    results = {model: review_cache.get(cache_keys[model]) for model in selected_models}
+    missing_models = [model for model in selected_models if results[model] is None]
+    logging.info(f"Review cache hits: {len(selected_models) - len(missing_models)}/{len(selected_models)}")
+
+    if missing_models:
+        sections = {model: {} for model in missing_models}
+        spare_models = [model for model in MODELS if model not in selected_models]
+        random.shuffle(spare_models)
+
+        def snapshot():
+            return [results[model] if model not in sections else
+                    [f"{PaperProcessor.HEADER[i-1]} {text}" for i, text in sorted(sections[model].items())]
+                    for model in selected_models]
+
+        yield snapshot(), selected_models, False
+
+        # Spans of one upload share a trace named after the paper digest
+        trace_id = paper_digest[:16]
+        max_chars = max(prompt_char_limit(model) for model in missing_models)
+        with span('extract', trace_id=trace_id) as extract_span:
+            extracted_text = extract_text(pdf_bytes, max_chars, paper_digest, file_path)
+            extract_span.set(chars=len(extracted_text))
+        paper = Paper(pdf_file.name if hasattr(pdf_file, 'name')
+                      else os.path.basename(pdf_path), extracted_text)
+
+        # Section updates are produced on the provider loop and consumed here
+        events = queue.Queue()
+
+        async def review_with_model(model):
+            processor = PaperProcessor(prompt_dir, model, **api_keys)
+            return await with_review_deadline(processor.process_paper_async(
+                paper, on_section=lambda i, text, final: events.put(('section', model, i, text))))
+
+        # Each review is cached as soon as it is finished, so it is kept even
+        # if this generator is closed or its process dies before the others.
+        # Reviews with failed sections are not cached so a later upload can retry them.
+        async def cache_result(model, result):
+            if not any(section.endswith(' N/A') for section in result):
+                await asyncio.to_thread(review_cache.put, review_cache_key(paper_digest, model, prompt_version), result)
+            return model, result
+
+        # Returns (model, result) where model is the one that finally answered
+        async def process_with_model(model):
+            while True:
+                try:
+                    result = await review_with_model(model)
+                    if not all(section.endswith(' N/A') for section in result):
+                        return await cache_result(model, result)
+                    error = "failed every section"
+                except Exception as e:
+                    result, error = e, repr(e)
+                if not MODEL_FALLBACK or not spare_models:
+                    return model, result
+                # Spares run on the provider loop only, so popping needs no lock
+                fallback = spare_models.pop()
+                logging.warning(f"Replacing {model} with {fallback}: {error}")
+                events.put(('swap', model, fallback))
+                cached = await asyncio.to_thread(review_cache.get, review_cache_key(paper_digest, fallback, prompt_version))
+                if cached is not None:
+                    return fallback, cached
+                model = fallback
+
+        async def process_with_models():
+            set_trace(trace_id)
+            scheduler.set_user(user_id or paper_digest)
+            # One moderation pass for the paper, before either review starts
+            if await moderate_paper(extracted_text, paper_digest):
+                return [await cache_result(model, PaperProcessor.DESK_REJECTION) for model in missing_models]
+            return await asyncio.gather(*[process_with_model(model) for model in missing_models])
+
+        future = asyncio.run_coroutine_threadsafe(process_with_models(), providers.get_loop())
+        future.add_done_callback(lambda _: events.put(None))
+        finished = False
+        try:
+            while not finished:
+                # Coalesce everything that arrived since the last update into one yield
+                try:
+                    batch = [events.get(timeout=STATUS_INTERVAL)]
+                except queue.Empty:
+                    batch = []
+                while True:
+                    try:
+                        batch.append(events.get_nowait())
+                    except queue.Empty:
+                        break
+                for event in batch:
+                    if event is None:
+                        finished = True
+                    elif event[0] == 'swap':
+                        _, model, fallback = event
+                        selected_models[selected_models.index(model)] = fallback
+                        del sections[model]
+                        sections[fallback] = {}
+                    elif event[1] in sections:
+                        _, model, i, text = event
+                        sections[model][i] = text
+                if not finished:
+                    yield snapshot(), selected_models, False
+        finally:
+            # A caller that stops listening (a closed page, a worker that lost
+            # its job) stops the calls still running; finished reviews are cached
+            future.cancel()
+
+        for model, result in future.result():
+            results[model] = result
+
     reviews = []
+    for model in selected_models:
+        result = results[model]
+        if isinstance(result, Exception):
+            logging.error(f"Model {model} generated an exception: {result}")
+            result = []
+        reviews.append(result)
+
+    log_payload("Reviews generated", reviews)
+    yield reviews, selected_models, True
+
+
+# Function to split text into chunks of at most size characters, at whitespace where possible
+def moderation_chunks(text, size=MODERATION_CHUNK_CHARS):
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            split = text.rfind(' ', start + size // 2, end)
+            end = split + 1 if split != -1 else end
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+# Function to check a paper's text with the moderation endpoint; True if it is
+# flagged. The text is sent in chunks, batched and concurrently, and checking
+# stops at the first flagged batch. Verdicts are cached by paper digest, so a
+# re-upload is not moderated again. Errors count as not flagged, uncached.
+# The cache does file I/O, so it is used off the provider loop.
+async def moderate_paper(text, paper_digest):
+    key = hashlib.sha256(f"{paper_digest}:{len(text)}".encode('utf-8')).hexdigest()
+    flagged = await asyncio.to_thread(moderation_cache.get, key)
+    if flagged is not None:
+        return flagged
+
+    chunks = moderation_chunks(text)
+    semaphore = asyncio.Semaphore(MODERATION_CONCURRENCY)
+
+    async def check(batch):
+        async with semaphore:
+            return await providers.moderate(batch)
+
+    with span('moderation', chunks=len(chunks)) as moderation_span:
+        tasks = [asyncio.ensure_future(check(chunks[i:i + MODERATION_BATCH]))
+                 for i in range(0, len(chunks), MODERATION_BATCH)]
+        flagged = False
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                if await next_done:
+                    flagged = True
+                    break
+        except Exception as e:
+            logging.error(f"Moderation failed, treating the paper as appropriate: {e!r}")
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
+        moderation_span.set(flagged=flagged)
+    await asyncio.to_thread(moderation_cache.put, key, flagged)
+    return flagged
+
 
-    def process_with_model(model):
-        processor = PaperProcessor(prompt_dir, model, **api_keys)
-        return processor.process_paper(paper)
-
-    with ThreadPoolExecutor() as executor:
-        future_to_model = {executor.submit(process_with_model, model): model for model in selected_models}
-        for future in concurrent.futures.as_completed(future_to_model):
-            model = future_to_model[future]
-            try:
-                review_text = future.result()
-                reviews.append(review_text)
-            except Exception as exc:
-                logging.error(f"Model {model} generated an exception: {exc}")
-
-    logging.debug(f"Reviews generated: {reviews}")
-    return reviews, selected_models
+# Function to get a user's place in the provider queues as (calls ahead,
+# seconds until all their calls have started), or None if none are waiting
+def queue_status(user_id):
+    async def status():
+        return scheduler.queue_status(user_id)
+    return providers.run(status())
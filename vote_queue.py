@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from metrics_utils import span, increment
+
+# Location of the local append-only vote log; its flushed offset lives next to it
+VOTE_LOG_PATH = os.environ.get('VOTE_LOG_PATH', os.path.join('vote_log', 'votes.jsonl'))
+FLUSH_INTERVAL = float(os.environ.get('VOTE_FLUSH_SECONDS', 1))
+BATCH_SIZE = 25  # DynamoDB BatchWriteItem limit
+MAX_BACKOFF = 60
+# Once everything is flushed, a log larger than this is truncated
+COMPACT_BYTES = 1024 * 1024
+
+
+# Function to check whether a write error is worth retrying, for writers
+# that do not say
+def is_transient(error):
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+# Write-behind queue for votes. submit() appends the vote to a local log and
+# fsyncs it, so the vote survives a crash; a background thread drains the log
+# into storage in batches and records how far it got in an offset file.
+# Records keep their RequestID, so replaying a batch after a crash is harmless.
+# Transient write errors are retried with backoff; a record that fails for
+# any other reason is moved to a dead-letter file next to the log, so one bad
+# record cannot hold up the votes behind it.
+class VoteQueue:
+    def __init__(self, writer, log_path=VOTE_LOG_PATH, is_transient=is_transient):
+        self.writer = writer
+        self.is_transient = is_transient
+        self.log_path = log_path
+        self.offset_path = f"{log_path}.offset"
+        self.dead_letter_path = f"{log_path}.dead"
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+        self._log = open(log_path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def submit(self, item):
+        line = json.dumps(item) + '\n'
+        with self._lock:
+            self._log.write(line)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        self._wake.set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='vote-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        backoff = 1
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                while self.flush_once():
+                    pass
+                backoff = 1
+            except Exception as e:
+                delay = random.uniform(backoff / 2, backoff)
+                logging.error(f"Vote flush failed, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                self._wake.set()
+
+    # Function to wait until every vote submitted so far is in storage; returns
+    # False if that did not happen within timeout seconds
+    def wait_flushed(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self._read_offset() < os.path.getsize(self.log_path):
+            if deadline is not None and time.time() >= deadline:
+                return False
+            self._wake.set()
+            time.sleep(0.05)
+        return True
+
+    # Function to write the next batch of unflushed votes. Returns False when
+    # there was nothing left to write.
+    def flush_once(self):
+        offset = self._read_offset()
+        batch, end = self._read_pending(offset)
+        if end == offset:
+            self._compact(offset)
+            return False
+        if batch:
+            with span('vote_write', votes=len(batch)):
+                try:
+                    self.writer(batch)
+                except Exception as e:
+                    if self.is_transient(e):
+                        raise
+                    # Some record in the batch is bad; write them one by one so only it is set aside
+                    self._write_each(batch)
+        self._write_offset(end)
+        return True
+
+    def _write_each(self, batch):
+        for item in batch:
+            try:
+                self.writer([item])
+            except Exception as e:
+                if self.is_transient(e):
+                    raise
+                logging.error(f"Moving vote {item.get('RequestID')} to {self.dead_letter_path}: {e!r}")
+                self._dead_letter(item, e)
+
+    def _dead_letter(self, item, error):
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'item': item, 'error': repr(error), 'time': time.time()}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        increment('arena_dead_votes_total')
+
+    def _read_pending(self, offset):
+        with open(self.log_path, 'rb') as f:
+            if offset > os.fstat(f.fileno()).st_size:
+                # The log was truncated after the offset was last written
+                offset = 0
+            f.seek(offset)
+            batch = []
+            end = offset
+            while len(batch) < BATCH_SIZE:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break  # nothing left, or a write still in progress
+                end += len(line)
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    logging.error(f"Skipping corrupt vote log line at offset {end - len(line)}")
+        return batch, end
+
+    def _compact(self, offset):
+        with self._lock:
+            if offset < COMPACT_BYTES or os.path.getsize(self.log_path) != offset:
+                return
+            self._log.truncate(0)
+            self._write_offset(0)
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path, 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = f"{self.offset_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)